@@ -0,0 +1,173 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.http import JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.exceptions import APIException, AuthenticationFailed, NotAuthenticated, PermissionDenied
+from rest_framework.permissions import SAFE_METHODS, IsAuthenticated
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+
+from .authentication import aauthenticate_credentials
+from .cache import acached_catalogue_response
+from .models import Category, Item, Order
+from .pagination import ItemCursorPagination, CategoryCursorPagination, OrderCursorPagination
+from .serializers import ItemSerializer, CategorySerializer, OrderSerializer
+from .filters import filter_items, filter_orders
+from .views import (
+    ITEM_FIELD_COLUMNS, ORDER_FIELD_COLUMNS, item_queryset, list_params, order_queryset, place_order,
+)
+
+
+# Async variants of the catalogue and order views, enabled with API_ASYNC_VIEWS.
+# They keep the URLs, permissions and response bodies of the views in views.py.
+
+def json_response(data, status_code=status.HTTP_200_OK):
+    return JsonResponse(data, status=status_code, encoder=JSONEncoder, safe=False)
+
+
+class AsyncAPIView(View):
+    """Async counterpart of APIView: token authentication, DRF permission classes, JSON responses."""
+
+    permission_classes = []
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Like APIView: token-authenticated clients do not send CSRF tokens
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            request.user = await self.authenticate(request)
+            self.check_permissions(request)
+        except (AuthenticationFailed, NotAuthenticated) as exc:
+            response = json_response({"detail": exc.detail}, exc.status_code)
+            response['WWW-Authenticate'] = 'Token'
+            return response
+        except APIException as exc:
+            return json_response({"detail": exc.detail}, exc.status_code)
+        try:
+            return await super().dispatch(request, *args, **kwargs)
+        except APIException as exc:
+            # Invalid filter, ordering or fields parameters
+            return json_response(exc.detail, exc.status_code)
+
+    async def authenticate(self, request):
+        header = request.headers.get('Authorization', '').split()
+        if header and header[0].lower() == 'token':
+            # Same messages as TokenAuthentication
+            if len(header) == 1:
+                raise AuthenticationFailed('Invalid token header. No credentials provided.')
+            if len(header) > 2:
+                raise AuthenticationFailed('Invalid token header. Token string should not contain spaces.')
+            user, _ = await aauthenticate_credentials(header[1])
+            return user
+        # Session users only for read requests: unsafe methods would need CSRF checks
+        if request.method in SAFE_METHODS:
+            return await request.auser()
+        return AnonymousUser()
+
+    def check_permissions(self, request):
+        for permission in self.permission_classes:
+            if not permission().has_permission(request, self):
+                if not request.user.is_authenticated:
+                    raise NotAuthenticated()
+                raise PermissionDenied()
+
+
+class ItemList(AsyncAPIView):
+    permission_classes = [IsAuthenticated]
+    pagination_class = ItemCursorPagination
+
+    async def get(self, request):
+        return await acached_catalogue_response(request, lambda: self.list(request))
+
+    async def list(self, request):
+        # Request is only used for query_params: it would re-run authentication on .user
+        query = Request(request)
+        paginator = self.pagination_class()
+        fields, ordering = list_params(query, paginator, ITEM_FIELD_COLUMNS)
+        items = filter_items(item_queryset(fields, ordering), query.query_params)
+        page = await paginator.apaginate_queryset(items, query, view=self)
+        serializer = ItemSerializer(page, many=True, context={'fields': fields})
+        return paginator.get_paginated_response(serializer.data).data, status.HTTP_200_OK
+
+
+class ItemDetail(AsyncAPIView):
+    permission_classes = [IsAuthenticated]
+
+    async def get(self, request, pk):
+        return await acached_catalogue_response(request, lambda: self.retrieve(request, pk))
+
+    async def retrieve(self, request, pk):
+        try:
+            item = await item_queryset().aget(pk=pk)
+        except Item.DoesNotExist:
+            return {"error": "Item not found"}, status.HTTP_404_NOT_FOUND
+        return ItemSerializer(item).data, status.HTTP_200_OK
+
+
+class CategoryList(AsyncAPIView):
+    permission_classes = [IsAuthenticated]
+    pagination_class = CategoryCursorPagination
+
+    async def get(self, request):
+        return await acached_catalogue_response(request, lambda: self.list(request))
+
+    async def list(self, request):
+        paginator = self.pagination_class()
+        page = await paginator.apaginate_queryset(Category.objects.all(), Request(request), view=self)
+        serializer = CategorySerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data).data, status.HTTP_200_OK
+
+
+class OrderCreate(AsyncAPIView):
+    permission_classes = [IsAuthenticated]
+
+    async def post(self, request):
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return json_response({"detail": "JSON parse error"}, status.HTTP_400_BAD_REQUEST)
+        if not isinstance(data, dict):
+            return json_response({"detail": "Expected a JSON object"}, status.HTTP_400_BAD_REQUEST)
+
+        # Validation and the stock reservation run in one transaction, which Django only supports synchronously
+        data, status_code = await sync_to_async(place_order)(request.user, data)
+        return json_response(data, status_code)
+
+
+class OrderList(AsyncAPIView):
+    permission_classes = [IsAuthenticated]
+    pagination_class = OrderCursorPagination
+
+    async def get(self, request):
+        query = Request(request)
+        paginator = self.pagination_class()
+        fields, ordering = list_params(query, paginator, ORDER_FIELD_COLUMNS)
+        orders = order_queryset(fields, ordering)
+        if request.user.role not in ['admin', 'superadmin']:
+            orders = orders.filter(user=request.user)
+        orders = filter_orders(orders, query.query_params)
+
+        page = await paginator.apaginate_queryset(orders, query, view=self)
+        serializer = OrderSerializer(page, many=True, context={'fields': fields})
+        return json_response(paginator.get_paginated_response(serializer.data).data)
+
+
+class OrderDetail(AsyncAPIView):
+    permission_classes = [IsAuthenticated]
+
+    async def get(self, request, pk):
+        try:
+            order = await order_queryset().aget(pk=pk)
+        except Order.DoesNotExist:
+            return json_response({"error": "Order not found"}, status.HTTP_404_NOT_FOUND)
+
+        if order.user_id != request.user.id and request.user.role not in ['admin', 'superadmin']:
+            return json_response({"error": "Access denied"}, status.HTTP_403_FORBIDDEN)
+
+        return json_response(OrderSerializer(order).data)
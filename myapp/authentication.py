@@ -0,0 +1,192 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.authtoken.models import Token
+
+from .metrics import Counter
+
+
+token_cache_lookups = Counter(
+    'api_token_cache_lookups', 'Token cache lookups by outcome', ['outcome'],
+)
+
+
+class _LRU:
+    """Thread-safe, size-bounded mapping whose entries expire ``ttl`` seconds after being stored."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return None if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class TokenCache:
+    """Authenticated tokens in an in-process LRU, optionally backed by a shared cache.
+
+    Entries hold plain values (token key, user pk, username, role, is_active), never model
+    instances: every request gets its own Token and user objects, so nothing mutable is
+    shared between threads or leaks from one request into another. Only tokens of active
+    users are stored. Entries are dropped explicitly when the user is updated or deleted,
+    or when a client evicts its own token; the local TTL bounds how long another process
+    can keep serving a stale entry after such a change.
+    """
+
+    # User fields kept per token; anything else is loaded on first access
+    USER_FIELDS = ('id', 'username', 'is_active', 'role')
+
+    def __init__(self, max_size, ttl, shared_alias=None, shared_ttl=300):
+        self.tokens = _LRU(max_size, ttl)
+        self.shared_alias = shared_alias
+        self.shared_ttl = shared_ttl
+
+    @property
+    def shared(self):
+        return caches[self.shared_alias] if self.shared_alias else None
+
+    @staticmethod
+    def shared_key(key):
+        # Raw token keys never leave the process
+        return 'auth:token:' + hashlib.sha256(key.encode()).hexdigest()
+
+    @classmethod
+    def user_fields(cls):
+        # from_db() expects the loaded fields in model order
+        return [field.attname for field in get_user_model()._meta.concrete_fields if field.attname in cls.USER_FIELDS]
+
+    @classmethod
+    def entry(cls, token):
+        return tuple(getattr(token.user, name) for name in cls.user_fields())
+
+    @classmethod
+    def build(cls, key, entry):
+        """A fresh Token with its user from a cached entry; other user fields are deferred."""
+        user = get_user_model().from_db(DEFAULT_DB_ALIAS, cls.user_fields(), entry)
+        token = Token.from_db(DEFAULT_DB_ALIAS, ['key', 'user_id'], [key, user.pk])
+        token.user = user
+        return token
+
+    def get(self, key):
+        """Return a Token (with ``token.user`` loaded) for a cached key, or None."""
+        entry = self.tokens.get(key)
+        if entry is not None:
+            token_cache_lookups.labels('local_hit').inc()
+            return self.build(key, entry)
+        if self.shared is not None:
+            entry = self.shared.get(self.shared_key(key))
+            if entry is not None:
+                token_cache_lookups.labels('shared_hit').inc()
+                self.tokens.set(key, entry)
+                return self.build(key, entry)
+        token_cache_lookups.labels('miss').inc()
+        return None
+
+    async def aget(self, key):
+        entry = self.tokens.get(key)
+        if entry is not None:
+            token_cache_lookups.labels('local_hit').inc()
+            return self.build(key, entry)
+        if self.shared is not None:
+            entry = await self.shared.aget(self.shared_key(key))
+            if entry is not None:
+                token_cache_lookups.labels('shared_hit').inc()
+                self.tokens.set(key, entry)
+                return self.build(key, entry)
+        token_cache_lookups.labels('miss').inc()
+        return None
+
+    def set(self, token):
+        entry = self.entry(token)
+        self.tokens.set(token.key, entry)
+        if self.shared is not None:
+            self.shared.set(self.shared_key(token.key), entry, self.shared_ttl)
+
+    async def aset(self, token):
+        entry = self.entry(token)
+        self.tokens.set(token.key, entry)
+        if self.shared is not None:
+            await self.shared.aset(self.shared_key(token.key), entry, self.shared_ttl)
+
+    def invalidate(self, key):
+        self.tokens.pop(key)
+        if self.shared is not None:
+            self.shared.delete(self.shared_key(key))
+
+    def invalidate_user(self, user_id):
+        """Drop the user's token; call before deleting the user, while the token row still exists."""
+        for key in Token.objects.filter(user_id=user_id).values_list('key', flat=True):
+            self.invalidate(key)
+
+    def clear(self):
+        self.tokens.clear()
+
+
+token_cache = TokenCache(
+    max_size=settings.AUTH_TOKEN_CACHE_SIZE,
+    ttl=settings.AUTH_TOKEN_CACHE_TTL,
+    shared_alias=settings.AUTH_TOKEN_SHARED_CACHE or None,
+    shared_ttl=settings.AUTH_TOKEN_SHARED_CACHE_TTL,
+)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication that skips the Token/user query for recently seen tokens."""
+
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(token)
+        return token.user, token
+
+
+async def aauthenticate_credentials(key):
+    """Async counterpart of CachedTokenAuthentication.authenticate_credentials."""
+    token = await token_cache.aget(key)
+    if token is None:
+        try:
+            token = await Token.objects.select_related('user').aget(key=key)
+        except Token.DoesNotExist:
+            raise AuthenticationFailed('Invalid token.')
+        if not token.user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+        await token_cache.aset(token)
+    return token.user, token
@@ -4,13 +4,20 @@ import os
 import sys
 import django
 from aiogram import Bot, Dispatcher, types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram import Router
 from aiogram import F
 import aiohttp
+from aiohttp import web
 import asyncio
+import functools
 from asgiref.sync import sync_to_async
 import base64
+import re
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, urljoin, urlsplit
 
 load_dotenv()
 
@@ -22,30 +29,213 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myproject.settings")
 django.setup()
 
 from myapp.models import Item
+from myapp.bot_storage import get_state_storage
+from myapp.bot_local import LocalAPIClient
+from myapp.bot_inline import ItemPrefixIndex
+from myapp.bot_media import get_file_cache
+from myapp.bot_webhook import WebhookServer
+from myapp.bot_scheduler import UserOrderingMiddleware
+from myapp.bot_throttle import OutboundLimiter
+from myapp.bot_reply import ReplyStream, split_message
+from myapp.bot_logging import SamplingFilter, Truncated, setup_logging
+from myapp.metrics import CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram
 API_TOKEN = os.getenv("API_TOKEN")
 API_BASE_URL = os.getenv("API_BASE_URL")
+# API-ге қатынау тәсілі: "http" (әдепкі) немесе "local" - бір хостта Django сервистерін процесс ішінде шақыру
+API_TRANSPORT = os.getenv("API_TRANSPORT", "http")
 
 if not API_TOKEN:
     raise ValueError("❌ API_TOKEN .env файлында жоқ")
-if not API_BASE_URL:
+if API_TRANSPORT not in ("http", "local"):
+    raise ValueError(f"❌ API_TRANSPORT мәні белгісіз: {API_TRANSPORT}")
+if API_TRANSPORT == "http" and not API_BASE_URL:
     raise ValueError("❌ API_BASE_URL .env файлында жоқ")
 
 # Нақты superadmin деректерін пайдаланыңыз
 DEFAULT_USERNAME = os.getenv("DEFAULT_USERNAME")
 DEFAULT_PASSWORD = os.getenv("DEFAULT_PASSWORD")
 
-user_login_state = {}
+user_login_state = get_state_storage()
+# Тауар суреттерінің Telegram file_id-лері: бір сурет Telegram-ға бір рет қана жүктеледі
+telegram_files = get_file_cache()
+
+# Telegram-ға жіберу шектеулері (секундына): жалпы, бір чатқа және топтарға
+BOT_GLOBAL_RATE = float(os.getenv("BOT_GLOBAL_RATE", "30"))
+BOT_CHAT_RATE = float(os.getenv("BOT_CHAT_RATE", "1"))
+BOT_CHAT_BURST = int(os.getenv("BOT_CHAT_BURST", "3"))
+BOT_GROUP_RATE = float(os.getenv("BOT_GROUP_RATE", str(20 / 60)))
+# 429 жауабынан кейінгі қайталау саны
+BOT_SEND_RETRIES = int(os.getenv("BOT_SEND_RETRIES", "3"))
+# Ұзын тізімнің бір жауабындағы хабарламалар шегі (0 - шексіз)
+BOT_LIST_MAX_MESSAGES = int(os.getenv("BOT_LIST_MAX_MESSAGES", "50"))
 
 bot = Bot(token=API_TOKEN)
+# Барлық шығыс сұраулар бір кезектен өтеді: интерактивті жауаптар көлемді шығыстан бұрын жіберіледі
+outbound_limiter = OutboundLimiter(
+    global_rate=BOT_GLOBAL_RATE,
+    chat_rate=BOT_CHAT_RATE,
+    chat_burst=BOT_CHAT_BURST,
+    group_rate=BOT_GROUP_RATE,
+    max_retries=BOT_SEND_RETRIES,
+)
+bot.session.middleware(outbound_limiter)
 dp = Dispatcher()
 router = Router()
 
 dp.include_router(router)
 
+# Жаңартуларды параллель өңдеу шектеулері
+BOT_CONCURRENCY = int(os.getenv("BOT_CONCURRENCY", "64"))
+BOT_MAX_PENDING = int(os.getenv("BOT_MAX_PENDING", "1000"))
+BOT_DRAIN_TIMEOUT = float(os.getenv("BOT_DRAIN_TIMEOUT", "30"))
+
+def command_label(event):
+    """Метрика белгісі: команда атауы немесе хабарлама түрі"""
+    if isinstance(event, types.CallbackQuery):
+        return f"callback:{(event.data or '').split(':', 1)[0]}"
+    if isinstance(event, types.InlineQuery):
+        return 'inline_query'
+    text = getattr(event, 'text', None)
+    if text and text.startswith('/'):
+        return text.split(maxsplit=1)[0].split('@', 1)[0]
+    if getattr(event, 'photo', None):
+        return 'photo'
+    if getattr(event, 'document', None):
+        return 'document'
+    return 'text'
+
+async def handler_metrics_middleware(handler, event, data):
+    command = command_label(event)
+    in_flight = bot_handlers_in_flight.labels()
+    in_flight.inc()
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        bot_handler_errors.labels(command).inc()
+        raise
+    finally:
+        bot_handler_seconds.labels(command).observe(time.perf_counter() - started)
+        in_flight.dec()
+
+dp.message.middleware(handler_metrics_middleware)
+dp.callback_query.middleware(handler_metrics_middleware)
+dp.inline_query.middleware(handler_metrics_middleware)
+
+async def metrics_handler(request):
+    return web.Response(body=REGISTRY.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+metrics_runner = None
+
+# Бір пайдаланушының хабарламалары ретімен, әртүрлі пайдаланушылар параллель өңделеді
+update_scheduler = UserOrderingMiddleware(concurrency=BOT_CONCURRENCY, max_pending=BOT_MAX_PENDING)
+dp.update.outer_middleware(update_scheduler)
+
+# HTTP пулының баптаулары (.env арқылы өзгертуге болады)
+API_POOL_LIMIT = int(os.getenv("API_POOL_LIMIT", "100"))
+API_POOL_LIMIT_PER_HOST = int(os.getenv("API_POOL_LIMIT_PER_HOST", "20"))
+API_KEEPALIVE_TIMEOUT = float(os.getenv("API_KEEPALIVE_TIMEOUT", "30"))
+API_DNS_CACHE_TTL = int(os.getenv("API_DNS_CACHE_TTL", "300"))
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "5"))
+API_TOTAL_TIMEOUT = float(os.getenv("API_TOTAL_TIMEOUT", "30"))
+API_IMPORT_TIMEOUT = float(os.getenv("API_IMPORT_TIMEOUT", "900"))
+
+# Пайдаланушы сессияларының шектеулері
+USER_SESSIONS_MAX = int(os.getenv("USER_SESSIONS_MAX", "10000"))
+USER_SESSION_TTL = float(os.getenv("USER_SESSION_TTL", "43200"))
+
+# Логтау баптаулары: деңгей, API логтарының үлесі (0..1) және payload ұзындығы
+BOT_LOG_LEVEL = os.getenv("BOT_LOG_LEVEL", "INFO")
+API_LOG_SAMPLE_RATE = float(os.getenv("API_LOG_SAMPLE_RATE", "1.0"))
+API_LOG_MAX_CHARS = int(os.getenv("API_LOG_MAX_CHARS", "500"))
+
+api_logger = logging.getLogger("myapp.bot.api")
+api_logger.addFilter(SamplingFilter(API_LOG_SAMPLE_RATE))
+
+# ========== МЕТРИКАЛАР ==========
+BOT_METRICS_HOST = os.getenv("BOT_METRICS_HOST", "127.0.0.1")
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "0"))  # 0 - /metrics сервері өшірулі
+
+bot_handler_seconds = Histogram('bot_handler_seconds', 'Bot handler latency in seconds', ['command'])
+bot_handler_errors = Counter('bot_handler_errors', 'Bot handlers that raised', ['command'])
+bot_handlers_in_flight = Gauge('bot_handlers_in_flight', 'Bot handlers currently running')
+api_upstream_seconds = Histogram('bot_api_upstream_seconds', 'Django API call latency seen by the bot', ['method', 'endpoint'])
+api_upstream_requests = Counter('bot_api_upstream_requests', 'Django API calls by status', ['method', 'endpoint', 'status'])
+api_upstream_in_flight = Gauge('bot_api_upstream_in_flight', 'Django API calls currently in progress')
+item_photo_sends = Counter('bot_item_photo_sends', 'Item photos sent, by file_id cache outcome', ['source'])
+
+# Метрика белгілері: API маршруттарының үлгілері, белгісіз жол - "other".
+# Пайдаланушы енгізген кез келген ID белгілер санын көбейтпейді.
+# Тұрақты маршруттар {id} үлгілерінен бұрын тексеріледі (/items/search/ және /items/{id}/)
+API_ROUTES = (
+    '/users/', '/user/create/', '/user/{id}/', '/user/{id}/edit/', '/user/{id}/delete/',
+    '/items/', '/items/create/', '/items/import/', '/items/search/',
+    '/items/{id}/', '/items/{id}/edit/', '/items/{id}/delete/', '/items/{id}/image/',
+    '/categories/', '/categories/create/',
+    '/orders/', '/orders/create/', '/orders/checkout/', '/orders/{id}/',
+    '/token-cache/evict/',
+)
+API_ROUTE_PATTERNS = [
+    (re.compile('^' + re.escape(route).replace(re.escape('{id}'), '[^/]+') + '$'), route)
+    for route in API_ROUTES
+]
+
+def endpoint_label(endpoint):
+    for pattern, route in API_ROUTE_PATTERNS:
+        if pattern.match(endpoint):
+            return route
+    return 'other'
+
+async def read_body(response):
+    """JSON жауап денесі, JSON болмаса - мәтін (204 үшін бос жол)"""
+    if response.status == 204:
+        return ''
+    try:
+        return await response.json()
+    except (ValueError, aiohttp.ContentTypeError):
+        return await response.text()
+
 class APIClient:
-    def __init__(self, base_url):
+    def __init__(self, base_url, token=None, parent=None):
         self.base_url = base_url
-        self.token = None
+        self.token = token
+        self.session = None
+        # Пайдаланушы клиенттері ата-клиенттің қосылым пулын ортақ пайдаланады
+        self.parent = parent
+
+    def for_token(self, token):
+        """Осы пулды пайдаланатын, берілген token-і бар клиент"""
+        return APIClient(self.base_url, token=token, parent=self.parent or self)
+
+    async def start(self):
+        """Ортақ HTTP сессиясын және қосылым пулын құру"""
+        if self.parent is not None:
+            return await self.parent.start()
+        if self.session is not None and not self.session.closed:
+            return self.session
+
+        connector = aiohttp.TCPConnector(
+            limit=API_POOL_LIMIT,
+            limit_per_host=API_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=API_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=API_DNS_CACHE_TTL,
+        )
+        timeout = aiohttp.ClientTimeout(total=API_TOTAL_TIMEOUT, connect=API_CONNECT_TIMEOUT)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.session
+
+    async def close(self):
+        """Сессияны және пулдағы қосылымдарды жабу"""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def get_session(self):
+        if self.parent is not None:
+            return await self.parent.get_session()
+        if self.session is None or self.session.closed:
+            await self.start()
+        return self.session
     
     async def login(self, username, password):
         """Жүйеге кіру және token алу"""
@@ -54,46 +244,74 @@ class APIClient:
             'password': password
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{self.base_url}/token-login/", json=login_data) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    self.token = data.get('token')
-                    return data, response.status
-                else:
-                    return await response.json(), response.status
+        session = await self.get_session()
+        async with session.post(f"{self.base_url}/token-login/", json=login_data) as response:
+            return await response.json(), response.status
+
+    async def evict_token(self):
+        """Token-ді сервердің аутентификация кэшінен шығару (token жарамды болып қалады)"""
+        return await self.make_request('POST', '/token-cache/evict/')
     
-    async def make_request(self, method, endpoint, data=None):
+    async def make_request(self, method, endpoint, data=None, params=None):
         url = f"{self.base_url}{endpoint}"
         headers = {}
         
         if self.token:
             headers['Authorization'] = f'Token {self.token}'
         
-            # Debug логирование
-        print(f"🔧 API сұранысы: {method} {url}")
-        print(f"🔧 Header'лар: {headers}")
-        print(f"🔧 Деректер: {data}")
+        if api_logger.isEnabledFor(logging.DEBUG):
+            api_logger.debug("api_request method=%s url=%s params=%s headers=%s data=%s",
+                             method, url, params, Truncated(headers), Truncated(data, API_LOG_MAX_CHARS))
         
-        async with aiohttp.ClientSession() as session:
-            async with session.request(method, url, json=data, headers=headers) as response:
-                print(f"🔧 API жауап статусы: {response.status}")
-                
-                if response.status == 200 or response.status == 201:
-                    result = await response.json()
-                    print(f"🔧 API жауап деректері: {result}")
-                    return result, response.status
-                else:
-                    try:
-                        error_text = await response.json()
-                        print(f"🔧 API қате JSON: {error_text}")
-                    except:
-                        error_text = await response.text()
-                        print(f"🔧 API қате мәтіні: {error_text}")
-                    return error_text, response.status
+        route = endpoint_label(endpoint)
+        in_flight = api_upstream_in_flight.labels()
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            session = await self.get_session()
+            async with session.request(method, url, json=data, params=params, headers=headers) as response:
+                api_upstream_requests.labels(method, route, response.status).inc()
+                body = await read_body(response)
+                # Кез келген 2xx сәтті жауап, соның ішінде денесі жоқ 204 (мысалы, DELETE)
+                if 200 <= response.status < 300:
+                    api_logger.info("api_response method=%s url=%s status=%s duration_ms=%.1f",
+                                    method, url, response.status, (time.perf_counter() - started) * 1000)
+                    api_logger.debug("api_response_body url=%s body=%s", url, Truncated(body, API_LOG_MAX_CHARS))
+                    return body, response.status
+                api_logger.warning("api_error method=%s url=%s status=%s duration_ms=%.1f body=%s",
+                                   method, url, response.status, (time.perf_counter() - started) * 1000,
+                                   Truncated(body, API_LOG_MAX_CHARS))
+                return body, response.status
+        finally:
+            api_upstream_seconds.labels(method, route).observe(time.perf_counter() - started)
+            in_flight.dec()
+
+    async def iter_pages(self, fetch_page):
+        """Курсор бойынша беттерді бір-бірлеп қайтару: (жауап, статус); қате болса сонымен тоқтайды"""
+        cursor = None
+        while True:
+            response, status_code = await fetch_page(cursor=cursor)
+            yield response, status_code
+            if status_code != 200:
+                return
+            cursor = parse_cursor(response.get('next'))
+            if not cursor:
+                return
+
+    async def fetch_all(self, fetch_page):
+        """Курсор бойынша барлық беттерді бір тізімге жинау"""
+        results = []
+        async for response, status_code in self.iter_pages(fetch_page):
+            if status_code != 200:
+                return response, status_code
+            results.extend(response.get('results', []))
+        return results, 200
 
-    async def get_users(self):
-        return await self.make_request('GET', '/users/')
+    async def get_users(self, cursor=None):
+        return await self.make_request('GET', '/users/', params=page_params(cursor))
+
+    async def get_all_users(self):
+        return await self.fetch_all(self.get_users)
     
     async def get_user(self, user_id):
         return await self.make_request('GET', f'/user/{user_id}/')
@@ -107,11 +325,49 @@ class APIClient:
     async def delete_user(self, user_id):
         return await self.make_request('DELETE', f'/user/{user_id}/delete/')
     
-    async def get_items(self):
-        return await self.make_request('GET', '/items/')
+    async def get_items(self, cursor=None, **params):
+        # params: сүзгілер, ordering және fields (мысалы fields="id,name,price")
+        return await self.make_request('GET', '/items/', params=page_params(cursor, **params))
+    
+    async def post_file(self, endpoint, field, chunks, filename):
+        """Файлды бөліктермен API-ге ағынмен жіберу (толық жадқа жүктемей)"""
+        headers = {}
+        if self.token:
+            headers['Authorization'] = f'Token {self.token}'
+
+        form = aiohttp.FormData()
+        form.add_field(field, chunks, filename=filename)
+
+        session = await self.get_session()
+        timeout = aiohttp.ClientTimeout(total=API_IMPORT_TIMEOUT, connect=API_CONNECT_TIMEOUT)
+        async with session.post(f"{self.base_url}{endpoint}", data=form, headers=headers, timeout=timeout) as response:
+            try:
+                return await response.json(), response.status
+            except aiohttp.ContentTypeError:
+                return await response.text(), response.status
+
+    async def import_items(self, chunks, filename):
+        return await self.post_file('/items/import/', 'file', chunks, filename)
+
+    async def upload_item_image(self, item_id, chunks, filename):
+        return await self.post_file(f'/items/{item_id}/image/', 'image', chunks, filename)
     
     async def get_item(self, item_id):
         return await self.make_request('GET', f'/items/{item_id}/')
+
+    async def get_media(self, url):
+        """Сурет байттарын алу; /media/... сияқты салыстырмалы сілтеме API хостына қатысты"""
+        session = await self.get_session()
+        async with session.get(urljoin(self.base_url, url)) as response:
+            if response.status != 200:
+                return await response.text(), response.status
+            return await response.read(), response.status
+
+    async def search_items(self, query, offset=None):
+        params = {'q': query}
+        if offset:
+            params['offset'] = offset
+        return await self.make_request('GET', '/items/search/', params=params)
     
     async def create_item(self, item_data):
         return await self.make_request('POST', '/items/create/', item_data)
@@ -122,29 +378,210 @@ class APIClient:
     async def delete_item(self, item_id):
         return await self.make_request('DELETE', f'/items/{item_id}/delete/')
 
-    async def get_categories(self):
-        return await self.make_request('GET', '/categories/')
+    async def get_categories(self, cursor=None):
+        return await self.make_request('GET', '/categories/', params=page_params(cursor))
+
+    async def get_all_categories(self):
+        return await self.fetch_all(self.get_categories)
+
+    async def fetch_all_if_changed(self, endpoint, etag=None, **params):
+        """Тізім өзгерген болса ғана барлық беттерді алу.
+
+        (results, status, etag) қайтарады; өзгеріс болмаса results = None, status = 304.
+        """
+        headers = {}
+        if self.token:
+            headers['Authorization'] = f'Token {self.token}'
+        if etag:
+            headers['If-None-Match'] = etag
+
+        session = await self.get_session()
+        async with session.get(f"{self.base_url}{endpoint}", params=page_params(None, 100, **params), headers=headers) as response:
+            if response.status == 304:
+                return None, response.status, etag
+            if response.status != 200:
+                return await response.text(), response.status, None
+            first_page = await response.json()
+            new_etag = response.headers.get('ETag')
+
+        results = list(first_page.get('results', []))
+        cursor = parse_cursor(first_page.get('next'))
+        while cursor:
+            page, status_code = await self.make_request('GET', endpoint, params=page_params(cursor, 100, **params))
+            if status_code != 200:
+                return page, status_code, None
+            results.extend(page.get('results', []))
+            cursor = parse_cursor(page.get('next'))
+        return results, 200, new_etag
+
+    async def get_categories_if_changed(self, etag=None):
+        return await self.fetch_all_if_changed('/categories/', etag)
+
+    async def get_items_if_changed(self, etag=None, **params):
+        return await self.fetch_all_if_changed('/items/', etag, **params)
 
     async def create_category(self, category_data):
         return await self.make_request('POST', '/categories/create/', category_data)
 
-    async def get_orders(self):
-        return await self.make_request('GET', '/orders/')
+    async def get_orders(self, cursor=None, **params):
+        return await self.make_request('GET', '/orders/', params=page_params(cursor, **params))
+
+    async def get_all_orders(self):
+        return await self.fetch_all(self.get_orders)
 
     async def create_order(self, order_data):
         return await self.make_request('POST', '/orders/create/', order_data)
 
+    async def checkout(self, lines):
+        return await self.make_request('POST', '/orders/checkout/', {'lines': lines})
+
     async def get_order(self, order_id):
         return await self.make_request('GET', f'/orders/{order_id}/')
 
-api_client = APIClient(API_BASE_URL)
+# Категориялар кэшінің өмір сүру уақыты (секунд)
+CATEGORY_CACHE_TTL = float(os.getenv("CATEGORY_CACHE_TTL", "60"))
+
+class CategoryCache:
+    """Барлық пайдаланушыларға ортақ категориялар кэші (id -> категория).
+
+    TTL біткенде API-ден ETag арқылы тексеріледі: өзгеріс болмаса 304 қайтады
+    және тізім қайта жүктелмейді. Бір уақытта тек бір жаңарту сұранысы жүреді.
+    """
+
+    def __init__(self, ttl=CATEGORY_CACHE_TTL):
+        self.ttl = ttl
+        self.categories = {}
+        self.etag = None
+        self.expires_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.expires_at = 0.0
+
+    async def get(self, client):
+        """(categories, status) қайтарады, categories - id бойынша сөздік"""
+        if time.monotonic() < self.expires_at:
+            return self.categories, 200
+
+        async with self._lock:
+            if time.monotonic() < self.expires_at:
+                return self.categories, 200
+
+            categories, status_code, etag = await client.get_categories_if_changed(self.etag)
+            if status_code == 200:
+                self.categories = {cat['id']: cat for cat in categories}
+                self.etag = etag
+            elif status_code != 304:
+                return categories, status_code
+
+            self.expires_at = time.monotonic() + self.ttl
+            return self.categories, 200
+
+category_cache = CategoryCache()
+
+def page_params(cursor, page_size=None, **filters):
+    params = {name: value for name, value in filters.items() if value is not None}
+    if cursor:
+        params['cursor'] = cursor
+    if page_size:
+        params['page_size'] = page_size
+    return params or None
+
+def parse_cursor(page_url):
+    """API қайтарған next/previous сілтемесінен курсорды алу"""
+    if not page_url:
+        return None
+    return parse_qs(urlsplit(page_url).query).get('cursor', [None])[0]
+
+def parse_offset(page_url):
+    """Іздеу нәтижелерінің next/previous сілтемесінен offset алу (бірінші бетте offset болмайды)"""
+    if not page_url:
+        return None
+    return int(parse_qs(urlsplit(page_url).query).get('offset', ['0'])[0])
+
+class UserSessionRegistry:
+    """Telegram user id бойынша token-ді клиенттердің процесс ішіндегі кэші (LRU + бос тұру TTL).
+
+    Token-нің өзі user_login_state-те сақталады, сондықтан LRU бойынша шығарылған немесе
+    қайта іске қосылғаннан кейін жоғалған клиент келесі жаңартуда қайта құрылады.
+    """
+
+    def __init__(self, client, max_size=USER_SESSIONS_MAX, ttl=USER_SESSION_TTL):
+        self.client = client
+        self.max_size = max_size
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def set(self, user_id, token):
+        self._sessions.pop(user_id, None)
+        self._sessions[user_id] = [self.client.for_token(token), time.monotonic() + self.ttl]
+        while len(self._sessions) > self.max_size:
+            self._sessions.popitem(last=False)
+
+    def get(self, user_id):
+        entry = self._sessions.get(user_id)
+        if entry is None:
+            return None
+        entry[1] = time.monotonic() + self.ttl
+        self._sessions.move_to_end(user_id)
+        return entry[0]
+
+    def expire(self, user_id):
+        """Бос тұру TTL-і өткен сессияны жою; жойылса True"""
+        entry = self._sessions.get(user_id)
+        if entry is None or entry[1] > time.monotonic():
+            return False
+        del self._sessions[user_id]
+        return True
+
+    def discard(self, user_id):
+        self._sessions.pop(user_id, None)
+
+api_client = LocalAPIClient() if API_TRANSPORT == "local" else APIClient(API_BASE_URL)
+api_sessions = UserSessionRegistry(api_client)
+
+def get_api_client(user_id):
+    """Пайдаланушының жеке клиенті, ол жоқ болса - token-сіз ортақ клиент"""
+    return api_sessions.get(user_id) or api_client
+
+async def refresh_session(user_id):
+    """Сессияны handler-ден бұрын state-пен сәйкестендіру.
+
+    Мерзімі өткен сессия пайдаланушыны шығарады. Клиент жоқ болса (қайта іске қосу, басқа
+    бот процесі, LRU), ол state-тегі token-нен қалпына келтіріледі; token жоқ болса,
+    пайдаланушы қайта кіруі керек - әйтпесе ол кірген болып көрінеді, бірақ API 401 қайтарады.
+    """
+    if api_sessions.expire(user_id):
+        await user_login_state.areset(user_id, is_logged_in=False, waiting_for_login=False)
+        return
+    if api_sessions.get(user_id) is not None:
+        return
+    state = await user_login_state.aget(user_id)
+    if not state.get("is_logged_in"):
+        return
+    if state.get("token"):
+        api_sessions.set(user_id, state.token)
+    else:
+        await user_login_state.areset(user_id, is_logged_in=False, waiting_for_login=False)
+
+async def user_session_middleware(handler, event, data):
+    # Мерзімі өткен token-дерді handler іске қосылмай тұрып тазалау (хабарлама, батырма, inline сұрау)
+    user = data.get("event_from_user")
+    if user is not None:
+        await refresh_session(user.id)
+    return await handler(event, data)
+
+# update_scheduler-ден кейін тіркеледі: сессия пайдаланушының кезегінде, ретімен тексеріледі
+dp.update.outer_middleware(user_session_middleware)
 
 @router.message(Command("start"))
 async def send_welcome(message: types.Message):
     await message.reply("Сәлем! Жүйеге кіру үшін, логин мен парольді бос орын арқылы енгізіңіз\nМысалы: `username password`", parse_mode='Markdown')
-    user_login_state[message.from_user.id] = {"is_logged_in": False, "waiting_for_login": True}
+    await user_login_state.areset(message.from_user.id, is_logged_in=False, waiting_for_login=True)
 
-logging.basicConfig(level=logging.INFO)
 
 async def show_available_commands(message: types.Message, role='user'):
     """Сәтті кіргеннен кейін рөлге байланысты қолжетімді командаларды жіберу"""
@@ -153,14 +590,20 @@ async def show_available_commands(message: types.Message, role='user'):
 ℹ️ **Ортақ командалар:**
 /help - Осы хабарламаны көрсету
 /logout - Жүйеден шығу
+Кез келген чатта @<бот атауы> <сөз> - тауарларды inline режимінде жылдам іздеу
 """
     
     user_commands = """
 👤 **Пайдаланушыларға арналған командалар:**
 /item_info <id> - Тауар туралы ақпаратты көрсету
 /list_items - Барлық тауарлар тізімін көрсету
+/search <сөз> - Тауарларды атауы, сипаттамасы және категориясы бойынша іздеу
 /list_categories - Категориялар тізімі
 /buy_item <id> [саны] - Тауар сатып алу
+/cart_add <id> [саны] - Тауарды себетке қосу
+/cart - Себетті көрсету
+/cart_clear - Себетті тазалау
+/checkout - Себеттегі барлық тауарларды бір тапсырыспен сатып алу
 /my_orders - Менің тапсырыстарым (сатып алу тарихы)
 """
 
@@ -168,9 +611,12 @@ async def show_available_commands(message: types.Message, role='user'):
 🛍️ **Администраторға арналған командалар:**
 /item_info <id> - Тауар туралы ақпаратты көрсету
 /list_items - Барлық тауарлар тізімін көрсету
+/search <сөз> - Тауарларды іздеу
 /create_item - Жаңа тауар құру
 /update_item <id> - Тауарды жаңарту
 /delete_item <id> - Тауарды жою
+/set_image <id> - Тауардың суретін жүктеу
+/import_items - Тауарларды CSV/JSONL файлынан жаппай жүктеу
 /create_category - Категория құру
 /list_categories - Категориялар тізімі
 /list_orders - Барлық тапсырыстар (админ бәрін көреді)
@@ -207,7 +653,7 @@ async def show_available_commands(message: types.Message, role='user'):
 @router.message(F.text & ~F.text.startswith('/'))
 async def handle_all_messages(message: types.Message):
     user_id = message.from_user.id
-    state = user_login_state.get(user_id, {})
+    state = await user_login_state.aget(user_id)
 
     # Алдымен тауар құру/жаңартуды өңдеу
     if state.get("creating_item"):
@@ -245,18 +691,20 @@ async def handle_all_messages(message: types.Message):
                 response, status_code = await api_client.login(username, password)
                 
                 if status_code == 200 and response.get('success'):
-                    # ✅ МАҢЫЗДЫ: Token-ді api_client-те сақтау
-                    api_client.token = response.get('token')
+                    # ✅ МАҢЫЗДЫ: Token-ді осы пайдаланушының сессиясында сақтау
+                    api_sessions.set(user_id, response.get('token'))
                     
-                    # Сәтті кіру
+                    # Сәтті кіру; token басқа процестер мен қайта іске қосу үшін state-те де сақталады
                     user_data = response['user']
-                    user_login_state[user_id] = {
-                        "is_logged_in": True,
-                        "username": username,
-                        "user_id": user_data['id'],
-                        "role": user_data['role'],
-                        "waiting_for_login": False
-                    }
+                    await user_login_state.areset(
+                        user_id,
+                        is_logged_in=True,
+                        token=response.get('token'),
+                        username=username,
+                        user_id=user_data['id'],
+                        role=user_data['role'],
+                        waiting_for_login=False
+                    )
                     
                     await message.reply(f"✅ Қош келдіңіз, {username}! Сіз жүйеге {user_data['role']} ретінде сәтті кірдіңіз.")
                     await show_available_commands(message, user_data['role'])
@@ -267,7 +715,7 @@ async def handle_all_messages(message: types.Message):
                     return
                     
             except Exception as e:
-                logging.error(f"Кіру қатесі: {e}")
+                logging.error("Кіру қатесі: %s", e)
                 await message.reply("❌ Серверге қосылу кезінде қате пайда болды. Django серверінің жұмыс істеп тұрғанын тексеріңіз.")
                 return
         else:
@@ -285,7 +733,7 @@ async def handle_all_messages(message: types.Message):
 @router.message(Command("create_user"))
 async def create_user_command(message: types.Message):
     user_id = message.from_user.id
-    state = user_login_state.get(user_id, {})
+    state = await user_login_state.aget(user_id)
     
     if not state.get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
@@ -317,7 +765,7 @@ role: user
     await message.reply(instructions)
     
     # Пайдаланушы құру күйін орнату
-    user_login_state[user_id]["creating_user"] = True
+    await user_login_state.aupdate(user_id, creating_user=True)
 
 async def handle_user_creation(message: types.Message):
     user_id = message.from_user.id
@@ -345,7 +793,7 @@ async def handle_user_creation(message: types.Message):
                         user_data['role'] = value.lower()
                     else:
                         await message.reply("❌ Қате: рөл 'user', 'admin' немесе 'superadmin' болуы керек")
-                        user_login_state[user_id]["creating_user"] = False
+                        await user_login_state.aupdate(user_id, creating_user=False)
                         return
         
         # Міндетті өрістерді тексеру
@@ -355,7 +803,7 @@ async def handle_user_creation(message: types.Message):
         
         if missing_fields:
             await message.reply(f"❌ Міндетті өрістер жоқ: {', '.join(missing_fields)}")
-            user_login_state[user_id]["creating_user"] = False
+            await user_login_state.aupdate(user_id, creating_user=False)
             return
         
         # Егер рөл көрсетілмесе, әдепкі рөлді орнату
@@ -363,7 +811,7 @@ async def handle_user_creation(message: types.Message):
             user_data['role'] = 'user'
         
         # API арқылы пайдаланушы құру
-        response, status_code = await api_client.create_user(user_data)
+        response, status_code = await get_api_client(user_id).create_user(user_data)
         
         if status_code == 201:
             await message.reply(f"✅ '{user_data['username']}' пайдаланушысы сәтті құрылды!")
@@ -393,12 +841,39 @@ async def handle_user_creation(message: types.Message):
         await message.reply(f"❌ Күтпеген қате пайда болды: {str(e)}")
     
     # Құру күйін тазалау
-    user_login_state[user_id]["creating_user"] = False
+    await user_login_state.aupdate(user_id, creating_user=False)
+
+async def stream_list(message, pages, title, format_entry, empty_text, error_text):
+    """API беттерін келген сайын бірнеше хабарламамен жіберу.
+
+    Бірінші хабарлама келесі беттер әлі жүктеліп жатқанда-ақ жіберіледі; мәтін 4096
+    таңбалық шектен жол шекарасында бөлінеді. error_text ішінде {status} және {response}.
+    """
+    error = None
+    entries = 0
+    async with ReplyStream(message, max_messages=BOT_LIST_MAX_MESSAGES or None) as stream:
+        async for response, status_code in pages:
+            if status_code != 200:
+                error = error_text.format(status=status_code, response=response)
+                break
+            results = response.get('results', [])
+            if results and not entries:
+                await stream.write(title)
+            entries += len(results)
+            if not await stream.write("".join(format_entry(entry) for entry in results)):
+                break
+
+    if error:
+        await message.reply(error)
+    elif not entries:
+        await message.reply(empty_text)
+    elif stream.truncated:
+        await message.answer(f"⚠️ Тізім тым ұзын: алғашқы {stream.sent} хабарлама ғана көрсетілді.")
 
 @router.message(Command("list_users"))
 async def list_users(message: types.Message):
     user_id = message.from_user.id
-    state = user_login_state.get(user_id, {})
+    state = await user_login_state.aget(user_id)
     
     if not state.get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
@@ -409,16 +884,15 @@ async def list_users(message: types.Message):
         return
     
     try:
-        response, status_code = await api_client.get_users()
-        
-        if status_code == 200 and response:
-            users_list = "\n".join([f"👤 {user['id']}: {user['username']} ({user['email']}) - {user.get('role', 'user')}" 
-                                  for user in response])
-            await message.reply(f"📋 Пайдаланушылар тізімі:\n{users_list}")
-        elif status_code == 200 and not response:
-            await message.reply("ℹ️ Тіркелген пайдаланушылар жоқ.")
-        else:
-            await message.reply(f"❌ Пайдаланушылар тізімін алу кезінде қате: статус {status_code}, жауап: {response}")
+        client = get_api_client(user_id)
+        await stream_list(
+            message,
+            client.iter_pages(client.get_users),
+            "📋 Пайдаланушылар тізімі:",
+            lambda user: f"\n👤 {user['id']}: {user['username']} ({user['email']}) - {user.get('role', 'user')}",
+            "ℹ️ Тіркелген пайдаланушылар жоқ.",
+            "❌ Пайдаланушылар тізімін алу кезінде қате: статус {status}, жауап: {response}",
+        )
             
     except Exception as e:
         await message.reply(f"❌ Қате пайда болды: {e}")
@@ -426,7 +900,7 @@ async def list_users(message: types.Message):
 @router.message(Command("user_info"))
 async def user_info(message: types.Message):
     user_id = message.from_user.id
-    if not user_login_state.get(user_id, {}).get("is_logged_in"):
+    if not (await user_login_state.aget(user_id)).get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
         return
     
@@ -437,7 +911,7 @@ async def user_info(message: types.Message):
             return
         
         user_id_param = parts[1]
-        response, status_code = await api_client.get_user(user_id_param)
+        response, status_code = await get_api_client(user_id).get_user(user_id_param)
         
         if status_code == 200:
             user = response
@@ -463,7 +937,7 @@ async def user_info(message: types.Message):
 @router.message(Command("update_user"))
 async def update_user_command(message: types.Message):
     user_id = message.from_user.id
-    if not user_login_state.get(user_id, {}).get("is_logged_in"):
+    if not (await user_login_state.aget(user_id)).get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
         return
     
@@ -476,7 +950,7 @@ async def update_user_command(message: types.Message):
         user_id_param = parts[1]
         
         # Алдымен пайдаланушының бар екенін тексеру
-        response, status_code = await api_client.get_user(user_id_param)
+        response, status_code = await get_api_client(user_id).get_user(user_id_param)
         if status_code != 200:
             await message.reply(f"❌ {user_id_param} ID пайдаланушысы табылмады.")
             return
@@ -498,19 +972,18 @@ password: newsecurepassword123
 """
         await message.reply(instructions)
         
-        user_login_state[user_id]["updating_user"] = True
-        user_login_state[user_id]["updating_user_id"] = user_id_param
+        await user_login_state.aupdate(user_id, updating_user=True, updating_user_id=user_id_param)
     except Exception as e:
         await message.reply(f"❌ Қате пайда болды: {e}")
 
 async def handle_user_update(message: types.Message):
     user_id = message.from_user.id
     try:
-        user_id_param = user_login_state[user_id].get("updating_user_id")
+        user_id_param = (await user_login_state.aget(user_id)).get("updating_user_id")
         
         if not user_id_param:
             await message.reply("❌ Қате: Пайдаланушы ID табылмады")
-            user_login_state[user_id]["updating_user"] = False
+            await user_login_state.aupdate(user_id, updating_user=False)
             return
         
         data_lines = message.text.strip().split('\n')
@@ -531,10 +1004,10 @@ async def handle_user_update(message: types.Message):
         
         if not user_data:
             await message.reply("❌ Жаңарту үшін деректер көрсетілмеген")
-            user_login_state[user_id]["updating_user"] = False
+            await user_login_state.aupdate(user_id, updating_user=False)
             return
         
-        response, status_code = await api_client.update_user(user_id_param, user_data)
+        response, status_code = await get_api_client(user_id).update_user(user_id_param, user_data)
         
         if status_code == 200:
             updated_fields = []
@@ -560,13 +1033,12 @@ async def handle_user_update(message: types.Message):
     except Exception as e:
         await message.reply(f"❌ Күтпеген қате пайда болды: {str(e)}")
     
-    user_login_state[user_id]["updating_user"] = False
-    user_login_state[user_id]["updating_user_id"] = None
+    await user_login_state.aupdate(user_id, updating_user=False, updating_user_id=None)
 
 @router.message(Command("delete_user"))
 async def delete_user(message: types.Message):
     user_id = message.from_user.id
-    if not user_login_state.get(user_id, {}).get("is_logged_in"):
+    if not (await user_login_state.aget(user_id)).get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
         return
     
@@ -577,7 +1049,7 @@ async def delete_user(message: types.Message):
             return
         
         user_id_param = parts[1]
-        response, status_code = await api_client.delete_user(user_id_param)
+        response, status_code = await get_api_client(user_id).delete_user(user_id_param)
         
         if status_code == 204:
             await message.reply(f"✅ {user_id_param} ID пайдаланушы сәтті жойылды.")
@@ -589,30 +1061,61 @@ async def delete_user(message: types.Message):
     except Exception as e:
         await message.reply(f"❌ Қате пайда болды: {e}")
 
+# Тізімде көрсетілетін өрістер ғана сұралады (сипаттамасыз, жауап әлдеқайда жеңіл)
+ITEM_LIST_FIELDS = "id,name,price,categories,image,image_variants,image_hash"
+
+def format_items_page(items, title="📋 Тауарлар тізімі:"):
+    items_list = []
+    for item in items:
+        # Категориялар туралы ақпаратты қалыптастыру
+        categories_info = ""
+        if item.get('categories'):
+            category_names = [cat['name'] for cat in item['categories']]
+            categories_info = f" | 📁 {', '.join(category_names)}"
+        
+        items_list.append(f"🛍️ {item['id']}: {item['name']} - 💰 {item['price']} ₸{categories_info}")
+    
+    items_text = "\n".join(items_list)
+    return f"{title}\n{items_text}"
+
+def items_page_keyboard(response):
+    buttons = []
+    if response.get('previous'):
+        buttons.append(types.InlineKeyboardButton(text="◀️ Алдыңғы", callback_data="items:prev"))
+    if response.get('next'):
+        buttons.append(types.InlineKeyboardButton(text="Келесі ▶️", callback_data="items:next"))
+    if not buttons:
+        return None
+    return types.InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+async def remember_items_cursors(user_id, response):
+    await user_login_state.aupdate(
+        user_id,
+        items_next_cursor=parse_cursor(response.get('next')),
+        items_prev_cursor=parse_cursor(response.get('previous'))
+    )
+
 @router.message(Command("list_items"))
 async def list_items_command(message: types.Message):
     user_id = message.from_user.id
-    if not user_login_state.get(user_id, {}).get("is_logged_in"):
+    if not (await user_login_state.aget(user_id)).get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
         return
     
     try:
-        response, status_code = await api_client.get_items()
+        # Тек бірінші бетті алу, қалғандары батырмалар арқылы
+        client = get_api_client(user_id)
+        response, status_code = await client.get_items(fields=ITEM_LIST_FIELDS)
         
-        if status_code == 200 and response:
-            items_list = []
-            for item in response:
-                # Категориялар туралы ақпаратты қалыптастыру
-                categories_info = ""
-                if item.get('categories'):
-                    category_names = [cat['name'] for cat in item['categories']]
-                    categories_info = f" | 📁 {', '.join(category_names)}"
-                
-                items_list.append(f"🛍️ {item['id']}: {item['name']} - 💰 {item['price']} ₸{categories_info}")
-            
-            items_text = "\n".join(items_list)
-            await message.reply(f"📋 Тауарлар тізімі:\n{items_text}")
-        elif status_code == 200 and not response:
+        if status_code == 200 and response.get('results'):
+            await remember_items_cursors(user_id, response)
+            await answer_items_photos(message, client, response['results'])
+            # Батырмалар беттің соңғы хабарламасында болады
+            *chunks, last = split_message(format_items_page(response['results']))
+            for chunk in chunks:
+                await message.reply(chunk)
+            await message.reply(last, reply_markup=items_page_keyboard(response))
+        elif status_code == 200:
             await message.reply("ℹ️ Дерекқорда тауарлар жоқ.")
         else:
             await message.reply(f"❌ Тауарлар тізімін алу кезінде қате: статус {status_code}, жауап: {response}")
@@ -620,11 +1123,241 @@ async def list_items_command(message: types.Message):
     except Exception as e:
         await message.reply(f"❌ Қате пайда болды: {e}")
 
+@router.callback_query(F.data.in_({"items:prev", "items:next"}))
+async def list_items_page_callback(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    state = await user_login_state.aget(user_id)
+    
+    if not state.get("is_logged_in"):
+        await callback.answer("❌ Алдымен /start арқылы жүйеге кіріңіз", show_alert=True)
+        return
+    
+    if callback.data == "items:next":
+        cursor = state.get("items_next_cursor")
+    else:
+        cursor = state.get("items_prev_cursor")
+    
+    if not cursor:
+        await callback.answer("ℹ️ Басқа бет жоқ.")
+        return
+    
+    try:
+        client = get_api_client(user_id)
+        response, status_code = await client.get_items(cursor=cursor, fields=ITEM_LIST_FIELDS)
+        
+        if status_code == 200 and response.get('results'):
+            await remember_items_cursors(user_id, response)
+            first, *chunks = split_message(format_items_page(response['results']))
+            keyboard = items_page_keyboard(response)
+            await callback.message.edit_text(first, reply_markup=None if chunks else keyboard)
+            await answer_items_photos(callback.message, client, response['results'])
+            for index, chunk in enumerate(chunks, 1):
+                await callback.message.answer(chunk, reply_markup=keyboard if index == len(chunks) else None)
+            await callback.answer()
+        elif status_code == 200:
+            await callback.answer("ℹ️ Басқа бет жоқ.")
+        else:
+            await callback.answer(f"❌ Тауарлар тізімін алу кезінде қате: статус {status_code}", show_alert=True)
+            
+    except Exception as e:
+        await callback.answer(f"❌ Қате пайда болды: {e}", show_alert=True)
+
+
+def search_page_text(query, response):
+    title = f"🔎 '{query}' бойынша табылды: {response.get('count', 0)}"
+    return format_items_page(response['results'], title=title)
+
+def search_page_keyboard(response):
+    buttons = []
+    if response.get('previous'):
+        buttons.append(types.InlineKeyboardButton(text="◀️ Алдыңғы", callback_data="search:prev"))
+    if response.get('next'):
+        buttons.append(types.InlineKeyboardButton(text="Келесі ▶️", callback_data="search:next"))
+    if not buttons:
+        return None
+    return types.InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+async def remember_search_offsets(user_id, query, response):
+    await user_login_state.aupdate(
+        user_id,
+        search_query=query,
+        search_next_offset=parse_offset(response.get('next')),
+        search_prev_offset=parse_offset(response.get('previous'))
+    )
+
+@router.message(Command("search"))
+async def search_command(message: types.Message):
+    user_id = message.from_user.id
+    if not (await user_login_state.aget(user_id)).get("is_logged_in"):
+        await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
+        return
+    
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].strip():
+        await message.reply("❌ Іздеу сөзін енгізіңіз: /search <сөз>\nМысалы: /search телефон")
+        return
+    query = parts[1].strip()
+    
+    try:
+        client = get_api_client(user_id)
+        response, status_code = await client.search_items(query)
+        
+        if status_code == 200 and response.get('results'):
+            await remember_search_offsets(user_id, query, response)
+            await answer_items_photos(message, client, response['results'])
+            await message.reply(search_page_text(query, response), reply_markup=search_page_keyboard(response))
+        elif status_code == 200:
+            await message.reply(f"ℹ️ '{query}' бойынша ештеңе табылмады.")
+        else:
+            await message.reply(f"❌ Іздеу кезінде қате: статус {status_code}, жауап: {response}")
+            
+    except Exception as e:
+        await message.reply(f"❌ Қате пайда болды: {e}")
+
+@router.callback_query(F.data.in_({"search:prev", "search:next"}))
+async def search_page_callback(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    state = await user_login_state.aget(user_id)
+    
+    if not state.get("is_logged_in"):
+        await callback.answer("❌ Алдымен /start арқылы жүйеге кіріңіз", show_alert=True)
+        return
+    
+    query = state.get("search_query")
+    if callback.data == "search:next":
+        offset = state.get("search_next_offset")
+    else:
+        offset = state.get("search_prev_offset")
+    
+    if not query or offset is None:
+        await callback.answer("ℹ️ Басқа бет жоқ.")
+        return
+    
+    try:
+        client = get_api_client(user_id)
+        response, status_code = await client.search_items(query, offset=offset)
+        
+        if status_code == 200 and response.get('results'):
+            await remember_search_offsets(user_id, query, response)
+            await callback.message.edit_text(search_page_text(query, response), reply_markup=search_page_keyboard(response))
+            await answer_items_photos(callback.message, client, response['results'])
+            await callback.answer()
+        elif status_code == 200:
+            await callback.answer("ℹ️ Басқа бет жоқ.")
+        else:
+            await callback.answer(f"❌ Іздеу кезінде қате: статус {status_code}", show_alert=True)
+            
+    except Exception as e:
+        await callback.answer(f"❌ Қате пайда болды: {e}", show_alert=True)
+
+
+def item_photo(item):
+    """Telegram-ға жіберілетін нұсқа мен сілтеме: 1024 px WebP, ол әлі дайын болмаса - түпнұсқа"""
+    variants = item.get('image_variants') or {}
+    if variants.get('large'):
+        return 'large', variants['large']
+    if item.get('image'):
+        return 'original', item['image']
+    return None, None
+
+def cached_item_photo_id(item):
+    """Бұрын жіберілген сурет болса, оның file_id-і"""
+    variant, _ = item_photo(item)
+    if variant is None or not item.get('image_hash'):
+        return None
+    return telegram_files.get(item['image_hash'], variant)
+
+def item_photo_filename(item, variant, url):
+    extension = 'webp' if variant != 'original' else url.rsplit('.', 1)[-1]
+    return f"item-{item['id']}.{extension}"
+
+async def remember_item_photo(item, sent):
+    """Жүктелген суреттің file_id-ін сақтау; хэш болмаса (нұсқалар әлі дайындалуда) сақталмайды"""
+    variant, _ = item_photo(item)
+    if item.get('image_hash') and sent.photo:
+        await telegram_files.aset(item['image_hash'], variant, sent.photo[-1].file_id, item_id=item['id'])
+
+async def fetch_item_photo(client, item):
+    """Тауар суретін API-ден алу; алынбаса None"""
+    variant, url = item_photo(item)
+    data, status_code = await client.get_media(url)
+    if status_code != 200:
+        logging.warning("%s тауар суретін алу мүмкін болмады: статус %s", item.get('id'), status_code)
+        return None
+    return types.BufferedInputFile(data, filename=item_photo_filename(item, variant, url))
+
+async def answer_item_photo(message: types.Message, client, item, caption=None):
+    """Тауар суретін file_id арқылы жіберу; алғаш рет қана файлды жүктеп, file_id-ді сақтау"""
+    variant, url = item_photo(item)
+    if url is None:
+        return None
+
+    file_id = cached_item_photo_id(item)
+    if file_id is not None:
+        try:
+            sent = await message.answer_photo(file_id, caption=caption)
+            item_photo_sends.labels('cache').inc()
+            return sent
+        except TelegramBadRequest:
+            # Telegram file_id-ді қабылдамаса, суретті қайта жүктеу
+            await telegram_files.aforget(item['image_hash'], variant)
+
+    photo = await fetch_item_photo(client, item)
+    if photo is None:
+        return None
+    sent = await message.answer_photo(photo, caption=caption)
+    item_photo_sends.labels('upload').inc()
+    await remember_item_photo(item, sent)
+    return sent
+
+# Telegram альбомындағы суреттердің ең көп саны
+MEDIA_GROUP_LIMIT = 10
+
+def item_photo_caption(item):
+    return f"🛍️ {item['id']}: {item.get('name', '')}"
+
+async def answer_items_photos(message: types.Message, client, items):
+    """Тізім бетіндегі тауарлардың суреттерін бір альбоммен жіберу; сақталған file_id-лер қайта жүктелмейді"""
+    items = [item for item in items if item_photo(item)[1] is not None][:MEDIA_GROUP_LIMIT]
+    if len(items) == 1:
+        await answer_item_photo(message, client, items[0], caption=item_photo_caption(items[0]))
+        return
+
+    media, media_items = [], []
+    for item in items:
+        photo = cached_item_photo_id(item) or await fetch_item_photo(client, item)
+        if photo is not None:
+            media.append(types.InputMediaPhoto(media=photo, caption=item_photo_caption(item)))
+            media_items.append(item)
+    if not media:
+        return
+
+    try:
+        if len(media) > 1:
+            sent = await message.answer_media_group(media)
+        else:
+            # Альбомға кемі екі сурет керек
+            sent = [await message.answer_photo(media[0].media, caption=media[0].caption)]
+    except TelegramBadRequest:
+        # Сақталған file_id-лердің бірін Telegram қабылдамады: оларды ұмытып, суреттерді жеке жіберу
+        for item, entry in zip(media_items, media):
+            if isinstance(entry.media, str):
+                await telegram_files.aforget(item['image_hash'], item_photo(item)[0])
+        for item in media_items:
+            await answer_item_photo(message, client, item, caption=item_photo_caption(item))
+        return
+
+    for item, entry, photo_message in zip(media_items, media, sent):
+        if isinstance(entry.media, str):
+            item_photo_sends.labels('cache').inc()
+        else:
+            item_photo_sends.labels('upload').inc()
+            await remember_item_photo(item, photo_message)
 
 @router.message(Command("item_info"))
 async def item_info_command(message: types.Message):
     user_id = message.from_user.id
-    if not user_login_state.get(user_id, {}).get("is_logged_in"):
+    if not (await user_login_state.aget(user_id)).get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
         return
     
@@ -635,10 +1368,12 @@ async def item_info_command(message: types.Message):
             return
         
         item_id = parts[1]
-        response, status_code = await api_client.get_item(item_id)
+        client = get_api_client(user_id)
+        response, status_code = await client.get_item(item_id)
         
         if status_code == 200:
             item = response
+            await answer_item_photo(message, client, item, caption=f"🛍️ {item.get('name', '')}")
             item_info_lines = [
                 "🛍️ Тауар туралы ақпарат:",
                 f"🆔 ID: {item.get('id', 'N/A')}",
@@ -646,7 +1381,8 @@ async def item_info_command(message: types.Message):
                 f"🔗 Slug: {item.get('slug', 'N/A')}",
                 f"📋 Сипаттамасы: {item.get('description', 'Көрсетілмеген')}",
                 f"💰 Бағасы: {item.get('price', 0)} ₸",
-                f"✅ Қолжетімді: {'Иә' if item.get('available', True) else 'Жоқ'}"
+                f"✅ Қолжетімді: {'Иә' if item.get('available', True) else 'Жоқ'}",
+                f"📦 Қоймада: {item['stock'] if item.get('stock') is not None else 'Шектелмеген'}"
             ]
             
             # Категориялар туралы ақпаратты қосу
@@ -669,7 +1405,7 @@ async def item_info_command(message: types.Message):
 @router.message(Command("create_item"))
 async def create_item_command(message: types.Message):
     user_id = message.from_user.id
-    if not user_login_state.get(user_id, {}).get("is_logged_in"):
+    if not (await user_login_state.aget(user_id)).get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
         return
     
@@ -683,6 +1419,7 @@ slug: бірегей-слаг
 description: Тауар сипаттамасы
 price: 99.99
 available: true
+stock: 10
 category_ids: 1,2,3
 
 **Мысалы:**
@@ -702,7 +1439,7 @@ category_ids: 1,2,3
 """
         await message.reply(instructions)
         
-        user_login_state[user_id]["creating_item"] = True
+        await user_login_state.aupdate(user_id, creating_item=True)
     except Exception as e:
         await message.reply(f"❌ Қате пайда болды: {e}")
 
@@ -736,21 +1473,25 @@ async def handle_item_creation(message: types.Message):
                         return
                 elif key == 'available':
                     item_data['available'] = value.lower() in ['true', 'yes', 'иә', '1', 'on']
+                elif key == 'stock':
+                    if not value.isdigit():
+                        await message.reply("❌ Қате: қойма саны теріс емес бүтін сан болуы керек (мысалы: 10)")
+                        return
+                    item_data['stock'] = int(value)
                 elif key == 'category_ids':
                     try:
                         # Категориялардың бар екенін тексеру
-                        categories_response, status = await api_client.get_categories()
+                        existing_categories, status = await category_cache.get(get_api_client(user_id))
                         if status != 200:
                             await message.reply("❌ Қате: категориялар тізімін алу мүмкін болмады")
                             return
                         
-                        existing_categories = [str(cat['id']) for cat in categories_response]
                         category_ids = [cat_id.strip() for cat_id in value.split(',')]
                         
                         # Әрбір категорияны тексеру
                         invalid_categories = []
                         for cat_id in category_ids:
-                            if cat_id not in existing_categories:
+                            if not cat_id.isdigit() or int(cat_id) not in existing_categories:
                                 invalid_categories.append(cat_id)
                         
                         if invalid_categories:
@@ -769,7 +1510,7 @@ async def handle_item_creation(message: types.Message):
                 await message.reply(f"❌ Міндетті '{field}' өрісі жоқ")
                 return
         
-        response, status_code = await api_client.create_item(item_data)
+        response, status_code = await get_api_client(user_id).create_item(item_data)
         
         if status_code == 201:
             await message.reply("✅ Тауар сәтті құрылды! 🎉")
@@ -793,34 +1534,77 @@ async def handle_item_creation(message: types.Message):
     except Exception as e:
         await message.reply(f"❌ Күтпеген қате пайда болды: {str(e)}")
     
-    user_login_state[user_id]["creating_item"] = False
+    await user_login_state.aupdate(user_id, creating_item=False)
 
 
-@router.message(lambda message: message.photo and user_login_state.get(message.from_user.id, {}).get("waiting_for_image", False))
-async def handle_image(message: types.Message):
+@router.message(Command("set_image"))
+async def set_image_command(message: types.Message):
     user_id = message.from_user.id
-    try:
-        file_id = message.photo[-1].file_id
-        file_info = await bot.get_file(file_id)
-        file_path = file_info.file_path
+    state = await user_login_state.aget(user_id)
 
-        file = await bot.download_file(file_path)
+    if not state.get("is_logged_in"):
+        await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
+        return
 
-        import uuid
-        file_name = f"{uuid.uuid4().hex}.jpg"
-        file_path_on_server = os.path.join("items", file_name)
-    
-        os.makedirs(os.path.dirname(file_path_on_server), exist_ok=True)
+    if state.get('role') not in ['admin', 'superadmin']:
+        await message.reply("❌ Тауар суретін өзгерту құқығыңыз жоқ. admin рөлі қажет.")
+        return
+
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await message.reply("ℹ️ Қолданылуы: /set_image <тауар_id>")
+        return
 
-        with open(file_path_on_server, 'wb') as f:
-            f.write(file.getvalue())
+    await user_login_state.aupdate(user_id, waiting_for_image=True, image_item_id=parts[1])
+    await message.reply(f"🖼️ {parts[1]} ID тауардың суретін фото немесе құжат (JPEG, PNG, WebP) ретінде жіберіңіз.")
+
+
+def is_image_message(message: types.Message):
+    if message.photo:
+        return True
+    return bool(message.document and (message.document.mime_type or '').startswith('image/'))
+
+
+def state_flag(name):
+    """State-тегі белгі бойынша фильтр; async, себебі state сақтау орны I/O жасауы мүмкін"""
+    async def check(message: types.Message):
+        return (await user_login_state.aget(message.from_user.id)).get(name, False)
+    return check
+
+
+@router.message(is_image_message, state_flag("waiting_for_image"))
+async def handle_image(message: types.Message):
+    user_id = message.from_user.id
+    item_id = (await user_login_state.aget(user_id)).get("image_item_id")
+    await user_login_state.aupdate(user_id, waiting_for_image=False, image_item_id=None)
+    try:
+        if message.photo:
+            # Ең үлкен өлшемдегі нұсқа
+            file_id = message.photo[-1].file_id
+            filename = "photo.jpg"
+        else:
+            file_id = message.document.file_id
+            filename = message.document.file_name or "image"
+        file_info = await bot.get_file(file_id)
+        file_url = bot.session.api.file_url(bot.token, file_info.file_path)
 
-        user_login_state[user_id]["waiting_for_image"] = False
-        user_login_state[user_id]["waiting_for_text"] = True 
-        user_login_state[user_id]["image_path"] = file_path_on_server
-        print(user_login_state)
+        # Сурет жадқа толық жүктелмейді: Telegram-нан келген бөліктер бірден API-ге жіберіледі
+        session = await api_client.get_session()
+        async with session.get(file_url) as telegram_response:
+            if telegram_response.status != 200:
+                await message.reply(f"❌ Telegram-нан суретті алу мүмкін болмады: статус {telegram_response.status}")
+                return
+            chunks = telegram_response.content.iter_chunked(64 * 1024)
+            response, status_code = await get_api_client(user_id).upload_item_image(item_id, chunks, filename)
 
-        await message.reply(f"Сурет қабылданды және {file_name} ретінде сақталды. Енді тауар деректерін жіберіңіз.")
+        if status_code == 200:
+            # Ескі суреттің file_id-лері енді қажет емес
+            await telegram_files.aforget_item(int(item_id))
+            await message.reply(f"✅ {item_id} ID тауардың суреті сақталды.")
+        elif status_code == 404:
+            await message.reply(f"❌ {item_id} ID тауар табылмады.")
+        else:
+            await message.reply(f"❌ Суретті сақтау кезінде қате: статус {status_code}, жауап: {response}")
 
     except Exception as e:
         await message.reply(f"❌ Суретті өңдеу кезінде қате пайда болды: {e}")
@@ -829,7 +1613,7 @@ async def handle_image(message: types.Message):
 @router.message(Command("update_item"))
 async def update_item_command(message: types.Message):
     user_id = message.from_user.id
-    if not user_login_state.get(user_id, {}).get("is_logged_in"):
+    if not (await user_login_state.aget(user_id)).get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
         return
     
@@ -842,15 +1626,15 @@ async def update_item_command(message: types.Message):
         item_id = parts[1]
         
         # Тауардың бар екенін тексеру
-        response, status_code = await api_client.get_item(item_id)
+        response, status_code = await get_api_client(user_id).get_item(item_id)
         if status_code != 200:
             await message.reply(f"❌ {item_id} ID тауар табылмады.")
             return
 
         # Анықтама үшін категориялар тізімін алу
-        categories_response, status = await api_client.get_categories()
+        categories, status = await category_cache.get(get_api_client(user_id))
         if status == 200:
-            categories_info = "\n".join([f"  - {cat['id']}: {cat['name']}" for cat in categories_response])
+            categories_info = "\n".join([f"  - {cat['id']}: {cat['name']}" for cat in categories.values()])
             categories_text = f"\n📋 **Бар категориялар:**\n{categories_info}"
         else:
             categories_text = ""
@@ -864,6 +1648,7 @@ slug: слаг
 description: Сипаттамасы
 price: 149.99
 available: false
+stock: 25
 category_ids: 1,2,3
 {categories_text}
 
@@ -872,8 +1657,7 @@ category_ids: 1,2,3
 """
         await message.reply(instructions)
         
-        user_login_state[user_id]["updating_item"] = True
-        user_login_state[user_id]["updating_item_id"] = item_id
+        await user_login_state.aupdate(user_id, updating_item=True, updating_item_id=item_id)
         
     except Exception as e:
         await message.reply(f"❌ Қате пайда болды: {e}")
@@ -883,11 +1667,11 @@ category_ids: 1,2,3
 async def handle_item_update(message: types.Message):
     user_id = message.from_user.id
     try:
-        item_id = user_login_state[user_id].get("updating_item_id")
+        item_id = (await user_login_state.aget(user_id)).get("updating_item_id")
         
         if not item_id:
             await message.reply("❌ Қате: Тауар ID табылмады")
-            user_login_state[user_id]["updating_item"] = False
+            await user_login_state.aupdate(user_id, updating_item=False)
             return
         
         data_lines = message.text.strip().split('\n')
@@ -917,21 +1701,25 @@ async def handle_item_update(message: types.Message):
                         return
                 elif key == 'available':
                     item_data['available'] = value.lower() in ['true', 'yes', 'иә', '1', 'on']
+                elif key == 'stock':
+                    if not value.isdigit():
+                        await message.reply("❌ Қате: қойма саны теріс емес бүтін сан болуы керек (мысалы: 10)")
+                        return
+                    item_data['stock'] = int(value)
                 elif key == 'category_ids':
                     try:
                         # Категориялардың бар екенін тексеру
-                        categories_response, status = await api_client.get_categories()
+                        existing_categories, status = await category_cache.get(get_api_client(user_id))
                         if status != 200:
                             await message.reply("❌ Қате: категориялар тізімін алу мүмкін болмады")
                             return
                         
-                        existing_categories = [str(cat['id']) for cat in categories_response]
                         category_ids = [cat_id.strip() for cat_id in value.split(',')]
                         
                         # Әрбір категорияны тексеру
                         invalid_categories = []
                         for cat_id in category_ids:
-                            if cat_id not in existing_categories:
+                            if not cat_id.isdigit() or int(cat_id) not in existing_categories:
                                 invalid_categories.append(cat_id)
                         
                         if invalid_categories:
@@ -945,10 +1733,10 @@ async def handle_item_update(message: types.Message):
                         
         if not item_data:
             await message.reply("❌ Жаңарту үшін деректер көрсетілмеген")
-            user_login_state[user_id]["updating_item"] = False
+            await user_login_state.aupdate(user_id, updating_item=False)
             return
         
-        response, status_code = await api_client.update_item(item_id, item_data)
+        response, status_code = await get_api_client(user_id).update_item(item_id, item_data)
         
         if status_code == 200:
             await message.reply(f"✅ {item_id} ID тауар сәтті жаңартылды! 🎉")
@@ -972,13 +1760,12 @@ async def handle_item_update(message: types.Message):
     except Exception as e:
         await message.reply(f"❌ Күтпеген қате пайда болды: {str(e)}")
     
-    user_login_state[user_id]["updating_item"] = False
-    user_login_state[user_id]["updating_item_id"] = None
+    await user_login_state.aupdate(user_id, updating_item=False, updating_item_id=None)
 
 @router.message(Command("delete_item"))
 async def delete_item_command(message: types.Message):
     user_id = message.from_user.id
-    if not user_login_state.get(user_id, {}).get("is_logged_in"):
+    if not (await user_login_state.aget(user_id)).get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
         return
     
@@ -989,7 +1776,7 @@ async def delete_item_command(message: types.Message):
             return
         
         item_id = parts[1]
-        response, status_code = await api_client.delete_item(item_id)
+        response, status_code = await get_api_client(user_id).delete_item(item_id)
         
         if status_code == 204:
             await message.reply(f"✅ {item_id} ID тауар сәтті жойылды.")
@@ -1001,11 +1788,96 @@ async def delete_item_command(message: types.Message):
     except Exception as e:
         await message.reply(f"❌ Қате пайда болды: {e}")
 
+# Прогресс хабарламасын жаңарту аралығы (байт)
+IMPORT_PROGRESS_STEP = 1024 * 1024
+
+@router.message(Command("import_items"))
+async def import_items_command(message: types.Message):
+    user_id = message.from_user.id
+    state = await user_login_state.aget(user_id)
+    
+    if not state.get("is_logged_in"):
+        await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
+        return
+    
+    if state.get('role') not in ['admin', 'superadmin']:
+        await message.reply("❌ Тауарларды жүктеу құқығыңыз жоқ. admin рөлі қажет.")
+        return
+    
+    instructions = """
+📥 **Тауарларды жаппай жүктеу**
+
+CSV немесе JSONL файлын құжат ретінде жіберіңіз.
+
+**CSV мысалы:**
+name,slug,description,price,available,category_ids
+iPhone 15,iphone-15,Жаңа iPhone,799.99,true,1;2
+
+**JSONL мысалы (әр жолда бір тауар):**
+{"name": "iPhone 15", "slug": "iphone-15", "price": "799.99", "category_ids": [1, 2]}
+
+*`name`, `slug` және `price` өрістері міндетті!*
+*Telegram файл өлшемін 20 МБ-қа дейін шектейді.*
+"""
+    await message.reply(instructions)
+    
+    await user_login_state.aupdate(user_id, importing_items=True)
+
+@router.message(F.document, state_flag("importing_items"))
+async def handle_import_file(message: types.Message):
+    user_id = message.from_user.id
+    await user_login_state.aupdate(user_id, importing_items=False)
+    document = message.document
+    
+    try:
+        progress = await message.reply(f"⏳ '{document.file_name}' файлы жүктелуде...")
+        file_info = await bot.get_file(document.file_id)
+        file_url = bot.session.api.file_url(bot.token, file_info.file_path)
+        
+        session = await api_client.get_session()
+        async with session.get(file_url) as telegram_response:
+            if telegram_response.status != 200:
+                await message.reply(f"❌ Telegram-нан файлды алу мүмкін болмады: статус {telegram_response.status}")
+                return
+            
+            async def stream_chunks():
+                # Telegram-нан келген бөліктерді бірден API-ге жіберу
+                sent = 0
+                reported = 0
+                async for chunk in telegram_response.content.iter_chunked(64 * 1024):
+                    sent += len(chunk)
+                    if sent - reported >= IMPORT_PROGRESS_STEP:
+                        reported = sent
+                        await progress.edit_text(f"⏳ Жіберілді: {sent // 1024} КБ...")
+                    yield chunk
+                await progress.edit_text(f"⚙️ Файл жіберілді ({sent // 1024} КБ), API тауарларды өңдеуде...")
+            
+            response, status_code = await get_api_client(user_id).import_items(stream_chunks(), document.file_name)
+        
+        if status_code == 200:
+            report_lines = [
+                "✅ Жүктеу аяқталды!",
+                f"📦 Құрылған тауарлар: {response.get('created', 0)}",
+                f"❌ Қате жолдар: {response.get('failed', 0)}"
+            ]
+            errors = response.get('errors', [])
+            if errors:
+                report_lines.append("")
+                report_lines.append("🔎 Алғашқы қателер:")
+                for error in errors[:20]:
+                    report_lines.append(f"• {error['row']}-жол: {error['errors']}")
+            await message.reply("\n".join(report_lines))
+        else:
+            await message.reply(f"❌ Жүктеу кезінде қате: статус {status_code}, жауап: {response}")
+    
+    except Exception as e:
+        await message.reply(f"❌ Файлды өңдеу кезінде қате пайда болды: {e}")
+
 # ========== ТАПСЫРЫС КОМАНДАЛАРЫ ==========
 @router.message(Command("buy_item"))
 async def buy_item_command(message: types.Message):
     user_id = message.from_user.id
-    state = user_login_state.get(user_id, {})
+    state = await user_login_state.aget(user_id)
     
     if not state.get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
@@ -1026,7 +1898,7 @@ async def buy_item_command(message: types.Message):
             "quantity": quantity
         }
         
-        response, status_code = await api_client.create_order(order_data)
+        response, status_code = await get_api_client(user_id).create_order(order_data)
         
         if status_code == 201:
             await message.reply(f"✅ Сатып алу сәтті ресімделді! 🎉")
@@ -1044,42 +1916,153 @@ async def buy_item_command(message: types.Message):
             await message.reply(order_info)
         elif status_code == 404:
             await message.reply("❌ Тауар табылмады.")
+        elif status_code == 409 and response.get('error') == "Item is not available":
+            await message.reply("❌ Тауар қазір сатылымда жоқ.")
+        elif status_code == 409:
+            await message.reply("❌ Қоймада тауар жеткіліксіз.")
         else:
             await message.reply(f"❌ Сатып алу кезінде қате: {response}")
             
     except Exception as e:
         await message.reply(f"❌ Қате пайда болды: {str(e)}")
 
-@router.message(Command("my_orders"))
-async def my_orders_command(message: types.Message):
+# Тапсырыстар тізімінде көрсетілетін өрістер және бет өлшемі (API шегі - 100)
+ORDER_LIST_FIELDS = "id,user,item_name,lines,total_price,quantity,created_at,status"
+ORDER_PAGE_SIZE = 100
+
+def order_items_text(order):
+    """Бір тауарлы және себет тапсырыстарының тауарларын көрсету"""
+    if order.get('lines'):
+        return ", ".join(f"{line.get('item_name')} × {line.get('quantity')}" for line in order['lines'])
+    return order.get('item_name') or 'N/A'
+
+# ========== СЕБЕТ КОМАНДАЛАРЫ ==========
+# Себет бот жағында сақталады; API-ге тек /checkout кезінде бір сұраныс жіберіледі
+@router.message(Command("cart_add"))
+async def cart_add_command(message: types.Message):
+    user_id = message.from_user.id
+    state = await user_login_state.aget(user_id)
+    
+    if not state.get("is_logged_in"):
+        await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
+        return
+    
+    parts = message.text.split()
+    if len(parts) < 2 or not parts[1].isdigit() or (len(parts) > 2 and not parts[2].isdigit()):
+        await message.reply("ℹ️ Қолданылуы: /cart_add <тауар_id> [саны]\nМысалы: /cart_add 1 2")
+        return
+    
+    item_id = parts[1]
+    quantity = int(parts[2]) if len(parts) > 2 else 1
+    if quantity < 1:
+        await message.reply("❌ Саны 1-ден кем болмауы керек.")
+        return
+    
+    cart = dict(state.get('cart', {}))
+    cart[item_id] = cart.get(item_id, 0) + quantity
+    await user_login_state.aupdate(user_id, cart=cart)
+    
+    await message.reply(f"🛒 {item_id} ID тауар себетке қосылды (саны: {cart[item_id]}). Себетте {len(cart)} тауар.\nСатып алу үшін /checkout қолданыңыз.")
+
+@router.message(Command("cart"))
+async def cart_command(message: types.Message):
+    user_id = message.from_user.id
+    state = await user_login_state.aget(user_id)
+    
+    if not state.get("is_logged_in"):
+        await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
+        return
+    
+    cart = state.get('cart', {})
+    if not cart:
+        await message.reply("ℹ️ Себет бос. Тауар қосу үшін /cart_add <тауар_id> [саны] қолданыңыз.")
+        return
+    
+    cart_lines = [f"📦 Тауар ID {item_id}: {quantity} дана" for item_id, quantity in cart.items()]
+    await message.reply("🛒 Сіздің себетіңіз:\n" + "\n".join(cart_lines) + "\n\nСатып алу: /checkout\nТазалау: /cart_clear")
+
+@router.message(Command("cart_clear"))
+async def cart_clear_command(message: types.Message):
+    user_id = message.from_user.id
+    if not (await user_login_state.aget(user_id)).get("is_logged_in"):
+        await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
+        return
+    
+    await user_login_state.aupdate(user_id, cart=None)
+    await message.reply("🗑️ Себет тазаланды.")
+
+@router.message(Command("checkout"))
+async def checkout_command(message: types.Message):
     user_id = message.from_user.id
-    state = user_login_state.get(user_id, {})
+    state = await user_login_state.aget(user_id)
     
     if not state.get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
         return
     
+    cart = state.get('cart', {})
+    if not cart:
+        await message.reply("ℹ️ Себет бос. Тауар қосу үшін /cart_add <тауар_id> [саны] қолданыңыз.")
+        return
+    
     try:
-        response, status_code = await api_client.get_orders()
+        lines = [{"item": int(item_id), "quantity": quantity} for item_id, quantity in cart.items()]
+        response, status_code = await get_api_client(user_id).checkout(lines)
         
-        if status_code == 200 and response:
-            orders_text = "📋 **Сіздің тапсырыстарыңыздың тарихы:**\n\n"
+        if status_code == 201:
+            await user_login_state.aupdate(user_id, cart=None)
+            
+            order_lines = [
+                f"• {line.get('item_name')} × {line.get('quantity')} = {line.get('price')} ₸/дана"
+                for line in response.get('lines', [])
+            ]
+            order_info = f"""✅ Сатып алу сәтті ресімделді! 🎉
+
+🧾 **Тапсырыс #{response.get('id')}**
+{chr(10).join(order_lines)}
+💵 Барлығы: {response.get('total_price')} ₸
+📅 Күні: {response.get('created_at', '')[:16]}
+"""
+            await message.reply(order_info)
+        elif status_code == 404:
+            await message.reply(f"❌ Келесі тауарлар табылмады: {response.get('items')}")
+        elif status_code == 409 and response.get('error') == "Item is not available":
+            await message.reply(f"❌ Келесі тауарлар қазір сатылымда жоқ: {response.get('items')}")
+        elif status_code == 409:
+            await message.reply(f"❌ Қоймада жеткіліксіз тауарлар: {response.get('items')}")
+        else:
+            await message.reply(f"❌ Сатып алу кезінде қате: {response}")
             
-            for order in response:
-                orders_text += f"""
+    except Exception as e:
+        await message.reply(f"❌ Қате пайда болды: {str(e)}")
+
+@router.message(Command("my_orders"))
+async def my_orders_command(message: types.Message):
+    user_id = message.from_user.id
+    state = await user_login_state.aget(user_id)
+    
+    if not state.get("is_logged_in"):
+        await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
+        return
+    
+    try:
+        client = get_api_client(user_id)
+        await stream_list(
+            message,
+            client.iter_pages(functools.partial(client.get_orders, page_size=ORDER_PAGE_SIZE, fields=ORDER_LIST_FIELDS)),
+            "📋 **Сіздің тапсырыстарыңыздың тарихы:**\n\n",
+            lambda order: f"""
 🧾 **Тапсырыс #{order['id']}**
-📦 Тауар: {order.get('item_name', 'N/A')}
+📦 Тауар: {order_items_text(order)}
 💰 Бағасы: {order.get('total_price')} ₸
 📊 Саны: {order.get('quantity')}
 📅 Күні: {order.get('created_at', '')[:16]}
 📊 Мәртебесі: {order.get('status', 'N/A')}
 ────────────────────
-"""
-            await message.reply(orders_text)
-        elif status_code == 200 and not response:
-            await message.reply("ℹ️ Сізде әлі тапсырыстар жоқ.")
-        else:
-            await message.reply(f"❌ Тапсырыстарды алу кезінде қате: {response}")
+""",
+            "ℹ️ Сізде әлі тапсырыстар жоқ.",
+            "❌ Тапсырыстарды алу кезінде қате: {response}",
+        )
             
     except Exception as e:
         await message.reply(f"❌ Қате пайда болды: {str(e)}")
@@ -1087,7 +2070,7 @@ async def my_orders_command(message: types.Message):
 @router.message(Command("list_orders"))
 async def list_orders_command(message: types.Message):
     user_id = message.from_user.id
-    state = user_login_state.get(user_id, {})
+    state = await user_login_state.aget(user_id)
     
     if not state.get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
@@ -1099,27 +2082,24 @@ async def list_orders_command(message: types.Message):
         return
     
     try:
-        response, status_code = await api_client.get_orders()
-        
-        if status_code == 200 and response:
-            orders_text = "📋 **Жүйедегі барлық тапсырыстар:**\n\n"
-            
-            for order in response:
-                orders_text += f"""
+        client = get_api_client(user_id)
+        await stream_list(
+            message,
+            client.iter_pages(functools.partial(client.get_orders, page_size=ORDER_PAGE_SIZE, fields=ORDER_LIST_FIELDS)),
+            "📋 **Жүйедегі барлық тапсырыстар:**\n\n",
+            lambda order: f"""
 🧾 **Тапсырыс #{order['id']}**
 👤 Пайдаланушы ID: {order.get('user', 'N/A')}
-📦 Тауар: {order.get('item_name', 'N/A')}
+📦 Тауар: {order_items_text(order)}
 💰 Сомасы: {order.get('total_price')} ₸
 📊 Саны: {order.get('quantity')}
 📅 Күні: {order.get('created_at', '')[:16]}
 📊 Мәртебесі: {order.get('status', 'N/A')}
 ────────────────────
-"""
-            await message.reply(orders_text)
-        elif status_code == 200 and not response:
-            await message.reply("ℹ️ Жүйеде әлі тапсырыстар жоқ.")
-        else:
-            await message.reply(f"❌ Тапсырыстарды алу кезінде қате: {response}")
+""",
+            "ℹ️ Жүйеде әлі тапсырыстар жоқ.",
+            "❌ Тапсырыстарды алу кезінде қате: {response}",
+        )
             
     except Exception as e:
         await message.reply(f"❌ Қате пайда болды: {str(e)}")
@@ -1128,7 +2108,7 @@ async def list_orders_command(message: types.Message):
 @router.message(Command("create_category"))
 async def create_category_command(message: types.Message):
     user_id = message.from_user.id
-    state = user_login_state.get(user_id, {})
+    state = await user_login_state.aget(user_id)
     
     if not state.get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
@@ -1157,7 +2137,7 @@ slug: socks
     await message.reply(instructions)
     
     # Категория құру күйін орнату
-    user_login_state[user_id]["creating_category"] = True
+    await user_login_state.aupdate(user_id, creating_category=True)
 
 async def handle_category_creation(message: types.Message):
     user_id = message.from_user.id
@@ -1182,7 +2162,7 @@ async def handle_category_creation(message: types.Message):
                     slug = value.lower().replace(' ', '-')
                     if not all(c.isalnum() or c == '-' for c in slug):
                         await message.reply("❌ Қате: slug тек латын әріптері, сандар және дефис қамтуы мүмкін!")
-                        user_login_state[user_id]["creating_category"] = False
+                        await user_login_state.aupdate(user_id, creating_category=False)
                         return
                     category_data['slug'] = slug
         
@@ -1192,13 +2172,14 @@ async def handle_category_creation(message: types.Message):
         
         if missing_fields:
             await message.reply(f"❌ Міндетті өрістер жоқ: {', '.join(missing_fields)}")
-            user_login_state[user_id]["creating_category"] = False
+            await user_login_state.aupdate(user_id, creating_category=False)
             return
         
         # API арқылы категория құру
-        response, status_code = await api_client.create_category(category_data)
+        response, status_code = await get_api_client(user_id).create_category(category_data)
         
         if status_code == 201:
+            category_cache.invalidate()
             await message.reply(f"✅ '{category_data['name']}' категориясы сәтті құрылды!")
             
             category_info = f"""
@@ -1215,23 +2196,23 @@ async def handle_category_creation(message: types.Message):
     except Exception as e:
         await message.reply(f"❌ Күтпеген қате пайда болды: {str(e)}")
     
-    user_login_state[user_id]["creating_category"] = False
+    await user_login_state.aupdate(user_id, creating_category=False)
 
 @router.message(Command("list_categories"))
 async def list_categories_command(message: types.Message):
     user_id = message.from_user.id
-    state = user_login_state.get(user_id, {})
+    state = await user_login_state.aget(user_id)
     
     if not state.get("is_logged_in"):
         await message.reply("❌ Алдымен /start арқылы жүйеге кіріңіз")
         return
     
     try:
-        response, status_code = await api_client.get_categories()
+        response, status_code = await category_cache.get(get_api_client(user_id))
         
         if status_code == 200 and response:
             categories_list = "\n".join([f"📁 {cat['id']}: {cat['name']} - {cat.get('title', '')}" 
-                                       for cat in response])
+                                       for cat in response.values()])
             await message.reply(f"📋 Категориялар тізімі:\n{categories_list}")
         elif status_code == 200 and not response:
             await message.reply("ℹ️ Дерекқорда категориялар жоқ.")
@@ -1244,7 +2225,7 @@ async def list_categories_command(message: types.Message):
 @router.message(Command("help"))
 async def send_help_command(message: types.Message):
     user_id = message.from_user.id
-    state = user_login_state.get(user_id, {})
+    state = await user_login_state.aget(user_id)
     
     if state.get("is_logged_in"):
         # ✅ Пайдаланушының рөлін алып, show_available_commands функциясына жіберу
@@ -1256,22 +2237,126 @@ async def send_help_command(message: types.Message):
 @router.message(Command("logout"))
 async def logout_command(message: types.Message):
     user_id = message.from_user.id
-    if user_id in user_login_state:
-        username = user_login_state[user_id].get('username', '')
-        user_login_state[user_id] = {"is_logged_in": False, "waiting_for_login": False}
-        api_client.token = None  # ✅ Token-ді тазалау
+    state = await user_login_state.aget(user_id)
+    if state.get("is_logged_in") or state.get("waiting_for_login"):
+        username = state.get('username', '')
+        await user_login_state.areset(user_id, is_logged_in=False, waiting_for_login=False)
+        client = api_sessions.get(user_id)
+        api_sessions.discard(user_id)  # ✅ Token-ді тазалау
+        if client is not None:
+            try:
+                # Бот token-ді ұмытады; серверде ол тек кэштен шығарылады
+                await client.evict_token()
+            except Exception as e:
+                logging.warning("Шығу кезінде API қатесі: %s", e)
         await message.reply(f"✅ {username}, сіз жүйеден шықтыңыз. Кіру үшін /start қолданыңыз.")
     else:
         await message.reply("ℹ️ Сіз авторизациядан өтпегенсіз.")
 
 
+# ========== INLINE РЕЖИМІ ==========
+# Тауарлар индексі бот жадында сақталады, inline сұраныстарға API-ге бармай жауап беріледі
+INLINE_REFRESH_INTERVAL = float(os.getenv("INLINE_REFRESH_INTERVAL", "60"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))
+
+def item_inline_result(item):
+    """Тауарды inline нәтижесіне айналдыру; суреті бұрын жіберілген болса, file_id арқылы фото ретінде"""
+    text = f"🛍️ {item['name']}\n💰 Бағасы: {item['price']} ₸\n🆔 ID: {item['id']}\n🛒 Сатып алу: /buy_item {item['id']}"
+    file_id = cached_item_photo_id(item)
+    if file_id is not None:
+        return types.InlineQueryResultCachedPhoto(
+            id=str(item['id']),
+            photo_file_id=file_id,
+            title=item['name'],
+            description=f"💰 {item['price']} ₸",
+            caption=text,
+        )
+    return types.InlineQueryResultArticle(
+        id=str(item['id']),
+        title=item['name'],
+        description=f"💰 {item['price']} ₸",
+        input_message_content=types.InputTextMessageContent(message_text=text),
+    )
+
+inline_index = ItemPrefixIndex(
+    render=item_inline_result,
+    fields="id,name,price,image,image_variants,image_hash",
+    refresh_interval=INLINE_REFRESH_INTERVAL,
+)
+
+@router.inline_query()
+async def inline_query_handler(inline_query: types.InlineQuery):
+    # Каталог тек жүйеге кірген пайдаланушыларға көрінеді, сондықтан жауаптар жеке кэштеледі
+    if not (await user_login_state.aget(inline_query.from_user.id)).get("is_logged_in"):
+        await inline_query.answer(
+            [], cache_time=0, is_personal=True,
+            button=types.InlineQueryResultsButton(text="🔐 Жүйеге кіру", start_parameter="login"),
+        )
+        return
+    
+    # Индекс сұрау жіберген пайдаланушының клиентімен жаңартылады (өзгеріс болмаса API 304 қайтарады)
+    await inline_index.ensure_fresh(get_api_client(inline_query.from_user.id))
+    if not inline_index.loaded:
+        await inline_query.answer([], cache_time=0, is_personal=True)
+        return
+    
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    results, next_offset = inline_index.answer(inline_query.query, offset)
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True, next_offset=next_offset)
+
+
+async def on_startup():
+    global metrics_runner
+    await api_client.start()
+    if BOT_METRICS_PORT:
+        app = web.Application()
+        app.router.add_get('/metrics', metrics_handler)
+        metrics_runner = web.AppRunner(app)
+        await metrics_runner.setup()
+        await web.TCPSite(metrics_runner, BOT_METRICS_HOST, BOT_METRICS_PORT).start()
+
+async def on_shutdown():
+    await update_scheduler.drain(BOT_DRAIN_TIMEOUT)
+    inline_index.close()
+    await api_client.close()
+    user_login_state.close()
+    telegram_files.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+# Жұмыс режимі: "polling" (әдепкі) немесе "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8081"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Telegram-ның webhook-қа бір уақыттағы қосылымдары; параллельдікті update_scheduler басқарады
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
 async def main():
-    await dp.start_polling(bot)
+    # Түбірлік логгер тек ботты іске қосқанда бапталады, импорттағанда емес
+    setup_logging(BOT_LOG_LEVEL)
+    if BOT_MODE == "webhook":
+        server = WebhookServer(
+            dp, bot, update_scheduler,
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            drain_timeout=BOT_DRAIN_TIMEOUT,
+        )
+        await server.run(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_URL)
+    else:
+        # Параллельдікті update_scheduler басқарады; поллинг ол толған кезде күтеді
+        await dp.start_polling(bot, handle_as_tasks=False)
 
 if __name__ == '__main__':
     print("🤖 Бот іске қосылуда...")
     print("✅ Бот дайын!")
     print("🔗 Django серверінің http://localhost:8000 мекенжайында жұмыс істеп тұрғанын тексеріңіз")
     print("🚀 Telegram-да бастау үшін /start қолданыңыз")
-    print(f"🔐 Әдепкі деректер: {DEFAULT_USERNAME} / {DEFAULT_PASSWORD}")
+    print(f"🔐 Әдепкі пайдаланушы: {DEFAULT_USERNAME}")
     asyncio.run(main())
\ No newline at end of file
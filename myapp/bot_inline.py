@@ -0,0 +1,165 @@
+import asyncio
+import bisect
+import heapq
+import logging
+import re
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+TOKEN = re.compile(r'\w+')
+
+# Telegram accepts at most 50 results per inline answer
+PAGE_SIZE = 50
+
+# Answers for prefixes up to this length match much of the catalogue and are precomputed
+SHORT_PREFIX = 2
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+class ItemPrefixIndex:
+    """Item names held in bot memory so inline queries are answered without calling the API.
+
+    Every word of an item name is a key in a sorted list; a query matches items having a
+    word that starts with each query term. Rendered answers are cached per query string
+    until the next rebuild. ``render`` turns an item dict into an inline query result;
+    ``fields`` limits the item fields fetched from the API to the ones it reads.
+
+    The index is refreshed with the client of the user asking, at most every
+    ``refresh_interval`` seconds, so the bot needs no account of its own for it.
+    """
+
+    def __init__(self, render, fields=None, max_results=200, cache_size=1000, refresh_interval=60):
+        self.render = render
+        self.fields = fields
+        self.refresh_interval = refresh_interval
+        # Monotonic time of the last refresh attempt, successful or not
+        self.checked = None
+        self._refresh_lock = asyncio.Lock()
+        self._refresh_task = None
+        # Short prefixes can match most of the catalogue; nobody scrolls past a few pages
+        self.max_results = max_results
+        self.cache_size = cache_size
+        self.etag = None
+        self.loaded = False
+        self.items = {}
+        self.name_tokens = {}
+        self.by_name = []
+        # Item id -> position in by_name, so matches are ordered without comparing names
+        self.rank = {}
+        self.short_prefixes = {}
+        # Parallel sorted lists: name word and the id of the item it belongs to
+        self.keys = []
+        self.ids = []
+        self._cache = OrderedDict()
+
+    def rebuild(self, items):
+        entries = []
+        self.items = {}
+        self.name_tokens = {}
+        for item in items:
+            tokens = tokenize(item['name'])
+            self.items[item['id']] = item
+            self.name_tokens[item['id']] = tokens
+            entries.extend((token, item['id']) for token in set(tokens))
+        entries.sort()
+        self.keys = [token for token, _ in entries]
+        self.ids = [pk for _, pk in entries]
+        self.by_name = sorted(self.items, key=lambda pk: (self.items[pk]['name'].lower(), pk))
+        self.rank = {pk: position for position, pk in enumerate(self.by_name)}
+
+        self.short_prefixes = {}
+        for pk in self.by_name:
+            prefixes = {token[:length] for token in self.name_tokens[pk] for length in range(1, SHORT_PREFIX + 1)}
+            for prefix in prefixes:
+                matches = self.short_prefixes.setdefault(prefix, [])
+                if len(matches) < self.max_results:
+                    matches.append(pk)
+        self._cache.clear()
+        self.loaded = True
+
+    async def refresh(self, client):
+        """Reload the items if the catalogue changed since the last refresh; returns the API status."""
+        self.checked = time.monotonic()
+        items, status_code, etag = await client.get_items_if_changed(self.etag, fields=self.fields)
+        if status_code == 200:
+            self.rebuild(items)
+            self.etag = etag
+            logger.info("Inline index rebuilt with %s items", len(self.items))
+        elif status_code != 304:
+            logger.warning("Inline index refresh failed with status %s", status_code)
+        return status_code
+
+    @property
+    def stale(self):
+        return self.checked is None or time.monotonic() - self.checked >= self.refresh_interval
+
+    async def ensure_fresh(self, client):
+        """Refresh through ``client`` when stale.
+
+        The first load is awaited; later refreshes run in the background while queries
+        are answered from the current index. An unchanged catalogue costs one 304.
+        """
+        if not self.stale:
+            return
+        if not self.loaded:
+            async with self._refresh_lock:
+                if self.stale:
+                    await self._refresh_logged(client)
+            return
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_logged(client))
+
+    async def _refresh_logged(self, client):
+        try:
+            await self.refresh(client)
+        except Exception:
+            logger.exception("Inline index refresh failed")
+
+    def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+
+    def search(self, query):
+        """Ids of items matching every term of ``query``, ordered by name."""
+        terms = tokenize(query)
+        if not terms:
+            return self.by_name[:self.max_results]
+
+        # The longest term narrows the candidates the most
+        first = max(terms, key=len)
+        if len(terms) == 1 and len(first) <= SHORT_PREFIX:
+            return self.short_prefixes.get(first, [])
+
+        start = bisect.bisect_left(self.keys, first)
+        end = bisect.bisect_left(self.keys, first + '\uffff', lo=start)
+        candidates = set(self.ids[start:end])
+
+        others = [term for term in terms if term != first]
+        if others:
+            candidates = [
+                pk for pk in candidates
+                if all(any(token.startswith(term) for token in self.name_tokens[pk]) for term in others)
+            ]
+        return heapq.nsmallest(self.max_results, candidates, key=self.rank.__getitem__)
+
+    def answer(self, query, offset=0):
+        """Return (results, next_offset) for one page of an inline query."""
+        key = ' '.join(tokenize(query))
+        results = self._cache.get(key)
+        if results is None:
+            results = [self.render(self.items[pk]) for pk in self.search(key)]
+            self._cache[key] = results
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+
+        page = results[offset:offset + PAGE_SIZE]
+        next_offset = str(offset + PAGE_SIZE) if offset + PAGE_SIZE < len(results) else ''
+        return page, next_offset
@@ -0,0 +1,225 @@
+import asyncio
+import functools
+import tempfile
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import aiohttp
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+
+from myapp import services
+
+
+# Uploads larger than this are spooled to disk before import
+IMPORT_SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def read_media(name):
+    with default_storage.open(name, 'rb') as media:
+        return media.read()
+
+
+def next_cursor(page):
+    page_url = page.get('next')
+    if not page_url:
+        return None
+    return parse_qs(urlsplit(page_url).query).get('cursor', [None])[0]
+
+
+class LocalAPIClient:
+    """Drop-in replacement for the bot's HTTP APIClient that calls myapp.services in-process.
+
+    For single-host deployments where the bot runs next to the Django project: no HTTP,
+    JSON round-trip or token lookup by the web server. Tokens still identify the user, and
+    every call gets the same permission checks and ``(data, status)`` results as the API.
+    """
+
+    def __init__(self, token=None, parent=None):
+        self.token = token
+        self.parent = parent
+        # Only used by the bot to download files from Telegram
+        self.session = None
+
+    def for_token(self, token):
+        return LocalAPIClient(token=token, parent=self.parent or self)
+
+    async def start(self):
+        if self.parent is not None:
+            return await self.parent.start()
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def get_session(self):
+        if self.parent is not None:
+            return await self.parent.get_session()
+        return await self.start()
+
+    async def call(self, service, *args):
+        return await self.run(self._call_as_user, service, *args)
+
+    async def run(self, service, *args):
+        """Run a service the way Django runs a request.
+
+        Connections that broke or outlived CONN_MAX_AGE are closed before and after, as the
+        request_started/request_finished handlers do, so a dropped database connection is
+        reopened on the next call instead of failing every call until the bot restarts.
+        ORM calls run in the sync thread, which is where its connections live.
+        """
+        await sync_to_async(close_old_connections)()
+        try:
+            return await service(*args)
+        finally:
+            await sync_to_async(close_old_connections)()
+
+    async def _call_as_user(self, service, *args):
+        if not self.token:
+            return await service(AnonymousUser(), *args)
+        user = await services.token_user(self.token)
+        if user is None:
+            return services.INVALID_TOKEN, 401
+        return await service(user, *args)
+
+    async def login(self, username, password):
+        return await self.run(services.login, username, password)
+
+    async def evict_token(self):
+        return await self.call(services.evict_token, self.token)
+
+    async def iter_pages(self, fetch_page):
+        cursor = None
+        while True:
+            response, status_code = await fetch_page(cursor=cursor)
+            yield response, status_code
+            if status_code != 200:
+                return
+            cursor = next_cursor(response)
+            if not cursor:
+                return
+
+    async def fetch_all(self, fetch_page):
+        results = []
+        async for response, status_code in self.iter_pages(fetch_page):
+            if status_code != 200:
+                return response, status_code
+            results.extend(response.get('results', []))
+        return results, 200
+
+    async def get_users(self, cursor=None):
+        return await self.call(services.list_users, cursor)
+
+    async def get_all_users(self):
+        return await self.fetch_all(self.get_users)
+
+    async def get_user(self, user_id):
+        return await self.call(services.get_user, user_id)
+
+    async def create_user(self, user_data):
+        return await self.call(services.create_user, user_data)
+
+    async def update_user(self, user_id, user_data):
+        return await self.call(services.update_user, user_id, user_data)
+
+    async def delete_user(self, user_id):
+        return await self.call(services.delete_user, user_id)
+
+    async def get_items(self, cursor=None, **params):
+        return await self.call(services.list_items, cursor, params)
+
+    async def import_items(self, chunks, filename):
+        """Spool the streamed file off the event loop, then run the importer on it."""
+        with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_SIZE) as upload:
+            async for chunk in chunks:
+                # Past IMPORT_SPOOL_SIZE the spool rolls over to disk inside write()
+                await asyncio.to_thread(upload.write, chunk)
+            await asyncio.to_thread(upload.seek, 0)
+            return await self.call(services.import_items, upload, filename)
+
+    async def upload_item_image(self, item_id, chunks, filename):
+        """Write the streamed image to a temporary file off the event loop, then attach it."""
+        with tempfile.TemporaryFile() as upload:
+            async for chunk in chunks:
+                await asyncio.to_thread(upload.write, chunk)
+            await asyncio.to_thread(upload.seek, 0)
+            return await self.call(services.upload_item_image, item_id, upload)
+
+    async def get_media(self, url):
+        """Read a media file: from storage for MEDIA_URL paths, over HTTP for absolute URLs."""
+        if url.startswith(settings.MEDIA_URL):
+            try:
+                return await asyncio.to_thread(read_media, unquote(url[len(settings.MEDIA_URL):])), 200
+            except FileNotFoundError:
+                return {"error": "File not found"}, 404
+        session = await self.get_session()
+        async with session.get(url) as response:
+            if response.status != 200:
+                return await response.text(), response.status
+            return await response.read(), response.status
+
+    async def get_item(self, item_id):
+        return await self.call(services.get_item, item_id)
+
+    async def search_items(self, query, offset=None):
+        return await self.call(services.search_items, query, offset)
+
+    async def create_item(self, item_data):
+        return await self.call(services.create_item, item_data)
+
+    async def update_item(self, item_id, item_data):
+        return await self.call(services.update_item, item_id, item_data)
+
+    async def delete_item(self, item_id):
+        return await self.call(services.delete_item, item_id)
+
+    async def get_categories(self, cursor=None):
+        return await self.call(services.list_categories, cursor)
+
+    async def get_all_categories(self):
+        return await self.fetch_all(self.get_categories)
+
+    async def fetch_all_if_changed(self, fetch_page, etag=None):
+        """Same contract as APIClient.fetch_all_if_changed, keyed on the catalogue version."""
+        version, status_code = await self.call(services.catalogue_version)
+        if status_code != 200:
+            return version, status_code, None
+        # The version is read before the list, so a concurrent change is picked up next time
+        new_etag = f'"catalogue-{version}"'
+        if etag == new_etag:
+            return None, 304, etag
+
+        results, status_code = await self.fetch_all(fetch_page)
+        if status_code != 200:
+            return results, status_code, None
+        return results, 200, new_etag
+
+    async def get_categories_if_changed(self, etag=None):
+        return await self.fetch_all_if_changed(self.get_categories, etag)
+
+    async def get_items_if_changed(self, etag=None, **params):
+        return await self.fetch_all_if_changed(functools.partial(self.get_items, **params), etag)
+
+    async def create_category(self, category_data):
+        return await self.call(services.create_category, category_data)
+
+    async def get_orders(self, cursor=None, **params):
+        return await self.call(services.list_orders, cursor, params)
+
+    async def get_all_orders(self):
+        return await self.fetch_all(self.get_orders)
+
+    async def create_order(self, order_data):
+        return await self.call(services.create_order, order_data)
+
+    async def checkout(self, lines):
+        return await self.call(services.checkout, lines)
+
+    async def get_order(self, order_id):
+        return await self.call(services.get_order, order_id)
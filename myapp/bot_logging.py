@@ -0,0 +1,73 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+import reprlib
+
+
+SECRET_HEADERS = {'authorization', 'cookie', 'x-telegram-bot-api-secret-token'}
+SECRET_FIELDS = {'password', 'token'}
+
+
+class Truncated:
+    """Lazy, size-bounded repr of a payload: nothing is formatted unless the record is emitted."""
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=500):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        short = reprlib.Repr()
+        short.maxstring = self.limit
+        short.maxother = self.limit
+        short.maxlist = short.maxdict = 10
+        short.maxlevel = 3
+        text = short.repr(redact(self.value))
+        if len(text) > self.limit:
+            text = f"{text[:self.limit]}...(+{len(text) - self.limit} chars)"
+        return text
+
+
+def redact(value):
+    """Mask secret fields in a (possibly nested) payload or header mapping."""
+    if isinstance(value, dict):
+        return {
+            key: '***' if str(key).lower() in SECRET_HEADERS | SECRET_FIELDS else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list) and value and isinstance(value[0], dict):
+        return [redact(item) for item in value]
+    return value
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of records at or below ``max_level``; more severe records always pass."""
+
+    def __init__(self, rate=1.0, max_level=logging.INFO):
+        super().__init__()
+        self.rate = rate
+        self.max_level = max_level
+
+    def filter(self, record):
+        if record.levelno > self.max_level or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+def setup_logging(level=logging.INFO):
+    """Route all records through a queue so the event loop never blocks on log I/O."""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,128 @@
+import asyncio
+import functools
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TelegramFileCache:
+    """Persistent (content hash, variant) -> Telegram file_id mapping.
+
+    Telegram keeps every file the bot has sent and returns a file_id for it, so an image
+    is uploaded once and afterwards sent by id. Keys are the SHA-256 of the original image
+    (``image_hash`` in the API) plus the variant sent; a new image therefore never matches
+    an old entry. The item -> hash table only lets superseded entries be dropped.
+
+    Lookups are served from memory; on the event loop use the awaitable writers
+    (``aset``, ``aforget``, ``aforget_item``), which run the SQLite I/O on a worker thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Lookups happen on every photo send; the table is small enough to keep in memory too
+        self._file_ids = {}
+        # One writer thread keeps the writes ordered
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bot-files')
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS telegram_files ("
+            "content_hash TEXT NOT NULL, variant TEXT NOT NULL, file_id TEXT NOT NULL, created REAL NOT NULL, "
+            "PRIMARY KEY (content_hash, variant))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS telegram_item_images ("
+            "item_id INTEGER PRIMARY KEY, content_hash TEXT NOT NULL)"
+        )
+        for content_hash, variant, file_id in self._conn.execute(
+            "SELECT content_hash, variant, file_id FROM telegram_files"
+        ):
+            self._file_ids[content_hash, variant] = file_id
+
+    def __len__(self):
+        return len(self._file_ids)
+
+    def get(self, content_hash, variant):
+        return self._file_ids.get((content_hash, variant))
+
+    def set(self, content_hash, variant, file_id, item_id=None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO telegram_files (content_hash, variant, file_id, created) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(content_hash, variant) DO UPDATE SET file_id = excluded.file_id, created = excluded.created",
+                (content_hash, variant, file_id, time.time()),
+            )
+            self._file_ids[content_hash, variant] = file_id
+            if item_id is not None:
+                self._track(item_id, content_hash)
+
+    def forget(self, content_hash, variant):
+        """Drop one entry, e.g. when Telegram no longer accepts its file_id."""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM telegram_files WHERE content_hash = ? AND variant = ?", (content_hash, variant),
+            )
+            self._file_ids.pop((content_hash, variant), None)
+
+    def forget_item(self, item_id):
+        """Drop the entries of the item's current image after it was replaced."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content_hash FROM telegram_item_images WHERE item_id = ?", (item_id,),
+            ).fetchone()
+            self._conn.execute("DELETE FROM telegram_item_images WHERE item_id = ?", (item_id,))
+            if row is not None:
+                self._drop_unused(row[0])
+
+    def _track(self, item_id, content_hash):
+        row = self._conn.execute(
+            "SELECT content_hash FROM telegram_item_images WHERE item_id = ?", (item_id,),
+        ).fetchone()
+        if row is not None and row[0] == content_hash:
+            return
+        self._conn.execute(
+            "INSERT INTO telegram_item_images (item_id, content_hash) VALUES (?, ?) "
+            "ON CONFLICT(item_id) DO UPDATE SET content_hash = excluded.content_hash",
+            (item_id, content_hash),
+        )
+        if row is not None:
+            self._drop_unused(row[0])
+
+    def _drop_unused(self, content_hash):
+        # The same picture may still be used by another item
+        in_use = self._conn.execute(
+            "SELECT 1 FROM telegram_item_images WHERE content_hash = ? LIMIT 1", (content_hash,),
+        ).fetchone()
+        if in_use:
+            return
+        self._conn.execute("DELETE FROM telegram_files WHERE content_hash = ?", (content_hash,))
+        for key in [key for key in self._file_ids if key[0] == content_hash]:
+            del self._file_ids[key]
+
+    def close(self):
+        self._executor.shutdown()
+        with self._lock:
+            self._conn.close()
+
+    # Awaitable counterparts for use on the event loop
+    async def aset(self, content_hash, variant, file_id, item_id=None):
+        return await self._call(self.set, content_hash, variant, file_id, item_id=item_id)
+
+    async def aforget(self, content_hash, variant):
+        return await self._call(self.forget, content_hash, variant)
+
+    async def aforget_item(self, item_id):
+        return await self._call(self.forget_item, item_id)
+
+    async def _call(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+
+
+def get_file_cache():
+    """Build the file_id cache configured through the environment."""
+    return TelegramFileCache(os.getenv("BOT_FILE_CACHE_PATH", "bot_files.sqlite3"))
@@ -0,0 +1,135 @@
+import asyncio
+
+from myapp.bot_throttle import bulk_sends
+
+
+# Telegram's limit on message text, counted in UTF-16 code units
+MESSAGE_LIMIT = 4096
+
+
+def text_length(text):
+    """Length as Telegram counts it: emoji outside the BMP take two units."""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """Split ``text`` into chunks of at most ``limit`` units, on line boundaries.
+
+    A single line longer than the limit is cut where it has to be. Chunks with nothing
+    but whitespace are skipped, Telegram rejects empty messages.
+    """
+    chunks = []
+    while text_length(text) > limit:
+        head = _head(text, limit)
+        cut = head.rfind('\n')
+        if cut > 0:
+            chunk, text = head[:cut], text[cut + 1:]
+        else:
+            chunk, text = head, text[len(head):]
+        if chunk.strip():
+            chunks.append(chunk)
+    if text.strip():
+        chunks.append(text)
+    return chunks
+
+
+def _head(text, limit):
+    # Longest prefix that fits; a surrogate pair cut in half is dropped
+    return text.encode('utf-16-le')[:limit * 2].decode('utf-16-le', errors='ignore')
+
+
+class ReplyStream:
+    """Reply to a message with text that is still being produced, as several messages.
+
+    Text passed to ``write`` is buffered as a list of parts and emitted as soon as a full
+    chunk is available, so the first message goes out while later API pages are still
+    being fetched. Chunks are sent by a background task through a small queue: producing
+    and sending overlap, and a slow chat (see OutboundLimiter) holds the producer back
+    instead of letting the output pile up in memory. The first chunk is a reply, the rest
+    follow as plain messages with bulk priority.
+
+    With ``max_messages`` set, output past that many messages is dropped; ``write`` then
+    returns False so the caller can stop fetching, and ``truncated`` is set.
+    """
+
+    def __init__(self, message, limit=MESSAGE_LIMIT, max_messages=None, queue_size=2):
+        self.message = message
+        self.limit = limit
+        self.max_messages = max_messages
+        self.truncated = False
+        self.sent = 0
+        self._parts = []
+        self._size = 0
+        self._chunks = 0
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._sender = None
+        self._error = None
+
+    async def __aenter__(self):
+        self._sender = asyncio.create_task(self._send_chunks())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._sender.cancel()
+            return False
+        if not self.truncated and self._parts:
+            for chunk in split_message(''.join(self._parts), self.limit):
+                if not await self._emit(chunk):
+                    break
+        self._parts = []
+        await self._queue.put(None)
+        await self._sender
+        if self._error is not None:
+            raise self._error
+        return False
+
+    @property
+    def full(self):
+        return self.max_messages is not None and self._chunks >= self.max_messages
+
+    async def write(self, text):
+        """Append ``text``; returns False once no more output will be sent."""
+        if self._error is not None:
+            raise self._error
+        if self.truncated:
+            return False
+        self._parts.append(text)
+        self._size += text_length(text)
+        if self._size > self.limit:
+            # Everything but the last chunk is complete; the rest keeps filling up
+            chunks = split_message(''.join(self._parts), self.limit)
+            rest = chunks.pop() if chunks else ''
+            self._parts = [rest]
+            self._size = text_length(rest)
+            for chunk in chunks:
+                if not await self._emit(chunk):
+                    return False
+        return True
+
+    async def _emit(self, chunk):
+        if self.full:
+            self.truncated = True
+            self._parts = []
+            return False
+        self._chunks += 1
+        await self._queue.put(chunk)
+        return True
+
+    async def _send_chunks(self):
+        while True:
+            chunk = await self._queue.get()
+            if chunk is None:
+                return
+            # After a failed send the queue is still drained, so the producer never blocks
+            if self._error is not None:
+                continue
+            try:
+                if self.sent == 0:
+                    await self.message.reply(chunk)
+                else:
+                    with bulk_sends():
+                        await self.message.answer(chunk)
+                self.sent += 1
+            except Exception as exc:
+                self._error = exc
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+
+from aiogram import BaseMiddleware
+
+
+logger = logging.getLogger(__name__)
+
+
+class UserOrderingMiddleware(BaseMiddleware):
+    """Run updates from different users in parallel while keeping each user's updates in order.
+
+    At most ``concurrency`` handlers run at once. At most ``max_pending`` updates may be
+    scheduled or running; beyond that the middleware blocks the caller (the polling loop
+    or a webhook worker), which pushes back on the update source instead of buffering.
+    """
+
+    def __init__(self, concurrency=64, max_pending=1000):
+        self._pending = asyncio.Semaphore(max_pending)
+        self._running = asyncio.Semaphore(concurrency)
+        # user id -> last scheduled task; the next update of that user waits for it
+        self._tails = {}
+        self._tasks = set()
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        key = user.id if user is not None else None
+
+        await self._pending.acquire()
+        previous = self._tails.get(key) if key is not None else None
+        task = asyncio.create_task(self._run(handler, event, data, previous))
+        self._tasks.add(task)
+        if key is not None:
+            self._tails[key] = task
+        task.add_done_callback(lambda done: self._forget(key, done))
+
+    async def _run(self, handler, event, data, previous):
+        try:
+            if previous is not None:
+                # Wait without inheriting the previous update's exception
+                await asyncio.wait([previous])
+            async with self._running:
+                return await handler(event, data)
+        except Exception:
+            logger.exception("Failed to process update %s", getattr(event, "update_id", None))
+
+    def _forget(self, key, task):
+        # The slot is freed only once the task is forgotten, so in_flight never exceeds max_pending
+        self._pending.release()
+        self._tasks.discard(task)
+        if key is not None and self._tails.get(key) is task:
+            del self._tails[key]
+
+    @property
+    def in_flight(self):
+        return len(self._tasks)
+
+    @property
+    def full(self):
+        """True while ``max_pending`` updates are scheduled; the next one would block."""
+        return self._pending.locked()
+
+    async def drain(self, timeout=None):
+        """Wait for scheduled updates to finish, e.g. before closing shared resources."""
+        if not self._tasks:
+            return
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        if pending:
+            logger.warning("%s updates still running after drain timeout", len(pending))
@@ -0,0 +1,247 @@
+import asyncio
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# All conversational flags the bot keeps per Telegram user
+STATE_FIELDS = (
+    'is_logged_in',
+    'waiting_for_login',
+    'username',
+    'user_id',
+    'role',
+    'token',
+    'creating_user',
+    'updating_user',
+    'updating_user_id',
+    'creating_item',
+    'updating_item',
+    'updating_item_id',
+    'creating_category',
+    'waiting_for_image',
+    'image_item_id',
+    'importing_items',
+    'cart',
+    'items_next_cursor',
+    'items_prev_cursor',
+    'search_query',
+    'search_next_offset',
+    'search_prev_offset',
+)
+
+
+class UserState:
+    """Compact per-user state record; unset fields read as None."""
+
+    __slots__ = STATE_FIELDS
+
+    def __init__(self, **fields):
+        for name in STATE_FIELDS:
+            setattr(self, name, None)
+        self.update(**fields)
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def update(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in STATE_FIELDS if getattr(self, name) is not None}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{name: value for name, value in data.items() if name in STATE_FIELDS})
+
+    def __repr__(self):
+        return f"UserState({self.to_dict()})"
+
+
+class BaseStateStorage:
+    """Storage interface for per-user bot state."""
+
+    def __init__(self, ttl=None):
+        # Idle time in seconds after which a user's state is dropped
+        self.ttl = ttl
+
+    def get(self, user_id):
+        """Return the user's state, or a blank UserState if there is none."""
+        raise NotImplementedError
+
+    def set(self, user_id, state):
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        raise NotImplementedError
+
+    # The key is positional-only: "user_id" is also a state field
+    def update(self, key, /, **fields):
+        state = self.get(key)
+        state.update(**fields)
+        self.set(key, state)
+        return state
+
+    def reset(self, key, /, **fields):
+        state = UserState(**fields)
+        self.set(key, state)
+        return state
+
+    def close(self):
+        pass
+
+    # Awaitable counterparts for use on the event loop
+    async def aget(self, user_id):
+        return await self._call(self.get, user_id)
+
+    async def aset(self, user_id, state):
+        return await self._call(self.set, user_id, state)
+
+    async def adelete(self, user_id):
+        return await self._call(self.delete, user_id)
+
+    async def aupdate(self, key, /, **fields):
+        return await self._call(self.update, key, **fields)
+
+    async def areset(self, key, /, **fields):
+        return await self._call(self.reset, key, **fields)
+
+    async def _call(self, method, *args, **kwargs):
+        # Engines with blocking I/O run it off the event loop
+        return method(*args, **kwargs)
+
+
+class MemoryStateStorage(BaseStateStorage):
+    """In-process storage with idle-TTL and size-bounded eviction."""
+
+    def __init__(self, ttl=None, max_size=None):
+        super().__init__(ttl)
+        self.max_size = max_size
+        # user_id -> (UserState, last_access), oldest access first
+        self._states = OrderedDict()
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, user_id):
+        now = time.monotonic()
+        self._evict(now)
+        entry = self._states.get(user_id)
+        if entry is None:
+            return UserState()
+        self._states[user_id] = (entry[0], now)
+        self._states.move_to_end(user_id)
+        return entry[0]
+
+    def set(self, user_id, state):
+        now = time.monotonic()
+        self._states[user_id] = (state, now)
+        self._states.move_to_end(user_id)
+        self._evict(now)
+
+    def delete(self, user_id):
+        self._states.pop(user_id, None)
+
+    def _evict(self, now):
+        if self.ttl is not None:
+            deadline = now - self.ttl
+            while self._states:
+                user_id, (_, last_access) = next(iter(self._states.items()))
+                if last_access > deadline:
+                    break
+                del self._states[user_id]
+        if self.max_size is not None:
+            while len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+
+
+class SQLiteStateStorage(BaseStateStorage):
+    """Durable storage in an SQLite file, shareable between bot processes.
+
+    The file holds users' API tokens, so it should be readable by the bot only.
+    """
+
+    # Expired rows are purged once per this many writes
+    PURGE_EVERY = 1000
+    # A read refreshes a row's idle clock only once this share of the TTL has passed,
+    # so most reads do not take the database write lock
+    TOUCH_FRACTION = 0.1
+
+    def __init__(self, path, ttl=None):
+        super().__init__(ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        self._writes = 0
+        # The async API runs queries here; one thread, as they share one connection
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bot-state')
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bot_state ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, touched REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bot_state_touched ON bot_state (touched)")
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data, touched FROM bot_state WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return UserState()
+            if self.ttl is not None:
+                if row[1] <= now - self.ttl:
+                    self._conn.execute("DELETE FROM bot_state WHERE user_id = ?", (user_id,))
+                    return UserState()
+                if row[1] <= now - self.ttl * self.TOUCH_FRACTION:
+                    self._conn.execute("UPDATE bot_state SET touched = ? WHERE user_id = ?", (now, user_id))
+        return UserState.from_dict(json.loads(row[0]))
+
+    def set(self, user_id, state):
+        now = time.time()
+        data = json.dumps(state.to_dict(), separators=(',', ':'))
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO bot_state (user_id, data, touched) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, touched = excluded.touched",
+                (user_id, data, now),
+            )
+            self._writes += 1
+            if self.ttl is not None and self._writes % self.PURGE_EVERY == 0:
+                self._conn.execute("DELETE FROM bot_state WHERE touched <= ?", (now - self.ttl,))
+
+    def delete(self, user_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM bot_state WHERE user_id = ?", (user_id,))
+
+    def close(self):
+        self._executor.shutdown()
+        with self._lock:
+            self._conn.close()
+
+    async def _call(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+
+
+def get_state_storage():
+    """Build the storage engine configured through the environment."""
+    engine = os.getenv("BOT_STATE_STORAGE", "memory")
+    ttl = os.getenv("BOT_STATE_TTL", "86400")
+    ttl = float(ttl) if ttl else None
+
+    if engine == 'memory':
+        max_size = os.getenv("BOT_STATE_MAX_USERS", "100000")
+        return MemoryStateStorage(ttl=ttl, max_size=int(max_size) if max_size else None)
+    if engine == 'sqlite':
+        return SQLiteStateStorage(os.getenv("BOT_STATE_SQLITE_PATH", "bot_state.sqlite3"), ttl=ttl)
+    raise ValueError(f"Unknown BOT_STATE_STORAGE engine: {engine}")
@@ -0,0 +1,161 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from myapp.metrics import Counter, Gauge, Histogram
+
+
+logger = logging.getLogger(__name__)
+
+# Lower value is sent first
+INTERACTIVE = 0
+BULK = 1
+
+send_priority = contextvars.ContextVar('send_priority', default=INTERACTIVE)
+
+outbound_wait_seconds = Histogram(
+    'bot_outbound_wait_seconds', 'Time Telegram calls waited for the rate limiter', ['priority'],
+)
+outbound_waiting = Gauge('bot_outbound_waiting', 'Telegram calls waiting for the rate limiter')
+outbound_retries = Counter('bot_outbound_retries', 'Telegram calls retried after a 429 response', ['method'])
+
+
+@contextlib.contextmanager
+def bulk_sends():
+    """Mark Telegram calls made in this block as bulk output: interactive replies go first."""
+    token = send_priority.set(BULK)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class PriorityBucket:
+    """Token bucket whose waiters are served by priority, then in arrival order.
+
+    Tokens refill at ``rate`` per second up to ``capacity``. ``pause`` blocks the bucket
+    entirely, e.g. for the retry_after of a 429 response.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._dispatcher = None
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _delay(self, now):
+        """Seconds until a token can be taken."""
+        self._refill(now)
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    @property
+    def idle(self):
+        """Full and nobody waiting: the bucket can be dropped and recreated later."""
+        now = time.monotonic()
+        self._refill(now)
+        return not self._waiters and self.paused_until <= now and self.tokens >= self.capacity
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, priority=INTERACTIVE):
+        if not self._waiters and self._delay(time.monotonic()) == 0:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        while self._waiters:
+            delay = self._delay(time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            # Cancelled waiters (e.g. a handler that timed out) do not use up a token
+            if not future.done():
+                self.tokens -= 1
+                future.set_result(None)
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Session middleware that paces every Telegram call aimed at a chat.
+
+    Calls wait for a token from the per-chat bucket and then from the global bucket, so no
+    handler can exceed Telegram's flood limits whatever it sends. A 429 pauses the chat's
+    bucket for retry_after and the call is retried, up to ``max_retries`` times. Calls made
+    inside ``bulk_sends()`` queue behind interactive replies in both buckets.
+    """
+
+    # Idle chat buckets are dropped once there are more than this many
+    MAX_IDLE_CHATS = 10000
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60, max_retries=3):
+        # No burst allowance globally: a full bucket plus its refill would let twice the
+        # rate through within one second, so sends are spread evenly instead
+        self.global_bucket = PriorityBucket(global_rate, 1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._chats = {}
+
+    def chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_IDLE_CHATS:
+                self._chats = {key: value for key, value in self._chats.items() if not value.idle}
+            # Negative ids are groups and channels, which Telegram limits per minute
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._chats[chat_id] = PriorityBucket(rate, self.chat_burst)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            # Answers to callback and inline queries are not counted against chat limits
+            return await make_request(bot, method)
+
+        priority = send_priority.get()
+        chat_bucket = self.chat_bucket(chat_id)
+        waiting = outbound_waiting.labels()
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            waiting.inc()
+            try:
+                await chat_bucket.acquire(priority)
+                await self.global_bucket.acquire(priority)
+            finally:
+                waiting.dec()
+            outbound_wait_seconds.labels('bulk' if priority == BULK else 'interactive').observe(time.monotonic() - started)
+
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as exc:
+                if attempt == self.max_retries:
+                    raise
+                outbound_retries.labels(type(method).__name__).inc()
+                logger.warning("Telegram flood limit for chat %s, retrying in %ss", chat_id, exc.retry_after)
+                chat_bucket.pause(exc.retry_after)
@@ -0,0 +1,116 @@
+import asyncio
+import hmac
+import logging
+import signal
+
+from aiogram import types
+from aiohttp import web
+
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """Receive Telegram updates over HTTP and hand them to the dispatcher.
+
+    Concurrency, per-user ordering and backpressure all come from ``scheduler``, the
+    UserOrderingMiddleware on the dispatcher's updates: an update is acknowledged as
+    soon as it is scheduled. While the scheduler is full the receiver answers 503 so
+    Telegram retries the delivery later instead of the bot buffering without bound.
+    """
+
+    def __init__(self, dispatcher, bot, scheduler, path='/telegram/webhook', secret_token=None,
+                 max_connections=40, drain_timeout=30.0):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.scheduler = scheduler
+        self.path = path
+        self.secret_token = secret_token
+        self.max_connections = max_connections
+        self.drain_timeout = drain_timeout
+        self.accepting = False
+        self._runner = None
+        self._stop_requested = asyncio.Event()
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request):
+        if self.secret_token:
+            received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(received, self.secret_token):
+                return web.Response(status=401)
+
+        if not self.accepting:
+            return web.Response(status=503)
+
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError:
+            return web.Response(status=400)
+
+        if self.scheduler.full:
+            logger.warning("Update scheduler is full, asking Telegram to retry update %s", update.update_id)
+            return web.Response(status=503)
+
+        try:
+            # Returns once the scheduler has taken the update
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception:
+            # A retry would fail the same way, so the update is still acknowledged
+            logger.exception("Failed to process update %s", update.update_id)
+        return web.Response()
+
+    async def start(self, host, port, webhook_url=None):
+        await self.dispatcher.emit_startup(bot=self.bot, dispatcher=self.dispatcher)
+        self.accepting = True
+
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+        if webhook_url:
+            await self.bot.set_webhook(
+                f"{webhook_url.rstrip('/')}{self.path}",
+                secret_token=self.secret_token,
+                max_connections=self.max_connections,
+            )
+        logger.info("Webhook receiver listening on %s:%s%s", host, port, self.path)
+
+    async def stop(self):
+        """Stop accepting updates, wait for scheduled ones to be handled, then shut down."""
+        self.accepting = False
+        # Closing the site first lets requests that are still scheduling an update finish
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+        await self.scheduler.drain(self.drain_timeout)
+        await self.dispatcher.emit_shutdown(bot=self.bot, dispatcher=self.dispatcher)
+
+    def request_stop(self):
+        """Make ``run`` drain the scheduled updates and return."""
+        self._stop_requested.set()
+
+    async def run(self, host, port, webhook_url=None):
+        """Serve until SIGTERM/SIGINT (or ``request_stop``), then stop gracefully."""
+        loop = asyncio.get_running_loop()
+        signals = []
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, self.request_stop)
+            except (NotImplementedError, RuntimeError):
+                # No signal handlers on Windows or outside the main thread
+                continue
+            signals.append(signum)
+
+        try:
+            await self.start(host, port, webhook_url)
+            await self._stop_requested.wait()
+            logger.info("Stopping webhook receiver")
+        finally:
+            await self.stop()
+            for signum in signals:
+                loop.remove_signal_handler(signum)
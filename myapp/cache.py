@@ -0,0 +1,161 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponseNotModified, JsonResponse
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+
+CATALOGUE_VERSION_KEY = 'catalogue:version'
+
+
+class CacheStats:
+    """In-process hit/miss counters and cumulative latency for the catalogue cache."""
+
+    OUTCOMES = ('hit', 'miss', 'not_modified')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = {outcome: 0 for outcome in self.OUTCOMES}
+            self.seconds = {outcome: 0.0 for outcome in self.OUTCOMES}
+
+    def record(self, outcome, seconds):
+        with self._lock:
+            self.counts[outcome] += 1
+            self.seconds[outcome] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            total = sum(self.counts.values())
+            served = self.counts['hit'] + self.counts['not_modified']
+            return {
+                'requests': total,
+                'hit_rate': served / total if total else 0.0,
+                'counts': dict(self.counts),
+                'avg_latency_ms': {
+                    outcome: (self.seconds[outcome] / count * 1000) if count else 0.0
+                    for outcome, count in self.counts.items()
+                },
+            }
+
+
+catalogue_stats = CacheStats()
+
+
+def _new_generation():
+    # A missing version (first start or evicted key) must not restart at a value that
+    # old ETags and response keys were built from, so it is seeded from the clock
+    return time.time_ns()
+
+
+def get_catalogue_version():
+    version = cache.get(CATALOGUE_VERSION_KEY)
+    if version is None:
+        seed = _new_generation()
+        cache.add(CATALOGUE_VERSION_KEY, seed, None)
+        version = cache.get(CATALOGUE_VERSION_KEY, seed)
+    return version
+
+
+async def aget_catalogue_version():
+    version = await cache.aget(CATALOGUE_VERSION_KEY)
+    if version is None:
+        seed = _new_generation()
+        await cache.aadd(CATALOGUE_VERSION_KEY, seed, None)
+        version = await cache.aget(CATALOGUE_VERSION_KEY, seed)
+    return version
+
+
+def bump_catalogue_version():
+    """Invalidate every cached catalogue response once the current transaction commits."""
+    transaction.on_commit(_incr_catalogue_version)
+
+
+def _incr_catalogue_version():
+    try:
+        cache.incr(CATALOGUE_VERSION_KEY)
+    except ValueError:
+        # Version key was evicted; any fresh value starts a new generation
+        cache.set(CATALOGUE_VERSION_KEY, _new_generation(), None)
+
+
+def _catalogue_etag(version, url):
+    digest = hashlib.md5(f'{version}:{url}'.encode()).hexdigest()
+    return digest, f'"{digest}"'
+
+
+def _etag_matches(request, etag):
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    candidates = [value.strip() for value in header.split(',')]
+    return '*' in candidates or etag in candidates or f'W/{etag}' in candidates
+
+
+def cached_catalogue_response(request, build_response):
+    """Serve a catalogue GET from the cache, revalidating with ETag/If-None-Match.
+
+    ``build_response`` is called on a miss; only 200 responses are cached.
+    """
+    started = time.perf_counter()
+    digest, etag = _catalogue_etag(get_catalogue_version(), request.build_absolute_uri())
+
+    if _etag_matches(request, etag):
+        catalogue_stats.record('not_modified', time.perf_counter() - started)
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+    key = f'catalogue:{digest}'
+    data = cache.get(key)
+    if data is not None:
+        response = Response(data)
+        outcome = 'hit'
+    else:
+        response = build_response()
+        if response.status_code != status.HTTP_200_OK:
+            return response
+        cache.set(key, response.data, settings.CATALOGUE_CACHE_TIMEOUT)
+        outcome = 'miss'
+
+    response['ETag'] = etag
+    catalogue_stats.record(outcome, time.perf_counter() - started)
+    return response
+
+
+async def acached_catalogue_response(request, build_data):
+    """Async counterpart of cached_catalogue_response for async views.
+
+    ``build_data`` is awaited on a miss and returns ``(data, status_code)``.
+    """
+    started = time.perf_counter()
+    digest, etag = _catalogue_etag(await aget_catalogue_version(), request.build_absolute_uri())
+
+    if _etag_matches(request, etag):
+        catalogue_stats.record('not_modified', time.perf_counter() - started)
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    key = f'catalogue:{digest}'
+    data = await cache.aget(key)
+    if data is not None:
+        outcome = 'hit'
+    else:
+        data, status_code = await build_data()
+        if status_code != status.HTTP_200_OK:
+            return JsonResponse(data, status=status_code, encoder=JSONEncoder, safe=False)
+        await cache.aset(key, data, settings.CATALOGUE_CACHE_TIMEOUT)
+        outcome = 'miss'
+
+    response = JsonResponse(data, encoder=JSONEncoder, safe=False)
+    response['ETag'] = etag
+    catalogue_stats.record(outcome, time.perf_counter() - started)
+    return response
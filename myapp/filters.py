@@ -0,0 +1,143 @@
+"""Query-string filters and sparse fieldsets for the list endpoints.
+
+Each function takes ``request.query_params`` (or any mapping of strings) and raises
+``ValidationError`` for malformed values, so the API answers 400 instead of ignoring them.
+"""
+import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+from .models import Order
+
+
+TRUE_VALUES = {'1', 'true', 'yes'}
+FALSE_VALUES = {'0', 'false', 'no'}
+
+
+def _parse_bool(value, errors, name):
+    value = value.lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    errors[name] = ['Must be true or false.']
+
+
+def _parse_decimal(value, errors, name):
+    try:
+        number = Decimal(value)
+    except InvalidOperation:
+        number = None
+    # NaN and Infinity parse but cannot be compared with a price
+    if number is None or not number.is_finite():
+        errors[name] = ['A valid number is required.']
+        return None
+    return number
+
+
+def _parse_moment(value, errors, name, end_of_day=False):
+    """Accept an ISO datetime or a date; a bare date covers the whole day."""
+    try:
+        # Well-formed but impossible values (2025-02-30) raise instead of returning None
+        # Dates first: parse_datetime also accepts a bare date, as midnight
+        day = parse_date(value)
+        if day is not None:
+            if end_of_day:
+                day += datetime.timedelta(days=1)
+            moment = datetime.datetime.combine(day, datetime.time.min)
+        else:
+            moment = parse_datetime(value)
+    except (ValueError, OverflowError):
+        moment = None
+    if moment is None:
+        errors[name] = ['Use YYYY-MM-DD or an ISO 8601 datetime.']
+        return None
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def filter_items(queryset, params):
+    """?category=<id|slug>&available=true&min_price=&max_price="""
+    errors = {}
+
+    category = params.get('category')
+    if category:
+        if category.isdigit():
+            queryset = queryset.filter(categories__id=int(category))
+        else:
+            queryset = queryset.filter(categories__slug=category)
+
+    available = params.get('available')
+    if available:
+        available = _parse_bool(available, errors, 'available')
+        if available is not None:
+            queryset = queryset.filter(available=available)
+
+    min_price = params.get('min_price')
+    if min_price:
+        min_price = _parse_decimal(min_price, errors, 'min_price')
+        if min_price is not None:
+            queryset = queryset.filter(price__gte=min_price)
+
+    max_price = params.get('max_price')
+    if max_price:
+        max_price = _parse_decimal(max_price, errors, 'max_price')
+        if max_price is not None:
+            queryset = queryset.filter(price__lte=max_price)
+
+    if errors:
+        raise ValidationError(errors)
+    return queryset
+
+
+def filter_orders(queryset, params):
+    """?status=&created_after=&created_before=&item=<id>"""
+    errors = {}
+
+    order_status = params.get('status')
+    if order_status:
+        statuses = dict(Order.STATUS_CHOICES)
+        if order_status in statuses:
+            queryset = queryset.filter(status=order_status)
+        else:
+            errors['status'] = [f"Must be one of: {', '.join(statuses)}."]
+
+    created_after = params.get('created_after')
+    if created_after:
+        created_after = _parse_moment(created_after, errors, 'created_after')
+        if created_after is not None:
+            queryset = queryset.filter(created_at__gte=created_after)
+
+    created_before = params.get('created_before')
+    if created_before:
+        # A date includes the whole day: created_before=2025-01-31 keeps orders from the 31st
+        created_before = _parse_moment(created_before, errors, 'created_before', end_of_day=True)
+        if created_before is not None:
+            queryset = queryset.filter(created_at__lt=created_before)
+
+    item = params.get('item')
+    if item:
+        if item.isdigit():
+            queryset = queryset.filter(item_id=int(item))
+        else:
+            errors['item'] = ['A valid integer is required.']
+
+    if errors:
+        raise ValidationError(errors)
+    return queryset
+
+
+def sparse_fields(params, allowed):
+    """Names requested with ?fields=a,b in request order, or None when every field is wanted."""
+    value = params.get('fields')
+    if not value:
+        return None
+    fields = list(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+    unknown = [name for name in fields if name not in allowed]
+    if unknown:
+        raise ValidationError({'fields': [f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(allowed)}."]})
+    return fields
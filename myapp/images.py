@@ -0,0 +1,62 @@
+"""Attaching uploaded images to items.
+
+Uploads arrive as files on disk (see ``ItemImageUpload``), are checked with Pillow, which
+only reads the header, and are handed to the default storage as a file object. MinIO's
+client sends them in fixed-size parts, so memory use does not grow with the image size.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from PIL import Image, UnidentifiedImageError
+
+from .cache import bump_catalogue_version
+from .variants import image_changed
+
+
+# Pillow format -> file extension for stored images
+IMAGE_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp', 'GIF': 'gif'}
+
+
+class ImageRejected(ValueError):
+    pass
+
+
+def image_extension(upload):
+    """Return the extension for an uploaded image (a django File), or raise ImageRejected."""
+    if upload.size > settings.ITEM_IMAGE_MAX_SIZE:
+        raise ImageRejected(f"Image is larger than {settings.ITEM_IMAGE_MAX_SIZE // (1024 * 1024)} MB")
+    try:
+        upload.seek(0)
+        with Image.open(upload) as image:
+            image_format = image.format
+    except Image.DecompressionBombError:
+        # A small, highly compressed file that would decode to an enormous bitmap
+        raise ImageRejected("Image dimensions are too large")
+    except (UnidentifiedImageError, OSError):
+        raise ImageRejected("File is not a valid image")
+    finally:
+        upload.seek(0)
+    if image_format not in IMAGE_EXTENSIONS:
+        raise ImageRejected(f"Allowed image formats: {', '.join(IMAGE_EXTENSIONS)}")
+    return IMAGE_EXTENSIONS[image_format]
+
+
+def attach_item_image(item, upload):
+    """Store ``upload`` as the item's image; old files are dropped and variants rendered once committed."""
+    # Uploaded temporary files keep temporary_file_path, so FileSystemStorage moves them instead of copying
+    content = upload if isinstance(upload, File) else File(upload)
+    extension = image_extension(content)
+    old_name = item.image.name if item.image else None
+    old_variants = item.image_variants
+
+    with transaction.atomic():
+        # upload_to adds the date folders; the random name never clashes with older files
+        item.image.save(f'{uuid.uuid4().hex}.{extension}', content, save=False)
+        item.image_variants = {}
+        item.image_hash = ''
+        item.save(update_fields=['image', 'image_variants', 'image_hash', 'updated'])
+        bump_catalogue_version()
+        image_changed(item, old_name, old_variants)
+    return item
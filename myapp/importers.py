@@ -0,0 +1,175 @@
+import codecs
+import csv
+import json
+import re
+
+from django.db import IntegrityError, transaction
+
+from .cache import bump_catalogue_version
+from .models import Category, Item
+from .serializers import ItemImportSerializer
+
+
+IMPORT_CHUNK_SIZE = 500
+
+SLUG_TAKEN = 'Item with this slug already exists.'
+
+ItemCategory = Item.categories.through
+
+
+class RowError(Exception):
+    pass
+
+
+def iter_upload_rows(upload, fmt):
+    """Yield (row_number, data) pairs from an uploaded CSV or JSONL file without reading it whole.
+
+    ``data`` is a RowError when a line cannot be decoded.
+    """
+    bad_lines = set()
+    lines = _decode_lines(upload, bad_lines)
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        last_line = 1
+        for row_number, row in enumerate(reader, start=1):
+            # A quoted value may span several lines
+            first_line, last_line = last_line + 1, reader.line_num
+            if not bad_lines.isdisjoint(range(first_line, last_line + 1)):
+                yield row_number, RowError('Not valid UTF-8 text')
+                continue
+            # Empty cells fall back to model defaults
+            yield row_number, {key.strip(): value for key, value in row.items() if key and value not in (None, '')}
+    elif fmt == 'jsonl':
+        row_number = 0
+        for line_number, line in enumerate(lines, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            row_number += 1
+            if line_number in bad_lines:
+                yield row_number, RowError('Not valid UTF-8 text')
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError as e:
+                yield row_number, RowError(f'Invalid JSON: {e}')
+                continue
+            if not isinstance(data, dict):
+                yield row_number, RowError('Each line must be a JSON object')
+                continue
+            yield row_number, data
+    else:
+        raise ValueError(f'Unsupported format: {fmt}')
+
+
+def _decode_lines(upload, bad_lines):
+    """Decode the upload line by line; numbers of lines that are not UTF-8 go to ``bad_lines``."""
+    for line_number, line in enumerate(upload, start=1):
+        if line_number == 1 and line.startswith(codecs.BOM_UTF8):
+            line = line[len(codecs.BOM_UTF8):]
+        try:
+            yield line.decode('utf-8')
+        except UnicodeDecodeError:
+            bad_lines.add(line_number)
+            yield line.decode('utf-8', errors='replace')
+
+
+def _normalize_row(data):
+    category_ids = data.get('category_ids')
+    if isinstance(category_ids, str):
+        data['category_ids'] = [value for value in re.split(r'[;,\s]+', category_ids) if value]
+    elif category_ids is None:
+        data.pop('category_ids', None)
+    return data
+
+
+def _import_chunk(chunk, report):
+    valid = []
+    for row_number, data in chunk:
+        if isinstance(data, RowError):
+            report['errors'].append({'row': row_number, 'errors': {'non_field_errors': [str(data)]}})
+            continue
+        serializer = ItemImportSerializer(data=_normalize_row(data))
+        if serializer.is_valid():
+            valid.append((row_number, serializer.validated_data))
+        else:
+            report['errors'].append({'row': row_number, 'errors': serializer.errors})
+
+    # Slug uniqueness and category existence are checked once per chunk instead of once per row
+    slugs = [data['slug'] for _, data in valid]
+    taken = _taken_slugs(slugs)
+    wanted_categories = {cat_id for _, data in valid for cat_id in data.get('category_ids', [])}
+    known_categories = set(Category.objects.filter(id__in=wanted_categories).values_list('id', flat=True))
+
+    rows = []
+    for row_number, data in valid:
+        missing = sorted(set(data.get('category_ids', [])) - known_categories)
+        if data['slug'] in taken:
+            report['errors'].append({'row': row_number, 'errors': {'slug': [SLUG_TAKEN]}})
+        elif missing:
+            report['errors'].append({'row': row_number, 'errors': {'category_ids': [f'Unknown categories: {missing}']}})
+        else:
+            taken.add(data['slug'])
+            rows.append((row_number, data))
+
+    if not rows:
+        return
+
+    try:
+        report['created'] += _insert_rows([data for _, data in rows])
+    except IntegrityError:
+        # Another request created one of the slugs or deleted a category after the checks above;
+        # insert row by row so that only the conflicting rows are reported
+        for row_number, data in rows:
+            try:
+                report['created'] += _insert_rows([data])
+            except IntegrityError:
+                report['errors'].append({'row': row_number, 'errors': _conflict_errors(data)})
+
+
+def _taken_slugs(slugs):
+    return set(Item.objects.filter(slug__in=slugs).values_list('slug', flat=True))
+
+
+def _insert_rows(rows):
+    with transaction.atomic():
+        items = Item.objects.bulk_create([
+            Item(**{key: value for key, value in data.items() if key != 'category_ids'})
+            for data in rows
+        ])
+        ItemCategory.objects.bulk_create([
+            ItemCategory(item_id=item.id, category_id=category_id)
+            for item, data in zip(items, rows)
+            for category_id in set(data.get('category_ids', []))
+        ])
+    return len(items)
+
+
+def _conflict_errors(data):
+    """Explain why a row that passed validation still failed to insert."""
+    if _taken_slugs([data['slug']]):
+        return {'slug': [SLUG_TAKEN]}
+    wanted = set(data.get('category_ids', []))
+    missing = sorted(wanted - set(Category.objects.filter(id__in=wanted).values_list('id', flat=True)))
+    if missing:
+        return {'category_ids': [f'Unknown categories: {missing}']}
+    return {'non_field_errors': ['Row conflicts with a concurrent change.']}
+
+
+def import_items(rows, chunk_size=IMPORT_CHUNK_SIZE):
+    """Validate and insert items chunk by chunk, collecting per-row errors."""
+    report = {'created': 0, 'failed': 0, 'errors': []}
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            _import_chunk(chunk, report)
+            chunk = []
+    if chunk:
+        _import_chunk(chunk, report)
+
+    report['errors'].sort(key=lambda error: error['row'])
+    report['failed'] = len(report['errors'])
+    if report['created']:
+        bump_catalogue_version()
+    return report
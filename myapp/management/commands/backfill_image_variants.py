@@ -0,0 +1,65 @@
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from myapp.models import Item
+from myapp.variants import generate_item_variants, worker_count
+
+
+class Command(BaseCommand):
+    help = "Render thumbnail/WebP variants for item images that do not have them yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Re-render variants that already exist.")
+        parser.add_argument('--workers', type=int, default=0, help="Worker processes (default: IMAGE_VARIANT_WORKERS or one per CPU).")
+        parser.add_argument('--limit', type=int, default=0, help="Stop after this many images.")
+
+    def handle(self, *args, force=False, workers=0, limit=0, **options):
+        items = Item.objects.exclude(image='').exclude(image__isnull=True).order_by('id')
+        if not force:
+            items = items.filter(image_variants={})
+        items = items.values_list('id', 'image')
+        if limit:
+            items = items[:limit]
+        # Ids are read up front so no cursor stays open while the workers write
+        items = list(items)
+
+        workers = workers or worker_count()
+        counts = Counter()
+        started = time.perf_counter()
+
+        def generate(item_id, name):
+            try:
+                return generate_item_variants(item_id, name, pool)
+            finally:
+                connection.close()
+
+        with ProcessPoolExecutor(max_workers=workers) as pool, ThreadPoolExecutor(max_workers=workers) as threads:
+            pending = {}
+            # A bounded window keeps at most two images per worker in memory
+            for item_id, name in items:
+                pending[threads.submit(generate, item_id, name)] = item_id
+                if len(pending) >= workers * 2:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        counts[self.collect(future, pending.pop(future))] += 1
+            for future in list(pending):
+                counts[self.collect(future, pending.pop(future))] += 1
+
+        elapsed = time.perf_counter() - started
+        rate = counts['done'] / elapsed if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f"Rendered {counts['done']} images, {counts['failed']} failed, {counts['skipped']} changed meanwhile, "
+            f"in {elapsed:.1f}s: {rate:.1f} images/s with {workers} workers ({rate / workers:.1f} per worker)"
+        ))
+
+    def collect(self, future, item_id):
+        try:
+            stored = future.result()
+        except Exception as exc:
+            self.stderr.write(f"Item {item_id}: {exc}")
+            return 'failed'
+        return 'done' if stored is not None else 'skipped'
@@ -0,0 +1,89 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db import connection
+
+from .metrics import Counter, Gauge, Histogram
+
+
+api_requests = Counter('api_requests', 'API requests by view, method and status', ['view', 'method', 'status'])
+api_request_seconds = Histogram('api_request_seconds', 'API request latency in seconds', ['view', 'method'])
+api_requests_in_flight = Gauge('api_requests_in_flight', 'API requests currently being served')
+api_db_queries = Histogram(
+    'api_db_queries', 'Database queries per API request', ['view'],
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89),
+)
+api_db_seconds = Histogram('api_db_seconds', 'Database time per API request in seconds', ['view'])
+
+
+class QueryStats:
+    """connection.execute_wrapper hook that counts and times queries."""
+
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    """Record per-view latency, status codes and database work."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            # Keep async views async under ASGI
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        queries = QueryStats()
+        in_flight = api_requests_in_flight.labels()
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(queries):
+                response = self.get_response(request)
+        finally:
+            in_flight.dec()
+        self.record(request, response, started, queries)
+        return response
+
+    async def __acall__(self, request):
+        # Async ORM calls run on a worker thread with its own connection, out of reach of
+        # an execute_wrapper installed here, so only latency and status are recorded
+        in_flight = api_requests_in_flight.labels()
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            in_flight.dec()
+        self.record(request, response, started)
+        return response
+
+    def record(self, request, response, started, queries=None):
+        match = request.resolver_match
+        view = match.url_name or match.view_name if match else 'unmatched'
+        if view == 'metrics':
+            return
+
+        api_request_seconds.labels(view, request.method).observe(time.perf_counter() - started)
+        api_requests.labels(view, request.method, response.status_code).inc()
+        if queries is not None:
+            api_db_queries.labels(view).observe(queries.count)
+            api_db_seconds.labels(view).observe(queries.seconds)
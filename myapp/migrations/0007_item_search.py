@@ -0,0 +1,45 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+# The "simple" configuration lowercases without stemming, which suits the mixed-language catalogue
+SEARCH_SQL = [
+    """
+    ALTER TABLE myapp_item ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(description, '')), 'B')
+    ) STORED
+    """,
+    "CREATE INDEX item_search_vector_idx ON myapp_item USING GIN (search_vector)",
+    "CREATE INDEX category_name_search_idx ON myapp_category USING GIN (to_tsvector('simple', name))",
+    "CREATE INDEX item_name_trgm_idx ON myapp_item USING GIN (name gin_trgm_ops)",
+]
+
+REVERSE_SQL = [
+    "DROP INDEX IF EXISTS item_name_trgm_idx",
+    "DROP INDEX IF EXISTS category_name_search_idx",
+    "DROP INDEX IF EXISTS item_search_vector_idx",
+    "ALTER TABLE myapp_item DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def run_on_postgres(statements):
+    # Other backends search with the in-memory index in myapp.search
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0006_order_lines'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunPython(run_on_postgres(SEARCH_SQL), run_on_postgres(REVERSE_SQL)),
+    ]
@@ -68,9 +68,15 @@ class Item(models.Model):
     name = models.CharField(max_length=100, db_index=True)
     slug = models.SlugField(max_length=100, unique=True)
     image = models.ImageField(upload_to='items/%Y/%m/%d', blank=True, null=True)
+    # Уменьшенные копии изображения (WebP): имя варианта -> путь в хранилище
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+    # SHA-256 оригинала, вычисляется вместе с вариантами; бот по нему кэширует file_id Telegram
+    image_hash = models.CharField(max_length=64, blank=True, editable=False)
     description = models.TextField(blank=True)
     price = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     available = models.BooleanField(default=True)
+    # Остаток на складе; NULL - остаток не ведётся (продажа без ограничений)
+    stock = models.PositiveIntegerField(null=True, blank=True)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
     
@@ -79,6 +85,12 @@ class Item(models.Model):
 
     class Meta:
         ordering = ('name',)
+        indexes = [
+            # Сортировки и фильтры списка товаров (?ordering=, ?available=, ?min_price=)
+            models.Index(fields=['price', 'id'], name='item_price_id_idx'),
+            models.Index(fields=['created', 'id'], name='item_created_id_idx'),
+            models.Index(fields=['available', 'name', 'id'], name='item_available_name_id_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -95,7 +107,8 @@ class Order(models.Model):
     )
     
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='orders')
-    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='orders')
+    # Для заказов из корзины товар и количество хранятся в OrderLine, item = NULL
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='orders', null=True, blank=True)
     quantity = models.IntegerField(default=1)
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
@@ -104,6 +117,29 @@ class Order(models.Model):
 
     class Meta:
         ordering = ('-created_at',)
+        indexes = [
+            # Курсорная пагинация заказов пользователя
+            models.Index(fields=['user', '-id'], name='order_user_id_desc_idx'),
+            # Фильтр по статусу для админа и для пользователя
+            models.Index(fields=['status', '-id'], name='order_status_id_desc_idx'),
+            models.Index(fields=['user', 'status', '-id'], name='order_user_status_id_idx'),
+            # Фильтр по дате и сортировка по сумме
+            models.Index(fields=['created_at'], name='order_created_at_idx'),
+            models.Index(fields=['total_price', 'id'], name='order_total_price_id_idx'),
+        ]
 
     def __str__(self):
-        return f"Order {self.id} - {self.user.username}"
\ No newline at end of file
+        return f"Order {self.id} - {self.user.username}"
+
+# Строка заказа из корзины
+class OrderLine(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='lines')
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='order_lines')
+    quantity = models.PositiveIntegerField(default=1)
+    price = models.DecimalField(max_digits=10, decimal_places=2)  # Цена за единицу на момент покупки
+
+    class Meta:
+        ordering = ('id',)
+
+    def __str__(self):
+        return f"{self.item_id} x {self.quantity}"
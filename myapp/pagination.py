@@ -0,0 +1,165 @@
+import json
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import F
+from django.db.models.fields.tuple_lookups import Tuple, TupleGreaterThan, TupleLessThan
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination, _reverse_ordering
+
+
+class BaseCursorPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    # ?ordering=<name> -> ordering tuple; each ends with a unique column so cursors stay stable.
+    # All columns of one ordering run in the same direction: the cursor is a row comparison.
+    ordering_options = {}
+
+    def get_ordering(self, request, queryset, view):
+        option = request.query_params.get('ordering')
+        if not option:
+            return self.ordering
+        if option not in self.ordering_options:
+            raise ValidationError({'ordering': [f"Must be one of: {', '.join(self.ordering_options)}."]})
+        return self.ordering_options[option]
+
+    # DRF's paginate_queryset, split around the single query it runs so that
+    # async views can evaluate the page with the async ORM.
+    def paginate_queryset(self, queryset, request, view=None):
+        window = self._page_window(queryset, request, view)
+        if window is None:
+            return None
+        return self._paginate_results(list(window))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        window = self._page_window(queryset, request, view)
+        if window is None:
+            return None
+        return self._paginate_results([obj async for obj in window])
+
+    def _page_window(self, queryset, request, view):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            (offset, reverse, current_position) = (0, False, None)
+        else:
+            (offset, reverse, current_position) = self.cursor
+
+        if reverse:
+            queryset = queryset.order_by(*_reverse_ordering(self.ordering))
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        if current_position is not None:
+            queryset = queryset.filter(self._keyset_filter(queryset.model, current_position))
+
+        # One extra row tells whether a following page exists
+        return queryset[offset:offset + self.page_size + 1]
+
+    def _keyset_filter(self, model, position):
+        """Rows after the cursor: ``(col, id) > (value, pk)``, an index range scan on the
+        ordering's index however many rows share ``value``."""
+        names = [name.lstrip('-') for name in self.ordering]
+        try:
+            values = json.loads(position)
+            if not isinstance(values, list) or len(values) != len(names):
+                raise ValueError(position)
+            values = [model._meta.get_field(name).to_python(value) for name, value in zip(names, values)]
+        except (ValueError, DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+        # Test for: (cursor reversed) XOR (queryset reversed)
+        if self.cursor.reverse != self.ordering[0].startswith('-'):
+            lookup = TupleLessThan
+        else:
+            lookup = TupleGreaterThan
+        return lookup(Tuple(*[F(name) for name in names]), values)
+
+    def _get_position_from_instance(self, instance, ordering):
+        # Every ordering column, so the position is unique and no offset is needed
+        values = []
+        for name in ordering:
+            name = name.lstrip('-')
+            values.append(str(instance[name] if isinstance(instance, dict) else getattr(instance, name)))
+        return json.dumps(values)
+
+    def _paginate_results(self, results):
+        if self.cursor is None:
+            (offset, reverse, current_position) = (0, False, None)
+        else:
+            (offset, reverse, current_position) = self.cursor
+
+        self.page = list(results[:self.page_size])
+
+        if len(results) > len(self.page):
+            has_following_position = True
+            following_position = self._get_position_from_instance(results[-1], self.ordering)
+        else:
+            has_following_position = False
+            following_position = None
+
+        if reverse:
+            self.page = list(reversed(self.page))
+
+            self.has_next = (current_position is not None) or (offset > 0)
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = (current_position is not None) or (offset > 0)
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
+
+
+# Ordering fields must be indexed so every page is a bounded index range scan
+class ItemCursorPagination(BaseCursorPagination):
+    ordering = ('name', 'id')
+    ordering_options = {
+        'name': ('name', 'id'),
+        '-name': ('-name', '-id'),
+        'price': ('price', 'id'),
+        '-price': ('-price', '-id'),
+        'created': ('created', 'id'),
+        '-created': ('-created', '-id'),
+    }
+
+
+class CategoryCursorPagination(BaseCursorPagination):
+    ordering = ('name', 'id')
+
+
+class OrderCursorPagination(BaseCursorPagination):
+    ordering = ('-id',)
+    ordering_options = {
+        '-id': ('-id',),
+        'id': ('id',),
+        '-total_price': ('-total_price', '-id'),
+        'total_price': ('total_price', 'id'),
+    }
+
+
+class UserCursorPagination(BaseCursorPagination):
+    ordering = ('id',)
+
+
+# Search hits are a bounded ranked list rather than an ordered table, so plain offsets are cheap
+class SearchPagination(LimitOffsetPagination):
+    default_limit = 10
+    max_limit = 50
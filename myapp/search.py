@@ -0,0 +1,142 @@
+"""Item search over name, description and category names.
+
+On Postgres this uses the generated ``search_vector`` column and GIN indexes from
+migration 0007, falling back to trigram similarity on the name when full-text search
+finds nothing (typos). Other backends, i.e. SQLite test runs, use an in-memory inverted
+index that is rebuilt whenever the catalogue version changes.
+
+Every query term matches as a prefix, so partially typed words already find items.
+"""
+import bisect
+import re
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from .cache import get_catalogue_version
+from .models import Item
+
+
+TOKEN = re.compile(r'\w+')
+
+# Item.search_vector weights the name (A) above the description (B)
+FULL_TEXT_SQL = """
+    SELECT item.id
+    FROM myapp_item AS item
+    WHERE item.search_vector @@ to_tsquery('simple', %(query)s)
+       OR item.id IN (
+           SELECT link.item_id
+           FROM myapp_item_categories AS link
+           JOIN myapp_category AS category ON category.id = link.category_id
+           WHERE to_tsvector('simple', category.name) @@ to_tsquery('simple', %(query)s)
+       )
+    ORDER BY ts_rank(item.search_vector, to_tsquery('simple', %(query)s)) DESC, item.name, item.id
+    LIMIT %(limit)s
+"""
+
+TRIGRAM_SQL = """
+    SELECT id
+    FROM myapp_item
+    WHERE name %% %(text)s
+    ORDER BY similarity(name, %(text)s) DESC, name, id
+    LIMIT %(limit)s
+"""
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+def search_item_ids(query, limit=None):
+    """Return ids of items matching ``query``, best matches first."""
+    limit = limit or settings.SEARCH_MAX_RESULTS
+    terms = tokenize(query)
+    if not terms:
+        return []
+    if connection.vendor == 'postgresql':
+        return _postgres_search(terms, limit)
+    return memory_index().search(terms, limit)
+
+
+def _postgres_search(terms, limit):
+    # Terms are \w+ only, so they are safe to splice into tsquery syntax
+    tsquery = ' & '.join(f'{term}:*' for term in terms)
+    with connection.cursor() as cursor:
+        cursor.execute(FULL_TEXT_SQL, {'query': tsquery, 'limit': limit})
+        ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            cursor.execute(TRIGRAM_SQL, {'text': ' '.join(terms), 'limit': limit})
+            ids = [row[0] for row in cursor.fetchall()]
+    return ids
+
+
+class InvertedIndex:
+    """Token -> item ids, with prefix lookups over the sorted token list."""
+
+    def __init__(self):
+        self.postings = {}
+        self.tokens = []
+        self.names = {}
+        self.name_tokens = {}
+
+    @classmethod
+    def build(cls, items, item_categories):
+        """``items`` yields (id, name, description); ``item_categories`` yields (item_id, category_name)."""
+        index = cls()
+        for pk, name, description in items:
+            index.names[pk] = name.lower()
+            index.name_tokens[pk] = tokenize(name)
+            index._add(pk, index.name_tokens[pk])
+            index._add(pk, tokenize(description))
+        for pk, category_name in item_categories:
+            index._add(pk, tokenize(category_name))
+        index.tokens = sorted(index.postings)
+        return index
+
+    def _add(self, pk, tokens):
+        for token in tokens:
+            self.postings.setdefault(token, set()).add(pk)
+
+    def _prefix_ids(self, prefix):
+        ids = set()
+        start = bisect.bisect_left(self.tokens, prefix)
+        for token in self.tokens[start:]:
+            if not token.startswith(prefix):
+                break
+            ids |= self.postings[token]
+        return ids
+
+    def _name_hits(self, pk, terms):
+        name_tokens = self.name_tokens[pk]
+        return sum(1 for term in terms if any(token.startswith(term) for token in name_tokens))
+
+    def search(self, terms, limit):
+        matches = None
+        for term in terms:
+            ids = self._prefix_ids(term)
+            matches = ids if matches is None else matches & ids
+            if not matches:
+                return []
+        # Name matches rank first, as with the weighted vector on Postgres
+        ranked = sorted(matches, key=lambda pk: (-self._name_hits(pk, terms), self.names[pk], pk))
+        return ranked[:limit]
+
+
+_memory_lock = threading.Lock()
+_memory_index = (None, None)
+
+
+def memory_index():
+    """The in-memory index for the current catalogue version, rebuilding it if needed."""
+    global _memory_index
+    version = get_catalogue_version()
+    with _memory_lock:
+        if _memory_index[0] != version:
+            item_categories = Item.categories.through.objects.values_list('item_id', 'category__name')
+            index = InvertedIndex.build(
+                Item.objects.values_list('id', 'name', 'description').iterator(),
+                item_categories.iterator(),
+            )
+            _memory_index = (version, index)
+        return _memory_index[1]
@@ -1,5 +1,8 @@
 from django.contrib.auth import get_user_model
 from .models import Item
+from .cache import bump_catalogue_version
+from .variants import image_changed, variant_urls
+from .authentication import token_cache
 from rest_framework import serializers
 
 CustomUser = get_user_model()
@@ -52,59 +55,133 @@ class UserSerializer(serializers.ModelSerializer):
             instance.set_password(password)
         
         instance.save()
+        # Cached authentications carry the old role and password hash
+        token_cache.invalidate_user(instance.pk)
         return instance
 
-from .models import Category, Order
+from .models import Category, Order, OrderLine
 
 class CategorySerializer(serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = ['id', 'name', 'title', 'slug']
 
-class OrderSerializer(serializers.ModelSerializer):
+    def create(self, validated_data):
+        category = super().create(validated_data)
+        bump_catalogue_version()
+        return category
+
+    def update(self, instance, validated_data):
+        category = super().update(instance, validated_data)
+        bump_catalogue_version()
+        return category
+
+class OrderLineSerializer(serializers.ModelSerializer):
     item_name = serializers.CharField(source='item.name', read_only=True)
-    item_price = serializers.DecimalField(source='item.price', max_digits=10, decimal_places=2, read_only=True)
+
+    class Meta:
+        model = OrderLine
+        fields = ['item', 'item_name', 'quantity', 'price']
+
+class SparseFieldsetMixin:
+    # Отдаёт только поля из context['fields'] (параметр ?fields=), None - все поля
+    def get_fields(self):
+        fields = super().get_fields()
+        requested = self.context.get('fields')
+        if requested is not None:
+            fields = {name: field for name, field in fields.items() if name in requested}
+        return fields
+
+class OrderSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    item_name = serializers.CharField(source='item.name', read_only=True, allow_null=True)
+    item_price = serializers.DecimalField(source='item.price', max_digits=10, decimal_places=2, read_only=True, allow_null=True)
+    lines = OrderLineSerializer(many=True, read_only=True)
     
     class Meta:
         model = Order
-        fields = ['id', 'user', 'item', 'item_name', 'item_price', 'quantity', 'total_price', 'status', 'created_at']
+        fields = ['id', 'user', 'item', 'item_name', 'item_price', 'quantity', 'total_price', 'status', 'created_at', 'lines']
         read_only_fields = ['user', 'total_price']
+        # Одиночная покупка всегда указывает товар; заказы из корзины создаются через CheckoutSerializer
+        extra_kwargs = {'item': {'required': True, 'allow_null': False}}
+
+    def validate_quantity(self, value):
+        if value < 1:
+            raise serializers.ValidationError("Quantity must be at least 1.")
+        return value
+
+class CheckoutLineSerializer(serializers.Serializer):
+    item = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1, default=1)
+
+class CheckoutSerializer(serializers.Serializer):
+    lines = CheckoutLineSerializer(many=True, allow_empty=False, max_length=100)
+
+    def validate_lines(self, value):
+        # Одинаковые товары в корзине объединяются в одну строку
+        quantities = {}
+        for line in value:
+            quantities[line['item']] = quantities.get(line['item'], 0) + line['quantity']
+        return quantities
 
 # Обновляем ItemSerializer чтобы включить категории
-class ItemSerializer(serializers.ModelSerializer):
+class ItemSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     categories = CategorySerializer(many=True, read_only=True)
     category_ids = serializers.ListField(
         child=serializers.IntegerField(),
         write_only=True,
         required=False
     )
+    image_variants = serializers.SerializerMethodField()
     
     class Meta:
         model = Item
-        fields = ['id', 'name', 'slug', 'image', 'description', 'price', 'available', 'created', 'updated', 'categories', 'category_ids']
+        fields = ['id', 'name', 'slug', 'image', 'image_variants', 'image_hash', 'description', 'price', 'available', 'stock', 'created', 'updated', 'categories', 'category_ids']
+
+    def get_image_variants(self, item):
+        # Адреса уменьшенных копий; пусто, пока они не сгенерированы
+        return variant_urls(item, self.context.get('request'))
     
     def create(self, validated_data):
         category_ids = validated_data.pop('category_ids', [])
         item = Item.objects.create(**validated_data)
+        if item.image:
+            image_changed(item, None, {})
         
         # Добавляем категории если переданы
         if category_ids:
             categories = Category.objects.filter(id__in=category_ids)
             item.categories.set(categories)
         
+        bump_catalogue_version()
         return item
     
     def update(self, instance, validated_data):
         category_ids = validated_data.pop('category_ids', None)
+        old_image = instance.image.name or None
+        old_variants = instance.image_variants
         
         # Обновляем основные поля
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
+        image_replaced = (instance.image.name or None) != old_image
+        if image_replaced:
+            instance.image_variants = {}
+            instance.image_hash = ''
         instance.save()
+        if image_replaced:
+            image_changed(instance, old_image, old_variants)
         
         # Обновляем категории если переданы
         if category_ids is not None:
             categories = Category.objects.filter(id__in=category_ids)
             instance.categories.set(categories)
         
-        return instance
\ No newline at end of file
+        bump_catalogue_version()
+        return instance
+
+class ItemImportSerializer(ItemSerializer):
+    """ItemSerializer rules for bulk import; slug uniqueness is checked per chunk by the importer."""
+
+    class Meta(ItemSerializer.Meta):
+        fields = ['name', 'slug', 'description', 'price', 'available', 'stock', 'category_ids']
+        extra_kwargs = {'slug': {'validators': []}}
@@ -0,0 +1,287 @@
+"""In-process counterparts of the REST endpoints.
+
+Each service takes the acting user and returns ``(data, status)`` with the same payloads
+and status codes as the HTTP API, after applying the same permission classes as the
+matching view. Reads use the async ORM; writes that need serializers or transactions run
+in Django's sync thread.
+"""
+import functools
+from types import SimpleNamespace
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.http import QueryDict
+from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework.permissions import IsAuthenticated
+
+from .authentication import aauthenticate_credentials, token_cache
+from .cache import aget_catalogue_version, bump_catalogue_version
+from .filters import filter_items, filter_orders
+from .importers import import_items as run_import, iter_upload_rows
+from .models import Category, Item, Order
+from .pagination import (
+    ItemCursorPagination, CategoryCursorPagination, OrderCursorPagination, UserCursorPagination,
+    SearchPagination,
+)
+from .permissions import IsAdmin, IsSuperAdmin
+from .search import search_item_ids
+from .serializers import CategorySerializer, ItemSerializer, OrderSerializer, UserSerializer
+from .views import (
+    ITEM_FIELD_COLUMNS, ORDER_FIELD_COLUMNS, item_queryset, list_params, order_queryset, place_checkout,
+    place_order, token_login, upload_item_image as attach_upload,
+)
+
+
+User = get_user_model()
+
+NOT_AUTHENTICATED = {"detail": "Authentication credentials were not provided."}
+INVALID_TOKEN = {"detail": "Invalid token."}
+PERMISSION_DENIED = {"detail": "You do not have permission to perform this action."}
+
+
+def requires(permission_class):
+    """Reject callers the view's permission class would reject, with the same status codes."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(user, *args, **kwargs):
+            # Permission classes only look at request.user
+            if not permission_class().has_permission(SimpleNamespace(user=user), None):
+                if not user.is_authenticated:
+                    return NOT_AUTHENTICATED, status.HTTP_401_UNAUTHORIZED
+                return PERMISSION_DENIED, status.HTTP_403_FORBIDDEN
+            return await func(user, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class PageRequest:
+    """The parts of a DRF request that cursor pagination reads."""
+
+    def __init__(self, path, **params):
+        self.path = path
+        self.query_params = QueryDict(mutable=True)
+        for name, value in params.items():
+            if value is not None:
+                self.query_params[name] = str(value)
+
+    def build_absolute_uri(self):
+        query = self.query_params.urlencode()
+        return f'{self.path}?{query}' if query else self.path
+
+
+async def paginate(queryset, pagination_class, serializer_class, path, cursor=None, page_size=None):
+    request = PageRequest(path, cursor=cursor, page_size=page_size)
+    return await paginate_page(queryset, pagination_class(), serializer_class, request)
+
+
+async def paginate_page(queryset, paginator, serializer_class, request, fields=None):
+    page = await paginator.apaginate_queryset(queryset, request)
+    serializer = serializer_class(page, many=True, context={'fields': fields})
+    return paginator.get_paginated_response(serializer.data).data, status.HTTP_200_OK
+
+
+def save_serializer(serializer, success_status=status.HTTP_200_OK):
+    if serializer.is_valid():
+        serializer.save()
+        return serializer.data, success_status
+    return serializer.errors, status.HTTP_400_BAD_REQUEST
+
+
+async def token_user(key):
+    """Return the active user owning the token, or None for an unknown or inactive token."""
+    try:
+        user, _ = await aauthenticate_credentials(key)
+    except AuthenticationFailed:
+        return None
+    return user
+
+
+async def login(username, password):
+    return await sync_to_async(token_login)(username, password)
+
+
+@requires(IsAuthenticated)
+async def evict_token(user, key):
+    """Drop the caller's token from the authentication cache; the token stays valid."""
+    token_cache.invalidate(key)
+    return '', status.HTTP_204_NO_CONTENT
+
+
+# Users
+
+@requires(IsSuperAdmin)
+async def list_users(user, cursor=None):
+    return await paginate(User.objects.all(), UserCursorPagination, UserSerializer, '/users/', cursor)
+
+
+@requires(IsSuperAdmin)
+async def get_user(user, pk):
+    try:
+        return UserSerializer(await User.objects.aget(pk=pk)).data, status.HTTP_200_OK
+    except User.DoesNotExist:
+        return {"error": "User not found"}, status.HTTP_404_NOT_FOUND
+
+
+@requires(IsSuperAdmin)
+async def create_user(user, data):
+    return await sync_to_async(save_serializer)(UserSerializer(data=data), status.HTTP_201_CREATED)
+
+
+@requires(IsSuperAdmin)
+async def update_user(user, pk, data):
+    try:
+        instance = await User.objects.aget(pk=pk)
+    except User.DoesNotExist:
+        return {"error": "User not found"}, status.HTTP_404_NOT_FOUND
+    return await sync_to_async(save_serializer)(UserSerializer(instance, data=data))
+
+
+def _delete_user(pk):
+    try:
+        instance = User.objects.get(pk=pk)
+    except User.DoesNotExist:
+        return {"error": "User not found"}, status.HTTP_404_NOT_FOUND
+    token_cache.invalidate_user(instance.pk)
+    instance.delete()
+    return '', status.HTTP_204_NO_CONTENT
+
+
+@requires(IsSuperAdmin)
+async def delete_user(user, pk):
+    return await sync_to_async(_delete_user)(pk)
+
+
+# Items
+
+@requires(IsAuthenticated)
+async def list_items(user, cursor=None, params=None):
+    """``params`` are the list query parameters: filters, ``ordering`` and ``fields``."""
+    request = PageRequest('/items/', cursor=cursor, **(params or {}))
+    paginator = ItemCursorPagination()
+    try:
+        fields, ordering = list_params(request, paginator, ITEM_FIELD_COLUMNS)
+        items = filter_items(item_queryset(fields, ordering), request.query_params)
+    except ValidationError as exc:
+        return exc.detail, status.HTTP_400_BAD_REQUEST
+    return await paginate_page(items, paginator, ItemSerializer, request, fields)
+
+
+@requires(IsAuthenticated)
+async def get_item(user, pk):
+    try:
+        return ItemSerializer(await item_queryset().aget(pk=pk)).data, status.HTTP_200_OK
+    except Item.DoesNotExist:
+        return {"error": "Item not found"}, status.HTTP_404_NOT_FOUND
+
+
+@requires(IsAuthenticated)
+async def search_items(user, query, offset=None):
+    query = (query or '').strip()
+    if not query:
+        return {"error": "Query parameter 'q' is required"}, status.HTTP_400_BAD_REQUEST
+
+    ids = await sync_to_async(search_item_ids)(query)
+    paginator = SearchPagination()
+    page_ids = paginator.paginate_queryset(ids, PageRequest('/items/search/', q=query, offset=offset))
+    items = await item_queryset().ain_bulk(page_ids)
+    serializer = ItemSerializer([items[pk] for pk in page_ids if pk in items], many=True)
+    return paginator.get_paginated_response(serializer.data).data, status.HTTP_200_OK
+
+
+@requires(IsAdmin)
+async def create_item(user, data):
+    return await sync_to_async(save_serializer)(ItemSerializer(data=data), status.HTTP_201_CREATED)
+
+
+@requires(IsAdmin)
+async def update_item(user, pk, data):
+    try:
+        instance = await Item.objects.aget(pk=pk)
+    except Item.DoesNotExist:
+        return {"error": "Item not found"}, status.HTTP_404_NOT_FOUND
+    return await sync_to_async(save_serializer)(ItemSerializer(instance, data=data))
+
+
+def _delete_item(pk):
+    deleted, _ = Item.objects.filter(pk=pk).delete()
+    if not deleted:
+        return {"error": "Item not found"}, status.HTTP_404_NOT_FOUND
+    bump_catalogue_version()
+    return '', status.HTTP_204_NO_CONTENT
+
+
+@requires(IsAdmin)
+async def delete_item(user, pk):
+    return await sync_to_async(_delete_item)(pk)
+
+
+@requires(IsAdmin)
+async def upload_item_image(user, pk, upload):
+    """Attach an image file object to the item; storage writes run in the sync thread."""
+    return await sync_to_async(attach_upload)(pk, upload)
+
+
+@requires(IsAdmin)
+async def import_items(user, upload, filename):
+    """Import a CSV or JSONL file object; the format is picked from the file name."""
+    fmt = 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+    report = await sync_to_async(run_import)(iter_upload_rows(upload, fmt))
+    return report, status.HTTP_200_OK
+
+
+# Categories
+
+@requires(IsAuthenticated)
+async def list_categories(user, cursor=None, page_size=None):
+    return await paginate(
+        Category.objects.all(), CategoryCursorPagination, CategorySerializer, '/categories/', cursor, page_size,
+    )
+
+
+@requires(IsAuthenticated)
+async def catalogue_version(user):
+    return await aget_catalogue_version(), status.HTTP_200_OK
+
+
+@requires(IsAdmin)
+async def create_category(user, data):
+    return await sync_to_async(save_serializer)(CategorySerializer(data=data), status.HTTP_201_CREATED)
+
+
+# Orders
+
+@requires(IsAuthenticated)
+async def list_orders(user, cursor=None, params=None):
+    request = PageRequest('/orders/', cursor=cursor, **(params or {}))
+    paginator = OrderCursorPagination()
+    try:
+        fields, ordering = list_params(request, paginator, ORDER_FIELD_COLUMNS)
+        orders = order_queryset(fields, ordering)
+        if user.role not in ['admin', 'superadmin']:
+            orders = orders.filter(user=user)
+        orders = filter_orders(orders, request.query_params)
+    except ValidationError as exc:
+        return exc.detail, status.HTTP_400_BAD_REQUEST
+    return await paginate_page(orders, paginator, OrderSerializer, request, fields)
+
+
+@requires(IsAuthenticated)
+async def get_order(user, pk):
+    try:
+        order = await order_queryset().aget(pk=pk)
+    except Order.DoesNotExist:
+        return {"error": "Order not found"}, status.HTTP_404_NOT_FOUND
+    if order.user_id != user.id and user.role not in ['admin', 'superadmin']:
+        return {"error": "Access denied"}, status.HTTP_403_FORBIDDEN
+    return OrderSerializer(order).data, status.HTTP_200_OK
+
+
+@requires(IsAuthenticated)
+async def create_order(user, data):
+    return await sync_to_async(place_order)(user, data)
+
+
+@requires(IsAuthenticated)
+async def checkout(user, lines):
+    return await sync_to_async(place_checkout)(user, {'lines': lines})
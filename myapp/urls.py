@@ -1,6 +1,10 @@
+from django.conf import settings
 from django.urls import path
-from . import views
-from .views import api_token_login
+from . import async_views, views
+from .views import api_token_cache_evict, api_token_login
+
+# Catalogue and order read/create views: async variants when API_ASYNC_VIEWS is on
+api = async_views if settings.API_ASYNC_VIEWS else views
 
 urlpatterns = [
     path('api/users/', views.UserList.as_view(), name='user_list'),
@@ -9,20 +13,27 @@ urlpatterns = [
     path('api/user/<int:pk>/edit/', views.UserUpdate.as_view(), name='user_update'),
     path('api/user/<int:pk>/delete/', views.UserDelete.as_view(), name='user_delete'),
 
-    path('api/items/', views.ItemList.as_view(), name='item_list'),
-    path('api/items/<int:pk>/', views.ItemDetail.as_view(), name='item_detail'),
+    path('api/items/', api.ItemList.as_view(), name='item_list'),
+    path('api/items/<int:pk>/', api.ItemDetail.as_view(), name='item_detail'),
+    path('api/items/search/', views.ItemSearch.as_view(), name='item_search'),
     path('api/items/create/', views.ItemCreate.as_view(), name='item_create'),
     path('api/items/<int:pk>/edit/', views.ItemUpdate.as_view(), name='item_update'),
     path('api/items/<int:pk>/delete/', views.ItemDelete.as_view(), name="item_delete"),
+    path('api/items/<int:pk>/image/', views.ItemImageUpload.as_view(), name='item_image_upload'),
+    path('api/items/import/', views.ItemImport.as_view(), name='item_import'),
 
     path('api/token-login/', api_token_login, name='api_token_login'),
+    path('api/token-cache/evict/', api_token_cache_evict, name='api_token_cache_evict'),
+    path('metrics', views.metrics, name='metrics'),
 
     # Category URLs
-    path('api/categories/', views.CategoryList.as_view(), name='category_list'),
+    path('api/categories/', api.CategoryList.as_view(), name='category_list'),
     path('api/categories/create/', views.CategoryCreate.as_view(), name='category_create'),
+    path('api/catalogue/cache-stats/', views.CatalogueCacheStats.as_view(), name='catalogue_cache_stats'),
     
     # Order URLs
-    path('api/orders/', views.OrderList.as_view(), name='order_list'),
-    path('api/orders/create/', views.OrderCreate.as_view(), name='order_create'),
-    path('api/orders/<int:pk>/', views.OrderDetail.as_view(), name='order_detail'),
+    path('api/orders/', api.OrderList.as_view(), name='order_list'),
+    path('api/orders/create/', api.OrderCreate.as_view(), name='order_create'),
+    path('api/orders/checkout/', views.OrderCheckout.as_view(), name='order_checkout'),
+    path('api/orders/<int:pk>/', api.OrderDetail.as_view(), name='order_detail'),
 ]
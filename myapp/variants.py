@@ -0,0 +1,151 @@
+"""Resized WebP variants of item images.
+
+Variants are rendered in a process pool, off the request path, and stored next to the
+original (``items/.../<name>_<variant>.webp``). ``Item.image_variants`` maps each variant
+name to its storage name and stays empty until rendering has finished; ``Item.image_hash``
+(SHA-256 of the original) is filled in at the same time.
+"""
+import hashlib
+import io
+import logging
+import os
+import posixpath
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from PIL import Image, ImageOps
+
+from .cache import bump_catalogue_version
+from .models import Item
+
+
+logger = logging.getLogger(__name__)
+
+# Variant name -> longest side in pixels; images are never upscaled
+VARIANTS = {'thumb': 200, 'small': 480, 'large': 1024}
+WEBP_QUALITY = 80
+
+
+def render_variants(data, variants=VARIANTS, quality=WEBP_QUALITY):
+    """Return {variant: WebP bytes} for the image in ``data``. Runs in a worker process."""
+    sizes = sorted(variants.items(), key=lambda variant: variant[1], reverse=True)
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEGs are decoded at a reduced scale when the largest variant allows it
+        image.draft('RGB', (sizes[0][1], sizes[0][1]))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+
+        rendered = {}
+        # Each variant is scaled down from the previous, larger one
+        for name, size in sizes:
+            image.thumbnail((size, size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            output = io.BytesIO()
+            image.save(output, 'WEBP', quality=quality)
+            rendered[name] = output.getvalue()
+    return rendered
+
+
+def variant_name(name, variant):
+    root, _ = posixpath.splitext(name)
+    return f'{root}_{variant}.webp'
+
+
+def image_storage():
+    return Item._meta.get_field('image').storage
+
+
+def variant_urls(item, request=None):
+    storage = image_storage()
+    urls = {}
+    for variant, name in (item.image_variants or {}).items():
+        url = storage.url(name)
+        urls[variant] = request.build_absolute_uri(url) if request is not None else url
+    return urls
+
+
+def delete_files(storage, names):
+    for name in names:
+        try:
+            storage.delete(name)
+        except Exception:
+            logger.exception("Could not delete image file %s", name)
+
+
+_pool_lock = threading.Lock()
+_process_pool = None
+_dispatcher = None
+
+
+def worker_count():
+    return settings.IMAGE_VARIANT_WORKERS or os.cpu_count() or 1
+
+
+def process_pool():
+    global _process_pool
+    with _pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=worker_count())
+        return _process_pool
+
+
+def generate_item_variants(item_id, name, pool=None):
+    """Render and store the variants of the item's image ``name``.
+
+    Returns the stored mapping, or None when the item's image changed in the meantime.
+    """
+    storage = image_storage()
+    with storage.open(name, 'rb') as source:
+        data = source.read()
+    rendered = (pool or process_pool()).submit(render_variants, data).result()
+
+    stored = {
+        variant: storage.save(variant_name(name, variant), ContentFile(content))
+        for variant, content in rendered.items()
+    }
+    previous = Item.objects.filter(pk=item_id).values_list('image_variants', flat=True).first() or {}
+    image_hash = hashlib.sha256(data).hexdigest()
+    if not Item.objects.filter(pk=item_id, image=name).update(image_variants=stored, image_hash=image_hash):
+        delete_files(storage, stored.values())
+        return None
+    delete_files(storage, [old for old in previous.values() if old not in stored.values()])
+    bump_catalogue_version()
+    return stored
+
+
+def _generate_in_background(item_id, name):
+    try:
+        generate_item_variants(item_id, name)
+    except Exception:
+        logger.exception("Rendering variants for item %s failed", item_id)
+    finally:
+        # The dispatcher thread keeps no connection between jobs
+        connection.close()
+
+
+def schedule_variants(item_id, name):
+    """Render variants in the background; the caller does not wait."""
+    global _dispatcher
+    with _pool_lock:
+        if _dispatcher is None:
+            _dispatcher = ThreadPoolExecutor(max_workers=worker_count(), thread_name_prefix='image-variants')
+    _dispatcher.submit(_generate_in_background, item_id, name)
+
+
+def image_changed(item, old_name, old_variants):
+    """Call inside the transaction that saved a new ``item.image``.
+
+    Once committed, the previous original and its variants are deleted and variants for
+    the new image are scheduled. ``item.image_variants`` and ``item.image_hash`` must
+    already be reset.
+    """
+    storage = image_storage()
+    old_files = ([old_name] if old_name else []) + list((old_variants or {}).values())
+    if old_files:
+        transaction.on_commit(lambda: delete_files(storage, old_files))
+    if item.image:
+        new_name = item.image.name
+        transaction.on_commit(lambda: schedule_variants(item.pk, new_name))
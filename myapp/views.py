@@ -2,14 +2,31 @@ from django.contrib.auth.models import User
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.parsers import MultiPartParser
 from .serializers import UserSerializer, ItemSerializer
-from .models import Item
+from .models import Item, Order, OrderLine
 from rest_framework.permissions import IsAuthenticated
 from django.contrib.auth import get_user_model
 from .permissions import IsAdmin, IsSuperAdmin, IsUser
+from .metrics import CONTENT_TYPE, REGISTRY
+from .importers import import_items, iter_upload_rows
+from .cache import bump_catalogue_version, cached_catalogue_response, catalogue_stats
+from .authentication import token_cache
+from .pagination import (
+    ItemCursorPagination, CategoryCursorPagination, OrderCursorPagination, UserCursorPagination,
+    SearchPagination,
+)
+from .search import search_item_ids
+from .filters import filter_items, filter_orders, sparse_fields
+from .images import ImageRejected, attach_item_image
 
 from django.contrib.auth import authenticate
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseForbidden
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.db.models import F, Prefetch, Q
 from rest_framework.authtoken.models import Token
 
 
@@ -17,12 +34,73 @@ from rest_framework.authtoken.models import Token
 
 User = get_user_model() 
 
+
+# Колонки, которые читает каждое поле ответа; по ним ?fields= сужает SELECT
+ITEM_FIELD_COLUMNS = {
+    'id': ['id'], 'name': ['name'], 'slug': ['slug'], 'image': ['image'],
+    'image_variants': ['image_variants'], 'image_hash': ['image_hash'],
+    'description': ['description'], 'price': ['price'], 'available': ['available'],
+    'stock': ['stock'], 'created': ['created'], 'updated': ['updated'], 'categories': [],
+}
+
+ORDER_FIELD_COLUMNS = {
+    'id': ['id'], 'user': ['user'], 'item': ['item'],
+    'item_name': ['item', 'item__name'], 'item_price': ['item', 'item__price'],
+    'quantity': ['quantity'], 'total_price': ['total_price'], 'status': ['status'],
+    'created_at': ['created_at'], 'lines': [],
+}
+
+
+def field_columns(fields, field_columns_map, ordering=()):
+    # id и поля сортировки нужны всегда: по ним строится курсор
+    columns = {'id'}
+    columns.update(name.lstrip('-') for name in ordering)
+    for name in fields:
+        columns.update(field_columns_map[name])
+    return sorted(columns)
+
+
+def item_queryset(fields=None, ordering=()):
+    # Категории подгружаются одним запросом на страницу, а не на каждый товар
+    if fields is None:
+        return Item.objects.prefetch_related('categories')
+    items = Item.objects.only(*field_columns(fields, ITEM_FIELD_COLUMNS, ordering))
+    if 'categories' in fields:
+        items = items.prefetch_related('categories')
+    return items
+
+
+def order_queryset(fields=None, ordering=()):
+    # OrderSerializer читает только item.name и item.price
+    if fields is None:
+        fields = ORDER_FIELD_COLUMNS
+    columns = field_columns(fields, ORDER_FIELD_COLUMNS, ordering)
+    orders = Order.objects.only(*columns)
+    if 'item__name' in columns or 'item__price' in columns:
+        orders = orders.select_related('item')
+    if 'lines' in fields:
+        lines = OrderLine.objects.select_related('item').only(
+            'id', 'order', 'item', 'item__name', 'quantity', 'price',
+        )
+        orders = orders.prefetch_related(Prefetch('lines', queryset=lines))
+    return orders
+
+
+def list_params(request, paginator, field_columns_map):
+    # Проверяет ?fields= и ?ordering= до запроса к базе
+    fields = sparse_fields(request.query_params, field_columns_map)
+    ordering = paginator.get_ordering(request, None, None)
+    return fields, ordering
+
 class UserList(APIView):
     permission_classes = [IsSuperAdmin]  
+    pagination_class = UserCursorPagination
     def get(self, request):
         users = User.objects.all()
-        serializer = UserSerializer(users, many=True)
-        return Response(serializer.data)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(users, request, view=self)
+        serializer = UserSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 class UserDetail(APIView):
     permission_classes = [IsSuperAdmin]
@@ -54,26 +132,55 @@ class UserDelete(APIView):
     permission_classes = [IsSuperAdmin]  
     def delete(self, request, pk):
         user = User.objects.get(pk=pk)
+        token_cache.invalidate_user(user.pk)
         user.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 class ItemList(APIView):
     permission_classes = [IsAuthenticated]  
+    pagination_class = ItemCursorPagination
     def get(self, request):
-        items = Item.objects.all()
-        serializer =  ItemSerializer(items, many=True)
-        return Response(serializer.data)
+        return cached_catalogue_response(request, lambda: self.list(request))
+
+    def list(self, request):
+        paginator = self.pagination_class()
+        fields, ordering = list_params(request, paginator, ITEM_FIELD_COLUMNS)
+        items = filter_items(item_queryset(fields, ordering), request.query_params)
+        page = paginator.paginate_queryset(items, request, view=self)
+        serializer = ItemSerializer(page, many=True, context={'fields': fields})
+        return paginator.get_paginated_response(serializer.data)
     
 class ItemDetail(APIView):
     permission_classes = [IsAuthenticated]  
     def get(self, request, pk):
+        return cached_catalogue_response(request, lambda: self.retrieve(request, pk))
+
+    def retrieve(self, request, pk):
         try:
-            item = Item.objects.get(pk=pk)
+            item = item_queryset().get(pk=pk)
             serializer = ItemSerializer(item)
             return Response(serializer.data)
         except Item.DoesNotExist: 
             return Response({"error" : "Item not found"}, status=status.HTTP_404_NOT_FOUND)
 
+class ItemSearch(APIView):
+    permission_classes = [IsAuthenticated]
+    pagination_class = SearchPagination
+    def get(self, request):
+        return cached_catalogue_response(request, lambda: self.list(request))
+
+    def list(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({"error": "Query parameter 'q' is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        paginator = self.pagination_class()
+        page_ids = paginator.paginate_queryset(search_item_ids(query), request, view=self)
+        # Товары страницы одним запросом, в порядке релевантности
+        items = item_queryset().in_bulk(page_ids)
+        serializer = ItemSerializer([items[pk] for pk in page_ids if pk in items], many=True)
+        return paginator.get_paginated_response(serializer.data)
+
 class ItemCreate(APIView):
     permission_classes = [IsAdmin]
     def post(self,request):
@@ -103,6 +210,7 @@ class ItemDelete(APIView):
         try:
             item = Item.objects.get(pk=pk)
             item.delete()
+            bump_catalogue_version()
             return Response(status=status.HTTP_204_NO_CONTENT)
         except Item.DoesNotExist:
             return Response({"error" : "Item not found"}, status=status.HTTP_404_NOT_FOUND)
@@ -110,44 +218,121 @@ class ItemDelete(APIView):
     
 
 
-@api_view(['POST'])
-def api_token_login(request):
-    username = request.data.get('username')
-    password = request.data.get('password')
-    
+class ItemImport(APIView):
+    permission_classes = [IsAdmin]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({"error": "File is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        fmt = request.data.get('format')
+        if not fmt:
+            fmt = 'jsonl' if upload.name.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+        if fmt not in ('csv', 'jsonl'):
+            return Response({"error": "Format must be 'csv' or 'jsonl'"}, status=status.HTTP_400_BAD_REQUEST)
+
+        report = import_items(iter_upload_rows(upload, fmt))
+        return Response(report)
+
+
+def upload_item_image(pk, upload):
+    """Привязать изображение к товару; возвращает (данные ответа, статус)."""
+    try:
+        item = Item.objects.get(pk=pk)
+    except Item.DoesNotExist:
+        return {"error": "Item not found"}, status.HTTP_404_NOT_FOUND
+    try:
+        attach_item_image(item, upload)
+    except ImageRejected as exc:
+        return {"error": str(exc)}, status.HTTP_400_BAD_REQUEST
+    return ItemSerializer(item_queryset().get(pk=pk)).data, status.HTTP_200_OK
+
+
+class ItemImageUpload(APIView):
+    permission_classes = [IsAdmin]
+    parser_classes = [MultiPartParser]
+
+    def initialize_request(self, request, *args, **kwargs):
+        # Тело запроса пишется во временный файл частями, даже для маленьких изображений
+        request.upload_handlers = [TemporaryFileUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
+
+    def post(self, request, pk):
+        upload = request.FILES.get('image')
+        if upload is None:
+            return Response({"error": "Image is required"}, status=status.HTTP_400_BAD_REQUEST)
+        data, status_code = upload_item_image(pk, upload)
+        return Response(data, status=status_code)
+
+
+def metrics(request):
+    # Метрики отдаются только с адресов из METRICS_ALLOWED_IPS
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+def token_login(username, password):
+    """Проверить логин и пароль; возвращает (данные ответа, статус)."""
     # Authenticate user with Django's authentication system
     user = authenticate(username=username, password=password)
-    
-    if user is not None:
-        # Get or create token for the user
-        token, created = Token.objects.get_or_create(user=user)
-        return Response({
-            'success': True,
-            'token': token.key,
-            'user': {
-                'id': user.id,
-                'username': user.username,
-                'email': user.email,
-                'role': user.role
-            }
-        })
-    else:
-        return Response({
+    if user is None:
+        return {
             'success': False,
             'error': 'Invalid credentials'
-        }, status=status.HTTP_401_UNAUTHORIZED)
+        }, status.HTTP_401_UNAUTHORIZED
+    
+    # Get or create token for the user
+    token, created = Token.objects.select_related('user').get_or_create(user=user)
+    # Следующие запросы бота с этим токеном не обращаются к базе
+    token_cache.set(token)
+    
+    return {
+        'success': True,
+        'token': token.key,
+        'user': {
+            'id': user.id,
+            'username': user.username,
+            'email': user.email,
+            'role': user.role
+        }
+    }, status.HTTP_200_OK
+
+
+@api_view(['POST'])
+def api_token_login(request):
+    data, status_code = token_login(request.data.get('username'), request.data.get('password'))
+    return Response(data, status=status_code)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def api_token_cache_evict(request):
+    # Только вытесняет токен из кэша аутентификации, это не выход из системы:
+    # токен общий для всех сессий пользователя и остаётся действительным
+    if request.auth is not None:
+        token_cache.invalidate(request.auth.key)
+    return Response(status=status.HTTP_204_NO_CONTENT)
     
 from .models import Category, Order
-from .serializers import CategorySerializer, OrderSerializer
+from .serializers import CategorySerializer, OrderSerializer, CheckoutSerializer
 
 # Category APIs
 class CategoryList(APIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = CategoryCursorPagination
     
     def get(self, request):
+        return cached_catalogue_response(request, lambda: self.list(request))
+
+    def list(self, request):
         categories = Category.objects.all()
-        serializer = CategorySerializer(categories, many=True)
-        return Response(serializer.data)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(categories, request, view=self)
+        serializer = CategorySerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
 class CategoryCreate(APIView):
     permission_classes = [IsAdmin]
@@ -159,61 +344,148 @@ class CategoryCreate(APIView):
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class CatalogueCacheStats(APIView):
+    permission_classes = [IsAdmin]
+
+    def get(self, request):
+        return Response(catalogue_stats.snapshot())
+
 # Order APIs
+def place_order(user, data):
+    """Создать заказ на один товар; возвращает (данные ответа, статус)."""
+    # Пользователь может покупать только для себя
+    data = data.copy()
+    data['user'] = user.id
+    
+    serializer = OrderSerializer(data=data)
+    if not serializer.is_valid():
+        return serializer.errors, status.HTTP_400_BAD_REQUEST
+    
+    item_id = serializer.validated_data['item'].id
+    quantity = serializer.validated_data.get('quantity', 1)
+    
+    with transaction.atomic():
+        # Резервируем товар одним условным UPDATE: строка блокируется до конца
+        # транзакции, поэтому параллельные покупки не могут продать больше остатка.
+        # stock = NULL означает, что остаток не ведётся.
+        reserved = Item.objects.filter(
+            Q(stock__isnull=True) | Q(stock__gte=quantity),
+            pk=item_id,
+            available=True,
+        ).update(stock=F('stock') - quantity)
+        
+        if not reserved:
+            available = Item.objects.filter(pk=item_id).values_list('available', flat=True).first()
+            if available is None:
+                return {"error": "Item not found"}, status.HTTP_404_NOT_FOUND
+            if not available:
+                return {"error": "Item is not available"}, status.HTTP_409_CONFLICT
+            return {"error": "Not enough stock"}, status.HTTP_409_CONFLICT
+        
+        # Цена читается под блокировкой строки
+        price, stock = Item.objects.values_list('price', 'stock').get(pk=item_id)
+        if stock is not None:
+            # Кэшированный каталог показывает остаток: сбрасываем его после коммита
+            bump_catalogue_version()
+        
+        # Создаем заказ
+        order = serializer.save(
+            user=user,
+            total_price=price * quantity,
+            status='completed'  # Сразу завершаем покупку
+        )
+    
+    return OrderSerializer(order).data, status.HTTP_201_CREATED
+
 class OrderCreate(APIView):
     permission_classes = [IsAuthenticated]
     
     def post(self, request):
-        # Пользователь может покупать только для себя
-        data = request.data.copy()
-        data['user'] = request.user.id
+        data, status_code = place_order(request.user, request.data)
+        return Response(data, status=status_code)
+
+def place_checkout(user, data):
+    """Оформить заказ из нескольких товаров; возвращает (данные ответа, статус)."""
+    serializer = CheckoutSerializer(data=data)
+    if not serializer.is_valid():
+        return serializer.errors, status.HTTP_400_BAD_REQUEST
+    
+    quantities = serializer.validated_data['lines']
+    
+    with transaction.atomic():
+        # Все строки оцениваются одним запросом; порядок по pk исключает взаимные блокировки
+        items = list(
+            Item.objects.select_for_update()
+            .filter(pk__in=quantities.keys())
+            .only('id', 'price', 'stock', 'available')
+            .order_by('pk')
+        )
         
-        serializer = OrderSerializer(data=data)
-        if serializer.is_valid():
-            # Рассчитываем общую цену
-            item_id = data.get('item')
-            quantity = data.get('quantity', 1)
-            
-            try:
-                item = Item.objects.get(id=item_id)
-                total_price = item.price * quantity
-                
-                # Создаем заказ
-                order = serializer.save(
-                    user=request.user,
-                    total_price=total_price,
-                    status='completed'  # Сразу завершаем покупку
-                )
-                
-                return Response(OrderSerializer(order).data, status=status.HTTP_201_CREATED)
-                
-            except Item.DoesNotExist:
-                return Response({"error": "Item not found"}, status=status.HTTP_404_NOT_FOUND)
+        missing = sorted(set(quantities) - {item.id for item in items})
+        if missing:
+            return {"error": "Item not found", "items": missing}, status.HTTP_404_NOT_FOUND
         
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        unavailable = [item.id for item in items if not item.available]
+        if unavailable:
+            return {"error": "Item is not available", "items": unavailable}, status.HTTP_409_CONFLICT
+        
+        short = [item.id for item in items if item.stock is not None and item.stock < quantities[item.id]]
+        if short:
+            return {"error": "Not enough stock", "items": short}, status.HTTP_409_CONFLICT
+        
+        tracked = [item for item in items if item.stock is not None]
+        for item in tracked:
+            item.stock -= quantities[item.id]
+        if tracked:
+            Item.objects.bulk_update(tracked, ['stock'])
+            bump_catalogue_version()
+        
+        order = Order.objects.create(
+            user=user,
+            quantity=sum(quantities.values()),
+            total_price=sum(item.price * quantities[item.id] for item in items),
+            status='completed'
+        )
+        OrderLine.objects.bulk_create([
+            OrderLine(order=order, item_id=item.id, quantity=quantities[item.id], price=item.price)
+            for item in items
+        ])
+    
+    return OrderSerializer(order_queryset().get(pk=order.pk)).data, status.HTTP_201_CREATED
+
+class OrderCheckout(APIView):
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request):
+        data, status_code = place_checkout(request.user, request.data)
+        return Response(data, status=status_code)
 
 class OrderList(APIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = OrderCursorPagination
     
     def get(self, request):
         # Пользователь видит только свои заказы
         # Админ/суперадмин могут видеть все заказы
-        if request.user.role in ['admin', 'superadmin']:
-            orders = Order.objects.all()
-        else:
-            orders = Order.objects.filter(user=request.user)
-        
-        serializer = OrderSerializer(orders, many=True)
-        return Response(serializer.data)
+        paginator = self.pagination_class()
+        fields, ordering = list_params(request, paginator, ORDER_FIELD_COLUMNS)
+        orders = order_queryset(fields, ordering)
+        if request.user.role not in ['admin', 'superadmin']:
+            orders = orders.filter(user=request.user)
+        orders = filter_orders(orders, request.query_params)
+
+        page = paginator.paginate_queryset(orders, request, view=self)
+        serializer = OrderSerializer(page, many=True, context={'fields': fields})
+        return paginator.get_paginated_response(serializer.data)
 
 class OrderDetail(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request, pk):
         try:
-            order = Order.objects.get(pk=pk)
+            order = order_queryset().get(pk=pk)
             # Проверяем что пользователь имеет доступ к этому заказу
-            if order.user != request.user and request.user.role not in ['admin', 'superadmin']:
+            if order.user_id != request.user.id and request.user.role not in ['admin', 'superadmin']:
                 return Response({"error": "Access denied"}, status=status.HTTP_403_FORBIDDEN)
             
             serializer = OrderSerializer(order)
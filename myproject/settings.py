@@ -38,12 +38,14 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'myapp',
     'rest_framework',
     'rest_framework.authtoken',  # Add this
 ]
 
 MIDDLEWARE = [
+    'myapp.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -138,14 +140,70 @@ MINIO_STORAGE_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY")
 MINIO_STORAGE_SECRET_KEY = os.getenv("MINIO_SECRET_KEY")
 MINIO_STORAGE_USE_HTTPS = os.getenv("MINIO_USE_HTTPS") == "True"
 MINIO_STORAGE_BUCKET_NAME = os.getenv("MINIO_BUCKET")
-DEFAULT_FILE_STORAGE = 'minio_storage.storage.MinioMediaStorage'
+MINIO_STORAGE_MEDIA_BUCKET_NAME = MINIO_STORAGE_BUCKET_NAME
+
+# Item images go to MinIO; without MINIO_ENDPOINT (local runs, tests) they are kept under MEDIA_ROOT.
+# Django 5 reads the backend from STORAGES only.
+DEFAULT_FILE_STORAGE = (
+    'minio_storage.storage.MinioMediaStorage' if MINIO_STORAGE_ENDPOINT
+    else 'django.core.files.storage.FileSystemStorage'
+)
+STORAGES = {
+    'default': {'BACKEND': DEFAULT_FILE_STORAGE},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", str(BASE_DIR / 'media'))
+MEDIA_URL = os.getenv("MEDIA_URL", '/media/')
+
+# Largest accepted item image; uploads are streamed to a temporary file, never held in memory
+ITEM_IMAGE_MAX_SIZE = int(os.getenv("ITEM_IMAGE_MAX_SIZE", str(20 * 1024 * 1024)))
+
+# Processes rendering thumbnail/WebP variants of item images; 0 means one per CPU
+IMAGE_VARIANT_WORKERS = int(os.getenv("IMAGE_VARIANT_WORKERS", "0"))
 
 AUTH_USER_MODEL = 'myapp.CustomUser'
 
+# Cache for catalogue responses: "file" (default) or "locmem".
+# The catalogue version lives in this cache, so every worker process must share it:
+# "locmem" is per-process and only suitable for a single process (e.g. runserver).
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "file")
+
+if CACHE_BACKEND == "file":
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.getenv("CACHE_LOCATION", str(BASE_DIR / '.cache')),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'catalogue',
+        }
+    }
+
+CATALOGUE_CACHE_TIMEOUT = int(os.getenv("CATALOGUE_CACHE_TIMEOUT", "600"))
+
+# Upper bound on ranked search hits; pages are cut from this list
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "100"))
+
+# Token authentication cache: in-process LRU, optionally backed by a shared cache alias from CACHES
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+AUTH_TOKEN_CACHE_TTL = float(os.getenv("AUTH_TOKEN_CACHE_TTL", "60"))
+AUTH_TOKEN_SHARED_CACHE = os.getenv("AUTH_TOKEN_SHARED_CACHE", "")
+AUTH_TOKEN_SHARED_CACHE_TTL = int(os.getenv("AUTH_TOKEN_SHARED_CACHE_TTL", "300"))
+
+# Serve catalogue and order endpoints with async views (for ASGI deployments)
+API_ASYNC_VIEWS = os.getenv("API_ASYNC_VIEWS") == "True"
+
+# Addresses allowed to scrape /metrics
+METRICS_ALLOWED_IPS = os.getenv("METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",")
+
 # Add to settings.py
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'myapp.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [